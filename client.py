@@ -1,17 +1,17 @@
 #!/usr/bin/env python3
 
-import curses, locale, select, signal, socket, struct, sys, time, traceback
+import argparse, curses, locale, selectors, signal, socket, sys, time, traceback
+import numpy
 
-locale.setlocale(locale.LC_ALL, '')
+from snek_pkts import *
+from snek_decode import *
 
-MSG_TYPE_JOIN = 0
-MSG_TYPE_BOARD = 1
-MSG_TYPE_UPDATE = 2
-MSG_TYPE_INFO = 3
-MSG_TYPE_TXT = 4
+locale.setlocale(locale.LC_ALL, '')
 
-INFO_TYPE_JOIN = 0
-INFO_TYPE_KILL = 1
+# the board is drawn through a window this big, following our snek around
+VIEW_W = 80
+VIEW_H = 40
+VIEW_MARGIN = 10
 
 NAME = 0
 SYMBOL = 1
@@ -46,9 +46,6 @@ the_sneks = {
         16: ('Dave', 'O&', 56)
         }
 
-TICKS_PER_SECOND_INPUT = 60
-TICKS_PER_SECOND_FPS = 7
-
 WHITEONGRAY = 128
 
 helpmsg = '''
@@ -137,27 +134,6 @@ class renderer:
     def shutdown(self):
         curses.endwin()
 
-# recv n characters from the socket
-def recv_n(sock, recv_len):
-    try:
-        buf = b''
-        while len(buf) < recv_len:
-            r, w, e = select.select([sock], [], [], 0)
-            if sock in r:
-                t_buf = sock.recv(recv_len - len(buf))
-            if not t_buf: # disconnected
-                raise Exception('Connection lost.')
-            buf += t_buf
-
-            if len(buf) != recv_len: # recv error
-                sock.close()
-                raise Exception('Recieve error.')
-
-    except Exception as e:
-        sys.stderr.write('Rx error:' + str(e))
-
-    return buf
-
 class snek:
     health = 0
     score = 0
@@ -190,10 +166,115 @@ class game:
     sidebar_dirty = True
     messagebar_dirty = True
     join_sent = False
-    board = [[0 for x in range(0,80)] for y in range(0,40)]
-    board_buff = [[0 for x in range(0,80)] for y in range(0,40)]
+    # (xs, ys) of the squares updates changed since the board was last drawn
+    changes = []
+    glyphs = {}
+    board_buff = numpy.zeros((40, 80), dtype=numpy.uint16)
     show_msg = True
     current_msg = helpmsg
+    version = PROTOCOL_V2
+    width = 80
+    height = 40
+    view_x = 0
+    view_y = 0
+    my_head = None
+    my_direction = None
+    region = None
+    # turns sent that the server hasn't acked, (sequence number, direction),
+    # and the squares drawn where we expect our snek to be after them
+    input_seq = 0
+    pending = []
+    predicted = []
+    # ticks over UDP, if we ask and the server has it. udp_seq is the
+    # number of the last state we applied.
+    use_udp = True
+    # the arena we're watching instead of playing, if we're a spectator
+    spectate = None
+    spectating = False
+    udp = None
+    udp_token = 0
+    udp_seq = 0
+
+    def get_snek(self, snek_id):
+        # sneks past the named ones reuse their looks
+        while len(self.sneks) <= snek_id:
+            i = len(self.sneks)
+            looks = the_sneks[i % len(the_sneks)]
+            name = looks[NAME] if i < len(the_sneks) else looks[NAME] + ' ' + str(i // len(the_sneks) + 1)
+            self.sneks.append(snek(i, looks[COLOR], looks[SYMBOL], name))
+        return self.sneks[snek_id]
+
+    def resize_board(self, width, height):
+        self.width = width
+        self.height = height
+        self.board_buff = numpy.zeros((height, width), dtype=numpy.uint16)
+        self.my_head = None
+        self.my_direction = None
+        self.pending = []
+        self.predicted = []
+        self.region = None
+        self.view_x = 0
+        self.view_y = 0
+        self.wipe = True
+
+    # keep our snek's head away from the edges of the view, unless the
+    # server is choosing the region we see
+    def move_head(self, head):
+        # which way our head went is which way we're heading
+        if self.my_head and head != self.my_head:
+            moves = [step_square(*self.my_head, direction, self.width, self.height) for direction in range(4)]
+            self.my_direction = moves.index(head) if head in moves else None
+        self.my_head = head
+
+    # show our snek's turns now rather than a round trip later: until the
+    # server acks them, draw the head where the next tick will put it
+    def predict(self):
+        # what was predicted before gets drawn over with what the server says
+        for x, y, v in self.predicted:
+            self.changes.append((numpy.array([x]), numpy.array([y])))
+            self.dirty = True
+        self.predicted = []
+        if not self.pending or not self.my_head or self.my_direction is None:
+            return
+
+        # the server ignores turning back on ourselves, and the last turn wins
+        direction = self.my_direction
+        for seq, turn in self.pending:
+            if 0 != (turn + self.my_direction) % 2:
+                direction = turn
+        if direction == self.my_direction:
+            return
+
+        head = snek_head_square(self.my_snek.snek_id)
+        x, y = step_square(*self.my_head, direction, self.width, self.height)
+        self.predicted = [(self.my_head[0], self.my_head[1], head + 1), (x, y, head)]
+        self.dirty = True
+
+    # spectators have no head to follow, so the arrow keys move the view instead
+    def pan(self, direction):
+        for i in range(VIEW_MARGIN):
+            self.view_x, self.view_y = step_square(self.view_x, self.view_y, direction, self.width, self.height)
+        if self.width <= VIEW_W:
+            self.view_x = 0
+        if self.height <= VIEW_H:
+            self.view_y = 0
+        self.dirty = True
+        self.wipe = True
+
+    def follow_head(self):
+        if not self.my_head or self.region:
+            return
+        x, y = self.my_head
+        if self.width > VIEW_W:
+            dx = (x - self.view_x) % self.width
+            if dx < VIEW_MARGIN or dx >= VIEW_W - VIEW_MARGIN:
+                self.view_x = (x - VIEW_W // 2) % self.width
+                self.wipe = True
+        if self.height > VIEW_H:
+            dy = (y - self.view_y) % self.height
+            if dy < VIEW_MARGIN or dy >= VIEW_H - VIEW_MARGIN:
+                self.view_y = (y - VIEW_H // 2) % self.height
+                self.wipe = True
 
     def get_sneks_by_highscore(self):
         return sorted(self.sneks, key=lambda x: x.score, reverse=True)
@@ -224,40 +305,77 @@ class game:
 
     def draw_board(self):
         if self.dirty:
-            # if wiping, clear and draw borders
+            window = self.my_renderer.game_window
+            border = curses.color_pair(self.get_snek(self.my_snek.snek_id).color)
+            # if wiping, clear, draw borders and repaint every square in view
             if self.wipe:
-                self.my_renderer.game_window.erase()
-                self.my_renderer.game_window.addstr(0,0,'+' + '-=' * 40 + '+', curses.color_pair(self.sneks[self.my_snek.snek_id].color))
-                self.my_renderer.game_window.addstr(41,0,'+' + '=-' * 40 + '+', curses.color_pair(self.sneks[self.my_snek.snek_id].color))
-            y = 1
-            for y_line in self.board_buff:
-                x = 1
-                # if wiping, draw borders
-                if self.wipe:
-                    self.my_renderer.game_window.addstr(y,0,'|', curses.color_pair(self.sneks[self.my_snek.snek_id].color))
-                    self.my_renderer.game_window.addstr(y,81,'|', curses.color_pair(self.sneks[self.my_snek.snek_id].color))
-                for x_elem in y_line:
-                    if self.board[y-1][x-1] != x_elem or self.wipe:
-                        self.board[y-1][x-1] = x_elem
-                        # clear previously used squares
-                        if x_elem == 0:
-                            self.my_renderer.game_window.addstr(y, x, ' ')
-                        # draw sneks
-                        elif x_elem > 0 and x_elem < 33:
-                            snek_id = (x_elem if x_elem % 2 == 0 else x_elem + 1) // 2 - 1
-                            self.my_renderer.game_window.addstr(y, x, self.sneks[snek_id].symbol[x_elem % 2], curses.color_pair(self.sneks[snek_id].color))
-                        # draw foodz
-                        elif x_elem > 32 and x_elem < 64:
-                            self.my_renderer.game_window.addstr(y, x, the_foods[x_elem][SYMBOL], curses.color_pair(the_foods[x_elem][COLOR]))
-                    x += 1
-                y += 1
+                window.erase()
+                window.addstr(0,0,'+' + '-=' * 40 + '+', border)
+                window.addstr(41,0,'+' + '=-' * 40 + '+', border)
+                columns = (self.view_x + numpy.arange(min(VIEW_W, self.width))) % self.width
+                for y in range(1, VIEW_H + 1):
+                    window.addstr(y,0,'|', border)
+                    window.addstr(y,81,'|', border)
+                    # the view wraps around the board like the sneks do
+                    if y <= self.height:
+                        self.draw_squares(y, 1, self.board_buff[(self.view_y + y - 1) % self.height, columns].tolist())
+            # otherwise only the squares that changed, a run along a row at a time
+            elif self.changes:
+                xs = numpy.concatenate([xs for xs, ys in self.changes])
+                ys = numpy.concatenate([ys for xs, ys in self.changes])
+                vx = (xs.astype(numpy.intp) - self.view_x) % self.width
+                vy = (ys.astype(numpy.intp) - self.view_y) % self.height
+                in_view = (vx < VIEW_W) & (vy < VIEW_H)
+                at = numpy.unique(vy[in_view] * VIEW_W + vx[in_view])
+                vy, vx = numpy.divmod(at, VIEW_W)
+                values = self.board_buff[(vy + self.view_y) % self.height, (vx + self.view_x) % self.width].tolist()
+                # runs break where the next square isn't the one to the right
+                breaks = (numpy.flatnonzero((at[1:] != at[:-1] + 1) | (0 == vx[1:])) + 1).tolist()
+                for start, end in zip([0] + breaks, breaks + [len(at)]):
+                    if start < end:
+                        self.draw_squares(int(vy[start]) + 1, int(vx[start]) + 1, values[start:end])
+            # our predicted head goes over the top
+            for x, y, v in self.predicted:
+                vx = (x - self.view_x) % self.width
+                vy = (y - self.view_y) % self.height
+                if vx < VIEW_W and vy < VIEW_H:
+                    self.draw_squares(vy + 1, vx + 1, [v])
             # move the cursor out of the play area
-            self.my_renderer.game_window.addstr(41, 81, '+', curses.color_pair(self.sneks[self.my_snek.snek_id].color))
+            window.addstr(41, 81, '+', border)
             # refresh without redrawing
-            self.my_renderer.game_window.noutrefresh()
+            window.noutrefresh()
+            self.changes = []
             self.dirty = False
             self.wipe = False
 
+    # draw squares left to right from (x, y) in the window, one addstr per run of the same colour
+    def draw_squares(self, y, x, values):
+        window = self.my_renderer.game_window
+        run = ''
+        run_attr = 0
+        for v in values:
+            symbol, attr = self.glyph(v)
+            if attr != run_attr and run:
+                window.addstr(y, x, run, run_attr)
+                x += len(run)
+                run = ''
+            run += symbol
+            run_attr = attr
+        if run:
+            window.addstr(y, x, run, run_attr)
+
+    # the character and colour a square is drawn with
+    def glyph(self, v):
+        if v not in self.glyphs:
+            if is_snek_square(v):
+                snek = self.get_snek(square_snek_id(v))
+                self.glyphs[v] = (snek.symbol[v % 2], curses.color_pair(snek.color))
+            elif v in the_foods:
+                self.glyphs[v] = (the_foods[v][SYMBOL], curses.color_pair(the_foods[v][COLOR]))
+            else:
+                self.glyphs[v] = (' ', 0)
+        return self.glyphs[v]
+
     def draw_sidebar(self):
         if self.sidebar_dirty:
             sneks_sorted = self.get_sneks_by_highscore()
@@ -302,40 +420,86 @@ class game:
         if msg_type == MSG_TYPE_JOIN:
             pass
 
-        elif msg_type == MSG_TYPE_BOARD or msg_type == MSG_TYPE_UPDATE:
-            num_sneks = msg[0]
-            sneks = msg[1:1 + num_sneks * 5]
-            board_changes = msg[1 + num_sneks * 5:]
+        elif msg_type == MSG_TYPE_BOARD or msg_type == MSG_TYPE_UPDATE or msg_type == MSG_TYPE_REGION:
             # process sneks
-            for snek in [sneks[i:i+5] for i in range(0, len(sneks), 5)]:
-                snek_id = snek[0]
-                score = struct.unpack('!h', snek[1:3])[0]
-                health = struct.unpack('!h', snek[3:5])[0]
-                if score != self.sneks[snek_id].score:
-                    self.sneks[snek_id].score = score
+            sneks, payload = split_frame(msg, self.version)
+            for snek_id, score, health in sneks:
+                snek = self.get_snek(snek_id)
+                if score != snek.score:
+                    snek.score = score
                     self.sidebar_dirty = True
-                if health != self.sneks[snek_id].health:
-                    self.sneks[snek_id].health = health
+                if health != snek.health:
+                    snek.health = health
                     self.sidebar_dirty = True
 
+            # v1 packs squares in bytes and is never encoded, v2 boards and
+            # updates start with the encoding the server picked
+            square = LAYOUTS[self.version][2]
+            if self.version == PROTOCOL_V1:
+                encoding = ENC_RAW
+            else:
+                encoding = payload[0]
+                payload = payload[1:]
+
+            my_head = -1 if self.spectating else snek_head_square(self.my_snek.snek_id)
             if msg_type == MSG_TYPE_BOARD:
-                # process board whole
-                cnt = 0
-                for v in board_changes:
-                    self.board_buff[cnt // 80][cnt % 80] = int(v)
-                    cnt += 1
+                # process board whole, the server sends it when we see all of it
+                self.region = None
+                squares = decode_squares(encoding, payload, square)
+                self.board_buff[:] = squares.reshape(self.height, self.width)
+                self.wipe = True
+                found = numpy.flatnonzero(squares == my_head)
+                if len(found):
+                    self.move_head((int(found[0]) % self.width, int(found[0]) // self.width))
             # process board updates
-            elif msg_type == MSG_TYPE_UPDATE: 
-                for update in [board_changes[i:i+3] for i in range(0, len(board_changes), 3)]:
-                    self.board_buff[update[1]][update[0]] = int(update[2])
+            elif msg_type == MSG_TYPE_UPDATE:
+                area = self.region or (0, 0, self.width, self.height)
+                xs, ys, squares = decode_changes(encoding, payload, area, self.width, self.height, square)
+                self.board_buff[ys, xs] = squares
+                self.changes.append((xs, ys))
+                found = numpy.flatnonzero(squares == my_head)
+                if len(found):
+                    self.move_head((int(xs[found[-1]]), int(ys[found[-1]])))
+            # process the region around our snek, and center the view in it
+            elif msg_type == MSG_TYPE_REGION:
+                rx, ry, rw, rh = REGION.unpack_from(payload)
+                squares = decode_squares(encoding, payload[REGION.size:], square)
+                rows = (ry + numpy.arange(rh)) % self.height
+                columns = (rx + numpy.arange(rw)) % self.width
+                self.board_buff[numpy.ix_(rows, columns)] = squares.reshape(rh, rw)
+                self.region = (rx, ry, rw, rh)
+                self.wipe = True
+                self.view_x = (rx + max(0, rw - VIEW_W) // 2) % self.width
+                self.view_y = (ry + max(0, rh - VIEW_H) // 2) % self.height
+            self.follow_head()
+            self.predict()
             self.dirty = True
 
+        elif msg_type == MSG_TYPE_UDP:
+            # say hello from where we'll take states, the server sends them there once it hears it
+            self.udp_token, port = unpack_udp(msg)
+            if not self.udp:
+                self.udp = socket.socket(self.sock.family, socket.SOCK_DGRAM)
+                self.udp.connect((self.sock.getpeername()[0], port))
+                self.udp.setblocking(0)
+            self.send_udp_ack()
+
+        elif msg_type == MSG_TYPE_STATE:
+            self.process_state(msg)
+
+        elif msg_type == MSG_TYPE_ACK:
+            # the server applied our turns up to this one, the update after this shows them
+            seqs = [seq for seq, direction in self.pending]
+            if msg[0] in seqs:
+                self.pending = self.pending[seqs.index(msg[0]) + 1:]
+
         elif msg_type == MSG_TYPE_INFO:
-            if msg[0] == INFO_TYPE_JOIN:
-                self.add_message(self.sneks[msg[1]].name + ' has joined the fight.')
-            elif msg[0] == INFO_TYPE_KILL:
-                self.add_message(self.sneks[msg[1]].name + ' has met an untimely death.  Mediocre.')
-                if msg[1] == self.my_snek.snek_id:
+            info_type, snek_id = unpack_info(msg, self.version)
+            if info_type == INFO_TYPE_JOIN:
+                self.add_message(self.get_snek(snek_id).name + ' has joined the fight.')
+            elif info_type == INFO_TYPE_KILL:
+                self.add_message(self.get_snek(snek_id).name + ' has met an untimely death.  Mediocre.')
+                if snek_id == self.my_snek.snek_id and not self.spectating:
                     self.current_msg = ('\n\n\n\n\n\n\n\n\n\nYOU ARE DEAD\n\n\n\n\n\n\nPress SPACE to respawn.')
                     self.show_msg = True
                     self.join_sent = False
@@ -343,30 +507,139 @@ class game:
         elif msg_type == MSG_TYPE_TXT:
             pass
 
+    # a state from the UDP channel, which can arrive late, twice or not at all
+    def process_state(self, data):
+        seq, base, input_seq = UDP_STATE.unpack_from(data)
+        # only newer states, and only changes since a state we have
+        if seq <= self.udp_seq or base > self.udp_seq:
+            return
+        if input_seq:
+            self.process_msg(MSG_TYPE_ACK, bytes([input_seq]))
+        msg_type, msg_len = HEADER.unpack_from(data, UDP_STATE.size)
+        self.process_msg(msg_type, memoryview(data)[UDP_STATE.size + HEADER.size:])
+        self.udp_seq = seq
+        self.send_udp_ack()
+
+    def send_udp_ack(self):
+        try:
+            self.udp.send(UDP_ACK.pack(self.udp_token, self.udp_seq))
+        except OSError:
+            pass
+
+    def send_join(self):
+        if self.spectate is not None:
+            self.sock.send(CLIENT_MSG_V2.pack(SPECTATE_V2, self.spectate, ACCEPT_ALL))
+        elif self.version == PROTOCOL_V1:
+            self.sock.send(JOIN_REQUEST)
+        else:
+            self.sock.send(CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, ACCEPT_ALL | (JOIN_UDP if self.use_udp else 0)))
+
+    def send_cmd(self, cmd):
+        if self.spectating:
+            self.pan(cmd)
+        elif self.version == PROTOCOL_V1:
+            self.sock.send(bytes([self.my_snek.snek_id, cmd]))
+        else:
+            # number the turn so the server can ack it, and show it straight away
+            self.input_seq = self.input_seq % 255 + 1
+            self.sock.send(CLIENT_MSG_V2.pack(self.my_snek.snek_id, cmd, self.input_seq))
+            self.pending = self.pending + [(self.input_seq, cmd)]
+            self.predict()
+
     def turn_up(self):
-        self.sock.send(bytes([self.my_snek.snek_id]) + b'\x00')
+        self.send_cmd(0)
 
     def turn_right(self):
-        self.sock.send(bytes([self.my_snek.snek_id]) + b'\x01')
+        self.send_cmd(1)
 
     def turn_down(self):
-        self.sock.send(bytes([self.my_snek.snek_id]) + b'\x02')
+        self.send_cmd(2)
 
     def turn_left(self):
-        self.sock.send(bytes([self.my_snek.snek_id]) + b'\x03')
+        self.send_cmd(3)
 
 def sig_handler(s, f):
     print('\r\nQuitting! Thanks for playing snek.')
     curses.endwin()
     sys.exit(1)
 
+# returns False to quit
+def process_key(my_game, key):
+    if key == curses.KEY_LEFT:
+        my_game.turn_left()
+    elif key == curses.KEY_RIGHT:
+        my_game.turn_right()
+    elif key == curses.KEY_UP:
+        my_game.turn_up()
+    elif key == curses.KEY_DOWN:
+        my_game.turn_down()
+    elif key == ord('h'):
+        my_game.show_msg = not my_game.show_msg
+        my_game.sidebar_dirty = True
+        my_game.messagebar_dirty = True
+        my_game.dirty = True
+        my_game.wipe = True
+    elif key == ord(' '):
+        my_game.show_msg = False
+        my_game.sidebar_dirty = True
+        my_game.messagebar_dirty = True
+        my_game.dirty = True
+        my_game.wipe = True
+        if not my_game.join_sent:
+            my_game.send_join()
+            my_game.join_sent = True
+    elif key == ord('q'):
+        return False
+    return True
+
+# process one message from the server
+def handle_msg(my_game, msg_type, msg):
+    if msg_type == MSG_TYPE_JOIN:
+        snek_id, width, height = unpack_join(msg, my_game.version)
+        # spectators are told they're watching instead of which snek is theirs
+        if snek_id == SPECTATE_V2:
+            my_game.spectating = True
+        else:
+            my_game.my_snek.snek_id = snek_id
+        rejected = snek_id == (JOIN_REJECT if my_game.version == PROTOCOL_V1 else JOIN_REJECT_V2)
+        # v2 also says how big the board is
+        if width and not rejected:
+            my_game.resize_board(width, height)
+        my_game.dirty = True
+        my_game.wipe = True
+
+        # server told us it was full of sneks
+        if rejected:
+            my_game.my_renderer.shutdown()
+            print('Server full of sneks.' if my_game.spectate is None else 'No such arena to watch.')
+            sys.exit(1)
+    else:
+        my_game.process_msg(msg_type, msg)
+        # ticks still coming over TCP, so the server hasn't heard our hello yet
+        if my_game.udp and msg_type in (MSG_TYPE_BOARD, MSG_TYPE_UPDATE, MSG_TYPE_REGION):
+            my_game.send_udp_ack()
+
 def main():
+    parser = argparse.ArgumentParser(description='Snek client')
+    parser.add_argument('--addr', default='localhost', type=str)
+    parser.add_argument('--port', default=55555, type=int)
+    parser.add_argument('--protocol', default=PROTOCOL_V2, type=int, choices=[PROTOCOL_V1, PROTOCOL_V2])
+    parser.add_argument('--tcp-only', action='store_true', help='don\'t ask for ticks over UDP')
+    parser.add_argument('--spectate', default=None, type=int, metavar='ARENA', help='watch an arena instead of playing, from a server or a relay')
+    args = parser.parse_args()
+
+    if args.spectate is not None and args.protocol != PROTOCOL_V2:
+        parser.error('only protocol 2 can spectate')
+
     signal.signal(signal.SIGINT, sig_handler)
     connected = False
     time.sleep(2)
 
     # init the game
     my_game = game()
+    my_game.version = args.protocol
+    my_game.use_udp = not args.tcp_only
+    my_game.spectate = args.spectate
 
     # init the curses window
     try:
@@ -385,7 +658,7 @@ def main():
 
     try:
         my_game.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        my_game.sock.connect(('localhost', 55555))
+        my_game.sock.connect((args.addr, args.port))
         my_game.sock.setblocking(0)
     except:
         my_game.my_renderer.shutdown()
@@ -396,78 +669,43 @@ def main():
     print('Connected!\r')
     connected = True
 
+    reader = FrameReader(my_game.version)
+
+    # sleep until the server sends something or a key is pressed
+    sel = selectors.DefaultSelector()
+    sel.register(my_game.sock, selectors.EVENT_READ)
+    sel.register(sys.stdin, selectors.EVENT_READ)
+
     # main loop
-    key = ''
-    current_time = last_time = time.time()
-    imm_redraw = True
+    my_game.draw_game()
     while connected:
         try:
-            # get input from keyboard
-            key = my_game.my_renderer.screen.getch()
-
-            # process key
-            if key == curses.KEY_LEFT:
-                my_game.turn_left()
-            elif key == curses.KEY_RIGHT:
-                my_game.turn_right()
-            elif key == curses.KEY_UP:
-                my_game.turn_up()
-            elif key == curses.KEY_DOWN:
-                my_game.turn_down()
-            elif key == ord('h'):
-                my_game.show_msg = not my_game.show_msg
-                my_game.sidebar_dirty = True
-                my_game.messagebar_dirty = True
-                my_game.dirty = True
-                my_game.wipe = True
-            elif key == ord(' '):
-                my_game.show_msg = False
-                my_game.sidebar_dirty = True
-                my_game.messagebar_dirty = True
-                my_game.dirty = True
-                my_game.wipe = True
-                if not my_game.join_sent:
-                    my_game.sock.send(b'\xff\xff')
-                    my_game.join_sent = True
-            elif key == ord('q'):
-                break
-
-            # process socket io
-            r, w, e = select.select([my_game.sock], [], [], 0)
-            if my_game.sock in r:
-                # joined game, process messages normally
-                msg_type = my_game.sock.recv(1)[0]
-                if msg_type == MSG_TYPE_JOIN:
-                    my_game.my_snek.snek_id = my_game.sock.recv(1)[0]
-                    my_game.dirty = True
-                    my_game.wipe = True
-
-                    # server told us it was full of sneks
-                    if my_game.my_snek.snek_id == 255:
-                        my_game.my_renderer.shutdown()
-                        print('Server full of sneks.')
-                        sys.exit(1)
-
-                elif msg_type == MSG_TYPE_BOARD or msg_type == MSG_TYPE_UPDATE or msg_type == MSG_TYPE_TXT:
-                    msg_len = struct.unpack('!i', my_game.sock.recv(4))[0]
-                    msg = recv_n(my_game.sock, msg_len)
-                    my_game.process_msg(msg_type, msg)
-
-                elif msg_type == MSG_TYPE_INFO:
-                    msg = recv_n(my_game.sock, 2)
-                    my_game.process_msg(msg_type, msg)
-
-                imm_redraw = True
-
-            # draw the game
-            current_time = time.time()
-            if (current_time - last_time) > (1 / TICKS_PER_SECOND_FPS) or imm_redraw:
+            for key, mask in sel.select():
+                if key.fileobj is my_game.sock:
+                    # read what's there and process every message it completes
+                    if not reader.read_from(my_game.sock):
+                        raise Exception('Connection lost.')
+                    for msg_type, msg in reader.frames():
+                        handle_msg(my_game, msg_type, msg)
+                    if my_game.udp and my_game.udp not in sel.get_map():
+                        sel.register(my_game.udp, selectors.EVENT_READ)
+                elif key.fileobj is my_game.udp:
+                    # take every state that's waiting
+                    while True:
+                        try:
+                            my_game.process_state(my_game.udp.recv(MAX_DATAGRAM))
+                        except (BlockingIOError, ConnectionRefusedError):
+                            break
+                else:
+                    # handle every key that's waiting
+                    ch = my_game.my_renderer.screen.getch()
+                    while ch != -1 and connected:
+                        connected = process_key(my_game, ch)
+                        ch = my_game.my_renderer.screen.getch()
+
+            # draw whatever changed
+            if connected:
                 my_game.draw_game()
-                last_time = current_time
-                imm_redraw = False
-
-            # don't busy wait... despite what maixner says about you, sleep
-            time.sleep(1/TICKS_PER_SECOND_INPUT)
 
         except Exception as e:
             my_game.my_renderer.shutdown()
@@ -475,9 +713,12 @@ def main():
             print(traceback.format_exc())
             break
 
+    sel.close()
     my_game.my_renderer.shutdown()
     print('Thanks for playing Snek.')
     my_game.sock.close()
+    if my_game.udp:
+        my_game.udp.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,2 @@
+# test_server.py is a fake server to point the client at, not tests
+collect_ignore = ["test_server.py"]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Many games of snek stepped in lockstep with NumPy, for training bots.
+# The rules are SnekGame's, applied to every snek on every board at once:
+# boards are one (envs, height, width) array and each snek's body is a ring
+# of flat board indices. reset() and step() work like a gym vector env,
+# and a board whose sneks are all dead starts over by itself.
+
+import numpy
+
+from snek_pkts import *
+from snek_game import *
+
+# Movement per direction, NORTH, EAST, SOUTH, WEST
+DX = numpy.array([0, 1, 0, -1])
+DY = numpy.array([-1, 0, 1, 0])
+
+# Food goes on a random blank square, tried this many times per tick before giving up till the next one
+MAX_FOOD_TRIES = 32
+
+class SnekBatch():
+    def __init__(self, envs, width=MAX_X, height=MAX_Y, sneks=4, seed=None, max_steps=None):
+        self.envs = envs
+        self.width = width
+        self.height = height
+        self.sneks = sneks
+        self.max_steps = max_steps
+        self.rng = numpy.random.default_rng(seed)
+        size = width * height
+
+        square_type = numpy.uint8 if V1_MAX_SNEKS >= sneks else numpy.uint16
+        self.boards = numpy.zeros((envs, height, width), dtype=square_type)
+
+        # Each snek's squares, head at head_at and the tail length - 1 behind it
+        self.body = numpy.zeros((envs, sneks, size), dtype=numpy.int32)
+        self.head_at = numpy.zeros((envs, sneks), dtype=numpy.int32)
+        self.length = numpy.zeros((envs, sneks), dtype=numpy.int32)
+        self.direction = numpy.zeros((envs, sneks), dtype=numpy.int64)
+        self.alive = numpy.zeros((envs, sneks), dtype=bool)
+        self.score = numpy.zeros((envs, sneks), dtype=numpy.int32)
+        self.food_count = numpy.zeros(envs, dtype=numpy.int64)
+        self.steps = numpy.zeros(envs, dtype=numpy.int64)
+
+        self.head_values = numpy.array([snek_head_square(i) for i in range(sneks)], dtype=square_type)
+        self.body_values = self.head_values + 1
+
+        # What's in a square, by square value
+        values = numpy.arange(max(SQ_FOOD_MAX, int(self.body_values.max())) + 1)
+        self.is_snek = numpy.array([is_snek_square(v) for v in values])
+        self.is_food = numpy.array([is_food_square(v) for v in values])
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng = numpy.random.default_rng(seed)
+        self._reset_envs(numpy.arange(self.envs))
+        self._spawn_food()
+        return self.boards
+
+    # Flat board index of every snek's head, valid where alive
+    def heads(self):
+        return numpy.take_along_axis(self.body, self.head_at[:, :, None], 2)[:, :, 0]
+
+    # Advance every board one tick. Actions are an (envs, sneks) array of
+    # directions to steer in, anything else carries on straight. Returns the
+    # boards, rewards of 1 for eating and -1 for dying per snek, which boards
+    # were done and got reset, and the scores they finished with.
+    def step(self, actions=None):
+        width = self.width
+        size = width * self.height
+        boards = self.boards.reshape(self.envs, size)
+        rewards = numpy.zeros((self.envs, self.sneks), dtype=numpy.float32)
+
+        # Turning back on yourself is ignored
+        if actions is not None:
+            actions = numpy.asarray(actions)
+            turn = self.alive & (0 <= actions) & (actions < 4) & (1 == (actions + self.direction) % 2)
+            self.direction = numpy.where(turn, actions, self.direction)
+
+        env, snek = numpy.nonzero(self.alive)
+        head_at = self.head_at[env, snek]
+        heads = self.body[env, snek, head_at]
+        direction = self.direction[env, snek]
+        new_heads = (heads // width + DY[direction]) % self.height * width + (heads % width + DX[direction]) % width
+
+        # Sneks are checked against the board before anyone moves, so running
+        # into where a tail just left still counts. Heads meeting in one square die together.
+        hit = boards[env, new_heads]
+        _, meeting, heads_there = numpy.unique(env * size + new_heads, return_inverse=True, return_counts=True)
+        dying = self.is_snek[hit] | (1 < heads_there[meeting])
+        eating = self.is_food[hit] & ~dying
+
+        # The dead leave salt behind in about half of their squares
+        for e, s in zip(env[dying], snek[dying]):
+            squares = self._squares(e, s)
+            salt = self.rng.random(len(squares)) < 0.5
+            boards[e, squares] = numpy.where(salt, SQ_SALT, SQ_BLANK)
+            self.food_count[e] += salt.sum()
+            self.alive[e, s] = False
+        rewards[env[dying], snek[dying]] = -1
+
+        # The rest move. Eating keeps the tail where it was, so the snek grows into it.
+        live = ~dying
+        env, snek, heads, new_heads, head_at, eating = env[live], snek[live], heads[live], new_heads[live], head_at[live], eating[live]
+        length = self.length[env, snek]
+        tails = self.body[env, snek, (head_at - length + 1) % size]
+        boards[env[~eating], tails[~eating]] = SQ_BLANK
+        neck = (1 < length) | eating
+        boards[env[neck], heads[neck]] = self.body_values[snek[neck]]
+        boards[env, new_heads] = self.head_values[snek]
+
+        head_at = (head_at + 1) % size
+        self.head_at[env, snek] = head_at
+        self.body[env, snek, head_at] = new_heads
+        self.length[env, snek] = length + eating
+        self.score[env, snek] += eating
+        self.food_count -= numpy.bincount(env[eating], minlength=self.envs)
+        rewards[env[eating], snek[eating]] = 1
+
+        self.steps += 1
+        dones = ~self.alive.any(1)
+        if self.max_steps:
+            dones |= self.max_steps <= self.steps
+        scores = self.score.copy()
+        if dones.any():
+            self._reset_envs(numpy.flatnonzero(dones))
+        self._spawn_food()
+
+        return self.boards, rewards, dones, {'scores': scores}
+
+    # A snek's squares from its head back to its tail
+    def _squares(self, env, snek):
+        size = self.width * self.height
+        return self.body[env, snek, (self.head_at[env, snek] - numpy.arange(self.length[env, snek])) % size]
+
+    # Clear boards and spawn their sneks away from the edges like SnekGame does, each heading somewhere random
+    def _reset_envs(self, envs):
+        self.boards[envs] = SQ_BLANK
+        self.head_at[envs] = 0
+        self.length[envs] = 1
+        self.alive[envs] = True
+        self.score[envs] = 0
+        self.food_count[envs] = 0
+        self.steps[envs] = 0
+        self.direction[envs] = self.rng.integers(0, 4, (len(envs), self.sneks))
+
+        edge_x = min(SPAWN_FROM_EDGE, (self.width - 1) // 2)
+        edge_y = min(SPAWN_FROM_EDGE, (self.height - 1) // 2)
+        if (self.width - 2 * edge_x) * (self.height - 2 * edge_y) < self.sneks:
+            edge_x = edge_y = 0
+        spawn_w = self.width - 2 * edge_x
+        spawn_h = self.height - 2 * edge_y
+        boards = self.boards.reshape(self.envs, -1)
+        for e in envs:
+            spots = self.rng.choice(spawn_w * spawn_h, self.sneks, replace=False)
+            squares = (spots // spawn_w + edge_y) * self.width + spots % spawn_w + edge_x
+            self.body[e, :, 0] = squares
+            boards[e, squares] = self.head_values
+
+    # Top every board up to its food minimum, a square at a time across all boards
+    def _spawn_food(self):
+        size = self.width * self.height
+        boards = self.boards.reshape(self.envs, size)
+        min_food = numpy.maximum(self.alive.sum(1) * FOOD_MULTIPLIER, STARTING_MIN_FOOD)
+        needed = min_food - self.food_count
+        for i in range(MAX_FOOD_TRIES):
+            envs = numpy.flatnonzero(0 < needed)
+            if not len(envs):
+                break
+            squares = self.rng.integers(0, size, len(envs))
+            blank = SQ_BLANK == boards[envs, squares]
+            envs = envs[blank]
+            squares = squares[blank]
+            boards[envs, squares] = self.rng.choice(FOODS, len(envs), p=FOOD_WEIGHTS)
+            self.food_count[envs] += 1
+            needed[envs] -= 1
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the game engine, the packet codec and the client decoder.
+# Every scenario is built from fixed seeds with scripted sneks, so two runs
+# on the same tree do the same work. Results are written out as JSON and
+# can be compared against an earlier run with --compare.
+
+import asyncio
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+from collections import deque
+from time import perf_counter
+import numpy
+
+from snek_pkts import *
+from snek_game import *
+from snek_server import SnekLobby, SnekProtocol
+from snek_batch import SnekBatch
+import client
+
+SEED = 1234
+
+# Stands in for a socket, remembering nothing
+class NullTransport():
+    def __init__(self, n):
+        self.peername = ('bench', n)
+        self.closing = False
+
+    def get_extra_info(self, name):
+        return self.peername
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+    def abort(self):
+        self.closing = True
+
+def seed(n=SEED):
+    random.seed(n)
+    numpy.random.seed(n)
+
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+# An arena with clients joined through the real protocol, sneks wherever they spawned
+def make_arena(sneks=0, width=MAX_X, height=MAX_Y, max_sneks=MAX_SNEKS, version=PROTOCOL_V1, encodings=0):
+    seed()
+    with quiet():
+        lobby = SnekLobby(1, width, height, max_sneks, seed=SEED)
+        clients = [connect(lobby, n) for n in range(sneks)]
+        for protocol in clients:
+            protocol.data_received(join_request(version, encodings))
+    arena = lobby.arenas[0]
+    arena.close()
+    return lobby, arena, clients
+
+def connect(lobby, n):
+    protocol = SnekProtocol(lobby)
+    protocol.connection_made(NullTransport(n))
+    return protocol
+
+def join_request(version, encodings=0):
+    if PROTOCOL_V1 == version:
+        return JOIN_REQUEST
+    return CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, encodings)
+
+# Move a snek to (x, y) heading in direction, its body trailing behind
+def lay_snek(game, snek, x, y, direction, length):
+    for block in snek.blocks:
+        if game.board[block[2], block[1]] in (snek.head_value, snek.body_value):
+            game._set_square(block[1], block[2], SQ_BLANK)
+    snek.direction = snek.last_direction = direction
+    snek.blocks = deque([(snek.head_value, x, y, direction)])
+    snek._append_null_tail()
+    for i in range(length - 1):
+        snek.eat()
+    snek.score = 0
+    for block in snek.blocks:
+        if SQ_BLANK != block[0]:
+            game._set_square(block[1], block[2], block[0])
+    game._cache_board()
+
+def close(lobby):
+    for arena in lobby.arenas.values():
+        arena.close()
+
+def measure(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        started = perf_counter()
+        fn()
+        times.append(perf_counter() - started)
+    return times
+
+def summarize(times):
+    times = numpy.asarray(times) * 1e6
+    return {
+        'n': len(times),
+        'min_us': round(float(times.min()), 3),
+        'median_us': round(float(numpy.median(times)), 3),
+        'mean_us': round(float(times.mean()), 3),
+        'p90_us': round(float(numpy.percentile(times, 90)), 3),
+    }
+
+# Run the arena for a number of ticks, timing each part by itself
+def run_ticks(arena, ticks, results, name):
+    slither, cache, broadcast, updates = [], [], [], []
+    with quiet():
+        for i in range(ticks):
+            started = perf_counter()
+            arena.game._slither_the_sneks()
+            slithered = perf_counter()
+            squares = arena.game._cache_board()
+            cached = perf_counter()
+            arena.broadcast_update(squares)
+            slither.append(slithered - started)
+            cache.append(cached - slithered)
+            broadcast.append(perf_counter() - cached)
+            updates.append(squares)
+    results[name + '/_slither_the_sneks'] = slither
+    results[name + '/_cache_board'] = cache
+    results[name + '/broadcast_update'] = broadcast
+    return updates
+
+# Time the codec on an arena's board and a tick's worth of changes
+def bench_codec(arena, squares, results, name, repeat):
+    sneks = list(arena.sneks.values())
+    versions = [(PROTOCOL_V2, 0, 'v2'), (PROTOCOL_V2, ACCEPT_ALL, 'v2_encoded')]
+    if arena.speaks(PROTOCOL_V1):
+        versions.insert(0, (PROTOCOL_V1, 0, 'v1'))
+    for version, encodings, label in versions:
+        results[name + '/msg_board_' + label] = measure(lambda: msg_board(arena.board, sneks, version, encodings), repeat)
+        results[name + '/msg_update_' + label] = measure(lambda: msg_update(arena.board, squares, sneks, version, encodings), repeat)
+
+# Time the client taking a keyframe and the updates after it
+def bench_client(arena, updates, results, name, repeat):
+    sneks = list(arena.sneks.values())
+    game = client.game()
+    for version, encodings, label in ((PROTOCOL_V1, 0, 'v1'), (PROTOCOL_V2, ACCEPT_ALL, 'v2')):
+        if not arena.speaks(version):
+            continue
+        game.version = version
+        game.resize_board(arena.width, arena.height)
+        board = msg_board(arena.board, sneks, version, encodings)[HEADER.size:]
+        frames = [msg_update(arena.board, squares, sneks, version, encodings)[HEADER.size:] for squares in updates]
+        results[name + '/process_msg_board_' + label] = measure(lambda: game.process_msg(MSG_TYPE_BOARD, board), repeat)
+        replay = iter(frames * repeat)
+        results[name + '/process_msg_update_' + label] = measure(lambda: game.process_msg(MSG_TYPE_UPDATE, next(replay)), len(frames) * repeat)
+
+def bench_spawn_food(game, results, name, repeat):
+    board = game.board.copy()
+    food_count = game.food_count
+    def setup():
+        game.board[:] = board
+        game._index_free()
+        game.food_count = 0
+        game.dirty.clear()
+    results[name + '/_spawn_food'] = measure(game._spawn_food, repeat, setup)
+    setup()
+    game.food_count = food_count
+
+# The scenarios
+
+def scenario_empty_board(results, repeat):
+    lobby, arena, clients = make_arena()
+    updates = run_ticks(arena, repeat, results, 'empty_board')
+    bench_spawn_food(arena.game, results, 'empty_board', repeat)
+    bench_codec(arena, updates[-1], results, 'empty_board', repeat)
+    bench_client(arena, updates[-10:], results, 'empty_board', max(1, repeat // 10))
+    close(lobby)
+
+# 16 sneks 60 long, one to a row and all heading east, so they never meet
+def scenario_long_sneks(results, repeat):
+    lobby, arena, clients = make_arena(16)
+    for i, protocol in enumerate(clients):
+        lay_snek(arena.game, protocol.snek, 70, 2 + i * 2, EAST, 60)
+
+    # A snek of its own, off the board, to slither by itself
+    snek = Snek(0, 40, 20, EAST)
+    lay_snek(SnekGame(), snek, 40, 20, EAST, 60)
+    results['long_sneks/Snek.slither'] = measure(snek.slither, repeat * 10)
+
+    updates = run_ticks(arena, repeat, results, 'long_sneks')
+    bench_spawn_food(arena.game, results, 'long_sneks', repeat)
+    bench_codec(arena, updates[-1], results, 'long_sneks', repeat)
+    bench_client(arena, updates[-10:], results, 'long_sneks', max(1, repeat // 10))
+    close(lobby)
+
+# 8 pairs of sneks meeting head on, so the whole arena dies in one tick
+def scenario_mass_death(results, repeat):
+    state = {}
+    def setup():
+        if 'lobby' in state:
+            close(state['lobby'])
+        lobby, arena, clients = make_arena(16)
+        for i, protocol in enumerate(clients):
+            y = 2 + i // 2 * 4
+            if i % 2:
+                lay_snek(arena.game, protocol.snek, 42, y, WEST, 20)
+            else:
+                lay_snek(arena.game, protocol.snek, 40, y, EAST, 20)
+        state['lobby'] = lobby
+        state['arena'] = arena
+    def tick():
+        with quiet():
+            state['arena']._tick()
+    results['mass_death/_tick'] = measure(tick, repeat, setup)
+    assert not state['arena'].sneks
+    close(state['lobby'])
+
+# Hundreds of v2 clients joining a big arena at once
+def scenario_join_storm(results, repeat):
+    joins = []
+    storms = []
+    for i in range(max(1, repeat // 20)):
+        lobby, arena, clients = make_arena(0, 1000, 600, 300, PROTOCOL_V2)
+        with quiet():
+            storm = [connect(lobby, n) for n in range(300)]
+            request = join_request(PROTOCOL_V2, ACCEPT_ALL)
+            started = perf_counter()
+            for protocol in storm:
+                joined = perf_counter()
+                protocol.data_received(request)
+                joins.append(perf_counter() - joined)
+            storms.append(perf_counter() - started)
+        close(lobby)
+    results['join_storm/join'] = joins
+    results['join_storm/storm'] = storms
+
+# A game with no server, 16 sneks steering at random and respawning when they die
+def scenario_offline(results, repeat):
+    game = SnekGame(seed=SEED)
+    rng = random.Random(SEED)
+    for i in range(16):
+        game.spawn_snek()
+    def inputs():
+        while not game.is_full():
+            game.spawn_snek()
+        return [(snek_id, rng.randint(0, 3)) for snek_id in game.sneks if rng.random() < 0.2]
+    results['offline/step'] = measure(lambda: game.step(inputs()), repeat * 10)
+    results['offline/advance'] = measure(lambda: game.advance(inputs()), repeat * 10)
+
+# 256 boards of 4 sneks stepped together, steering at random
+def scenario_batch(results, repeat):
+    batch = SnekBatch(256, sneks=4, seed=SEED)
+    batch.reset()
+    rng = numpy.random.default_rng(SEED)
+    actions = rng.integers(-1, 4, (repeat, 256, 4))
+    steps = iter(actions)
+    results['batch/step_256x4'] = measure(lambda: batch.step(next(steps)), repeat)
+
+SCENARIOS = {
+    'empty_board': scenario_empty_board,
+    'long_sneks': scenario_long_sneks,
+    'mass_death': scenario_mass_death,
+    'join_storm': scenario_join_storm,
+    'offline': scenario_offline,
+    'batch': scenario_batch,
+}
+
+async def run(args):
+    results = dict()
+    for name, scenario in SCENARIOS.items():
+        if args.scenario and name not in args.scenario:
+            continue
+        scenario(results, args.repeat)
+    return {name: summarize(times) for name, times in results.items()}
+
+def report(results, baseline):
+    for name, result in sorted(results.items()):
+        line = '{:<42} median {:>12.2f}us  min {:>12.2f}us  n {:>6}'.format(name, result['median_us'], result['min_us'], result['n'])
+        if baseline and name in baseline:
+            line += '  x{:.2f}'.format(result['median_us'] / baseline[name]['median_us'])
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snek benchmarks")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", default=200, type=int)
+    parser.add_argument("--output", default="bench_output.json", type=str)
+    parser.add_argument("--compare", default=None, type=str, help="earlier output to compare medians with")
+    parser.add_argument("--label", default="", type=str)
+    args = parser.parse_args()
+
+    # The arenas want an event loop to schedule their ticks on, they never get to run
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'label': args.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'seed': SEED,
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
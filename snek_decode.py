@@ -0,0 +1,161 @@
+# The receiving end of snek_pkts. A FrameReader takes the stream from the
+# server in big chunks and hands back every complete message in them, and
+# the decoders turn payloads into NumPy arrays that go into a board in one
+# write rather than a square at a time.
+
+import struct
+import zlib
+import numpy
+
+from snek_pkts import *
+
+# Bytes asked of the socket per read, at least
+READ_SIZE = 1 << 16
+
+# Length of the body after the type byte, for the messages that have no header
+JOIN_BODY = {PROTOCOL_V1: JOIN.size - 1, PROTOCOL_V2: JOIN_2.size - 1}
+INFO_BODY = {PROTOCOL_V1: INFO.size - 1, PROTOCOL_V2: INFO_2.size - 1}
+
+# The layout of a body after the type byte, from the message's layout in snek_pkts
+def body_layout(layout):
+    return struct.Struct(layout.format[:1] + layout.format[2:])
+
+JOIN_2_BODY   = body_layout(JOIN_2)
+UDP_INFO_BODY = body_layout(UDP_INFO)
+
+# Messages that start with a HEADER
+FRAMED = (MSG_TYPE_BOARD, MSG_TYPE_UPDATE, MSG_TYPE_TXT, MSG_TYPE_REGION, MSG_TYPE_STATE)
+
+class FrameReader():
+    def __init__(self, version=PROTOCOL_V1):
+        self.version = version
+        self.buf = bytearray(READ_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+        # Size of the message at start once it's known, so a big one is read in as few calls as possible
+        self.wanted = 0
+
+    # Read whatever the socket has. Returns False once it's closed.
+    def read_from(self, sock):
+        self._reserve(max(READ_SIZE, self.wanted - (self.end - self.start)))
+        try:
+            received = sock.recv_into(self.view[self.end:])
+        except BlockingIOError:
+            return True
+        self.end += received
+        return 0 < received
+
+    # For when something else did the reading
+    def feed(self, data):
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Every complete message buffered, as (message type, body). The body
+    # follows the type byte, or the header for messages that have one, and
+    # is a view into the buffer that's only good until the next read.
+    def frames(self):
+        view = self.view
+        while self.start < self.end:
+            available = self.end - self.start
+            msg_type = view[self.start]
+            if MSG_TYPE_JOIN == msg_type:
+                skip, size = 1, 1 + JOIN_BODY[self.version]
+            elif MSG_TYPE_INFO == msg_type:
+                skip, size = 1, 1 + INFO_BODY[self.version]
+            elif MSG_TYPE_ACK == msg_type:
+                skip, size = 1, ACK.size
+            elif MSG_TYPE_UDP == msg_type:
+                skip, size = 1, UDP_INFO.size
+            elif msg_type in FRAMED:
+                if HEADER.size > available:
+                    break
+                skip, size = HEADER.size, HEADER.size + HEADER.unpack_from(view, self.start)[1]
+            else:
+                raise ValueError('Unknown message type {}'.format(msg_type))
+
+            if size > available:
+                self.wanted = size
+                break
+            self.wanted = 0
+            self.start += size
+            yield msg_type, view[self.start - size + skip:self.start]
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    # Make room for size more bytes. What's left of a message moves to the
+    # front, or into a bigger buffer. Bodies handed out before keep pointing
+    # at the old one, which is never resized under them.
+    def _reserve(self, size):
+        if len(self.buf) - self.end >= size:
+            return
+        pending = bytes(self.view[self.start:self.end])
+        if len(self.buf) < len(pending) + size:
+            self.buf = bytearray(max(2 * len(self.buf), len(pending) + size))
+            self.view = memoryview(self.buf)
+        self.view[:len(pending)] = pending
+        self.start = 0
+        self.end = len(pending)
+
+# (snek id, board width, board height) from a join, v1 joins don't say how big the board is
+def unpack_join(body, version):
+    if PROTOCOL_V1 == version:
+        return body[0], None, None
+    return JOIN_2_BODY.unpack(body)
+
+# (info type, snek id) from an info message
+def unpack_info(body, version):
+    return body[0], int.from_bytes(body[1:], 'big')
+
+# (token, port) for the UDP state channel
+def unpack_udp(body):
+    return UDP_INFO_BODY.unpack(body)
+
+# The (snek id, score, health) of each snek in a board, region or update
+# message, and the payload that follows them
+def split_frame(body, version):
+    count, snek_data, square = LAYOUTS[version]
+    sneks_len = count.unpack_from(body)[0] * snek_data.size
+    sneks = snek_data.iter_unpack(body[count.size:count.size + sneks_len])
+    return sneks, body[count.size + sneks_len:]
+
+# The squares of a board or region, in order
+def decode_squares(encoding, data, square=SQUARE_V2):
+    if ENC_RLE == encoding:
+        runs = numpy.frombuffer(data, dtype=SQUARE_V2).reshape(-1, 2)
+        return numpy.repeat(runs[:, 1], runs[:, 0])
+    if ENC_ZLIB == encoding:
+        return numpy.frombuffer(zlib.decompress(data), dtype=SQUARE_V2)
+    return numpy.frombuffer(data, dtype=square)
+
+# (xs, ys, squares) of an update. The area is what a bitmap covers, the
+# whole board or the region last sent.
+def decode_changes(encoding, data, area, width, height, square=SQUARE_V2):
+    if ENC_RUNS == encoding:
+        shorts = numpy.frombuffer(data, dtype=SQUARE_V2)
+
+        # Only the run headers need walking, the squares in them are found all at once
+        headers = []
+        at = 0
+        while at < len(shorts):
+            headers.append(at)
+            at += 3 + int(shorts[at + 2])
+        headers = numpy.array(headers, dtype=numpy.intp)
+        counts = shorts[headers + 2].astype(numpy.intp)
+        run_of = numpy.repeat(numpy.arange(len(headers)), counts)
+        along = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        xs = (shorts[headers][run_of] + along) % width
+        return xs, shorts[headers + 1][run_of], shorts[headers[run_of] + 3 + along]
+
+    if ENC_BITMAP == encoding:
+        x, y, area_w, area_h = area
+        bitmap_len = (area_w * area_h + 7) // 8
+        at = numpy.flatnonzero(numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8, count=bitmap_len), count=area_w * area_h))
+        values = numpy.frombuffer(data, dtype=SQUARE_V2, offset=bitmap_len)
+        return (x + at % area_w) % width, (y + at // area_w) % height, values
+
+    changes = numpy.frombuffer(data, dtype=square).reshape(-1, 3)
+    return changes[:, 0], changes[:, 1], changes[:, 2]
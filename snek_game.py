@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+# The rules of snek, with no networking. A SnekGame is one arena's state:
+# the board, its sneks and a seeded RNG, so the same seed and the same
+# inputs always play out the same way. step() runs a tick and returns what
+# changed, and the server only has to tell the clients about it. Without
+# the server, games can be stepped as fast as they'll go.
+
+import random
+from collections import deque
+from time import perf_counter
+import numpy
+
+from snek_pkts import *
+
+# Square types
+SQ_SALT        = 33
+SQ_CRACKER     = 34
+SQ_TABASCO     = 35
+SQ_SNACK_BREAD = 36
+SQ_OMLET       = 37
+SQ_WATER       = 38
+
+FOODS = [SQ_SALT, SQ_CRACKER, SQ_TABASCO, SQ_SNACK_BREAD, SQ_OMLET, SQ_WATER]
+FOOD_WEIGHTS = [0.5, 0.15, 0.05, 0.15, 0.05, 0.1]
+
+# Limits
+STARTING_MIN_FOOD = 4
+FOOD_MULTIPLIER   = 2
+MAX_SNEKS         = 16
+MAX_X             = 80
+MAX_Y             = 40
+SPAWN_FROM_EDGE   = 15
+
+# Free squares sampled per spawn, the one furthest from every head wins
+SPAWN_CANDIDATES = 16
+
+# Food types are drawn this many at a time
+FOOD_DRAWS = 256
+
+# Causes of death
+DISCONNECT = 0
+OTHER      = 1
+
+# Direction to advance
+FORWARD  = 0
+BACKWARD = 1
+
+class Snek():
+    __slots__ = ('snek_id', 'head_value', 'body_value', 'direction', 'last_direction', 'blocks',
+                 'score', 'hydration', 'salt', 'tabasco', 'poisoned', 'width', 'height')
+
+    def __init__(self, snek_id, x, y, direction, width=MAX_X, height=MAX_Y):
+        self.snek_id = snek_id
+        self.head_value = snek_head_square(snek_id)
+        self.body_value = self.head_value+1
+        self.width = width
+        self.height = height
+        self.direction = direction
+
+        # Cache the direction from the begining of the move to ignore turning back on self
+        self.last_direction = direction
+
+        # [block type (head, body), x, y, direction]
+        # A deque gives constant time pushes at the head and pops at the tail.
+        self.blocks = deque([(self.head_value, x, y, direction)])
+        self._append_null_tail()
+
+        self.score = 0
+        self.hydration = 50
+        self.salt = 50
+        self.tabasco = False
+        self.poisoned = False
+
+    def poison(self):
+        self.poisoned = True
+
+    def unpoison(self):
+        self.poisoned = False
+
+    def armor(self):
+        self.tabasco = True
+
+    def unarmor(self):
+        self.tabasco = False
+
+    def hydrate(self, camelbaks):
+        self.hydration += camelbaks
+
+    def dehydrate(self, camelbaks):
+        self.hydration -= camelbaks
+    
+    def slither(self):
+        if not self.blocks:
+            return []
+
+        old_head = self.blocks[0]
+
+        # New head
+        x = old_head[1]
+        y = old_head[2]
+
+        new_x, new_y = self._advance_block(x, y, self.direction, FORWARD)
+
+        new_head = (self.head_value, new_x, new_y, self.direction)
+
+        # Drop the old null tail, and the last real block becomes the new null tail
+        self.blocks.pop()
+        tail = self.blocks.pop()
+        new_null_tail = (SQ_BLANK, tail[1], tail[2], tail[3])
+
+        # The old head becomes the neck, unless it was the tail that just moved
+        changes = [new_head]
+        if self.blocks:
+            new_neck = (self.body_value, old_head[1], old_head[2], old_head[3])
+            self.blocks[0] = new_neck
+            changes.append(new_neck)
+
+        self.blocks.appendleft(new_head)
+        self.blocks.append(new_null_tail)
+
+        self.last_direction = self.direction
+
+        # Return the changes
+        return changes
+
+    def change_direction(self, direction):
+        # Ignore turning back on self
+        if 0 != (direction + self.last_direction) % 2:
+            self.direction = direction
+
+    def die(self):
+        self.blocks = None
+
+    def eat(self):
+        self.score += 1
+        terminal_block = self.blocks[-1]
+        if SQ_BLANK != terminal_block[0]:
+            self._append_null_tail()
+            terminal_block = self.blocks[-1]
+
+        x = terminal_block[1]
+        y = terminal_block[2]
+        direction = terminal_block[3]
+
+        self.blocks.pop()
+        self.blocks.append((self.body_value, x, y, direction))
+        self._append_null_tail()
+
+    def _advance_block(self, x, y, direction, mode):
+        if BACKWARD == mode:
+            direction ^= 2
+        return step_square(x, y, direction, self.width, self.height)
+
+    # The null block at the end of a snek.blocks serves as a placeholder for growth
+    def _append_null_tail(self):
+        terminal_block = self.blocks[-1]
+        # Null block already exists
+        if SQ_BLANK == terminal_block[0]:
+            return
+
+        # Position null block based on direction of terminal block
+        direction = terminal_block[3]
+        x = terminal_block[1]
+        y = terminal_block[2]
+
+        x, y = self._advance_block(x, y, direction, BACKWARD)
+
+        self.blocks.append((SQ_BLANK, x, y, direction))
+
+class SnekGame():
+    def __init__(self, width=MAX_X, height=MAX_Y, max_sneks=MAX_SNEKS, seed=None):
+        self.width = width
+        self.height = height
+        self.max_sneks = max_sneks
+        self.sneks = dict()
+        self.available_snek_ids = [i for i in range(max_sneks-1, -1, -1)]
+        self.food_count = 0
+        self.rng = random.Random(seed)
+
+        # Squares only need 16 bits once there are sneks past the v1 limit
+        square_type = numpy.uint8 if V1_MAX_SNEKS >= max_sneks else numpy.uint16
+        self.board = numpy.zeros((height, width), dtype=square_type)
+        self.last_board = self.board.copy()
+
+        # Every board write lands in here, so changes never need to scan the board
+        self.dirty = set()
+
+        # Squares written between ticks, by spawns and disconnects. A keyframe
+        # sent then shows them, so they go out with the next tick even if it
+        # puts them back the way they were.
+        self.dirty_between = set()
+
+        # Every blank square, in no order, and where each one is in that list
+        # or -1. Writes keep both up to date, so a random free square is
+        # always one draw away however crowded the board gets.
+        self.free = list(range(width * height))
+        self.free_at = list(range(width * height))
+
+        # Food types still to be handed out, drawn in bulk
+        self.food_draws = []
+
+        # Histograms by phase, if someone wants the phases of a tick timed
+        self.phase_times = None
+
+    def is_full(self):
+        return 0 == len(self.available_snek_ids)
+
+    # Spawn on a free square away from the edges and as far from the other
+    # heads as the candidates allow. Returns None if the board has no room.
+    def spawn_snek(self, spread=True):
+        square = self._spawn_square(SPAWN_CANDIDATES if spread else 1)
+        if square is None:
+            return None
+
+        snek_id = self.available_snek_ids.pop()
+        x = square % self.width
+        y = square // self.width
+        snek = Snek(snek_id, x, y, self.rng.randint(0, 3), self.width, self.height)
+        self.sneks[snek_id] = snek
+
+        # The head is on the board right away, so nothing else lands on it before the next tick
+        self._set_square(x, y, snek.head_value)
+        return snek
+
+    def _spawn_square(self, candidates):
+        free = self.free
+        if not free:
+            return None
+
+        edge_x = min(SPAWN_FROM_EDGE, (self.width - 1) // 2)
+        edge_y = min(SPAWN_FROM_EDGE, (self.height - 1) // 2)
+        squares = numpy.array([free[self.rng.randrange(len(free))] for i in range(candidates)])
+        xs = squares % self.width
+        ys = squares // self.width
+
+        # Prefer squares away from the edges, if any were drawn
+        inside = (edge_x <= xs) & (xs < self.width - edge_x) & (edge_y <= ys) & (ys < self.height - edge_y)
+        if inside.any():
+            squares, xs, ys = squares[inside], xs[inside], ys[inside]
+
+        heads = [snek.blocks[0] for snek in self.sneks.values()]
+        if 1 == len(squares) or not heads:
+            return int(squares[0])
+
+        # Distance on a board that wraps around, to the nearest head
+        head_xs = numpy.array([head[1] for head in heads])
+        head_ys = numpy.array([head[2] for head in heads])
+        dx = numpy.abs(xs[:, None] - head_xs)
+        dy = numpy.abs(ys[:, None] - head_ys)
+        distance = numpy.minimum(dx, self.width - dx) + numpy.minimum(dy, self.height - dy)
+        return int(squares[distance.min(1).argmax()])
+
+    def steer(self, snek_id, direction):
+        snek = self.sneks.get(snek_id)
+        if snek:
+            snek.change_direction(direction)
+
+    # Advance the game one tick. Inputs are (snek id, direction) pairs to
+    # steer with first. Returns the flat indices of the squares that changed
+    # since the last step, in row major order, and the sneks that died.
+    def step(self, inputs=()):
+        killed = self.advance(inputs)
+        started = perf_counter()
+        squares = self._cache_board()
+        self._timed('cache', started)
+        return squares, killed
+
+    # A step without working out what changed, for running through ticks
+    # nobody watches. The next step() still returns everything that changed.
+    def advance(self, inputs=()):
+        self.dirty_between.update(self.dirty)
+        for snek_id, direction in inputs:
+            self.steer(snek_id, direction)
+        return self._slither_the_sneks()
+
+    def fast_forward(self, ticks, policy=None):
+        killed = []
+        for i in range(ticks):
+            killed += self.advance(policy(self) if policy else ())
+        return killed
+
+    # Record the time since the last phase ended, returns when this one did
+    def _timed(self, phase, since):
+        now = perf_counter()
+        if self.phase_times:
+            self.phase_times[phase].observe(now - since)
+        return now
+
+    def _slither_the_sneks(self):
+        started = perf_counter()
+        diffs = list()
+        sneks_to_kill = list()
+        sneks_to_feed = list()
+
+        # Advance the sneks!
+        for snek in self.sneks.values():
+            diffs += snek.slither()
+
+        # Index this tick's changes by square so each head finds its conflicts directly
+        occupants = dict()
+        for diff in diffs:
+            occupants.setdefault((diff[1], diff[2]), []).append(diff)
+
+        # Process the changes
+        for diff in diffs:
+            # If the diff is a head block
+            if is_head_square(diff[0]):
+                snek_id = square_snek_id(diff[0])
+                new_x = diff[1]
+                new_y = diff[2]
+
+                # Border
+                #if new_x < 0 or new_x >= MAX_X or new_y < 0 or new_y >= MAX_Y:
+                #    sneks_to_kill.append(self.sneks[snek_id])
+                #    continue
+
+                # Detect other types of conflicts
+                conflicts = [d for d in occupants[(new_x, new_y)] if d != diff]
+                if 0 == len(conflicts):
+                    conflicts.append((self.board[new_y, new_x], new_x, new_y, 0))
+
+                # The only conflict is a blank square. Do nothing exciting.
+                if 1 == len(conflicts) and SQ_BLANK == conflicts[0][0]:
+                    continue
+
+                for conflict in conflicts:
+                    square_type = conflict[0]
+                    # Head hit body square or head square
+                    if is_snek_square(square_type):
+                        sneks_to_kill.append(self.sneks[snek_id])
+                        continue
+                    # Head hit food square
+                    elif is_food_square(square_type):
+                        sneks_to_feed.append(self.sneks[snek_id])
+
+        # A snek can run into more than one thing at once, but only dies once
+        sneks_to_kill = list(dict.fromkeys(sneks_to_kill))
+        killed = set(sneks_to_kill)
+        sneks_to_feed = [s for s in sneks_to_feed if s not in killed] # snek
+
+        for snek in sneks_to_kill:
+            self.kill_snek(snek, OTHER)
+        now = self._timed('slither', started)
+
+        self._commit_sneks()
+
+        for snek in sneks_to_feed:
+            self._feed_snek(snek)
+        now = self._timed('commit', now)
+
+        self._spawn_food()
+        self._timed('spawn_food', now)
+
+        return [snek.snek_id for snek in sneks_to_kill]
+
+    # Only the ends of a snek move in a tick: the new head, the neck and
+    # the null tail left where the tail used to be.
+    def _commit_sneks(self):
+        for snek in self.sneks.values():
+            blocks = snek.blocks
+            for block in (blocks[0], blocks[1], blocks[-1]):
+                self._set_square(block[1], block[2], block[0])
+
+    def _set_square(self, x, y, value):
+        square = y * self.width + x
+        self.board[y, x] = value
+        self.dirty.add(square)
+
+        # Keep the free squares in step, swapping the last one into a taken square's place
+        at = self.free_at[square]
+        if SQ_BLANK == value:
+            if 0 > at:
+                self.free_at[square] = len(self.free)
+                self.free.append(square)
+        elif 0 <= at:
+            last = self.free.pop()
+            if last != square:
+                self.free[at] = last
+                self.free_at[last] = at
+            self.free_at[square] = -1
+
+    # Rebuild the free squares from the board, for when it was written to directly
+    def _index_free(self):
+        self.free = numpy.flatnonzero(SQ_BLANK == self.board.reshape(-1)).tolist()
+        self.free_at = [-1] * (self.width * self.height)
+        for at, square in enumerate(self.free):
+            self.free_at[square] = at
+
+    def kill_snek(self, snek, cause_of_death):
+        for block in snek.blocks:
+            if (SQ_BLANK != block[0] and DISCONNECT == cause_of_death) or (snek.head_value != block[0] and DISCONNECT != cause_of_death):
+                x = block[1]
+                y = block[2]
+                if self.rng.randint(0, 1):
+                    self._set_square(x, y, SQ_SALT)
+                    self.food_count += 1
+                else:
+                    self._set_square(x, y, SQ_BLANK)
+        self.available_snek_ids.insert(0, snek.snek_id)
+        snek.die()
+        self.sneks.pop(snek.snek_id)
+
+    # The snek grows into the square its tail just left. The new null tail
+    # behind it is only a placeholder, so the board isn't touched there.
+    def _feed_snek(self, snek):
+        snek.eat()
+        tail = snek.blocks[-2]
+        self._set_square(tail[1], tail[2], tail[0])
+        self.food_count -= 1
+
+    # Food goes on random free squares until there's enough, or there's no room left
+    def _spawn_food(self):
+        min_food = max(len(self.sneks) * FOOD_MULTIPLIER, STARTING_MIN_FOOD)
+        free = self.free
+        while min_food > self.food_count and free:
+            if not self.food_draws:
+                self.food_draws = self.rng.choices(FOODS, FOOD_WEIGHTS, k=FOOD_DRAWS)
+            square = free[self.rng.randrange(len(free))]
+            self._set_square(square % self.width, square // self.width, self.food_draws.pop())
+            self.food_count += 1
+
+    # Caching the board as last sent to the clients enables sending
+    # board updates to clients rather than the entire board. Only the
+    # squares written since the last tick are compared and copied, and
+    # the ones that really changed are returned in row major order, along
+    # with every square written between ticks.
+    def _cache_board(self):
+        squares = numpy.fromiter(self.dirty, dtype=numpy.intp, count=len(self.dirty))
+        squares.sort()
+        self.dirty.clear()
+
+        board = self.board.reshape(-1)
+        last_board = self.last_board.reshape(-1)
+        changed = board[squares] != last_board[squares]
+        if self.dirty_between:
+            changed |= numpy.isin(squares, numpy.fromiter(self.dirty_between, dtype=numpy.intp, count=len(self.dirty_between)))
+            self.dirty_between.clear()
+        squares = squares[changed]
+        last_board[squares] = board[squares]
+        return squares
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Server metrics, served in the Prometheus text format. Hot paths hold on to
+# their counters and histograms, so recording is an add or a bisect. The text
+# is only put together when someone scrapes the stats port.
+
+import asyncio
+from bisect import bisect_left
+from collections import deque
+
+# Bucket bounds, in seconds for timings
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# Histograms also keep their latest samples, for quantiles over just the recent past
+RECENT_SAMPLES = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+
+SCRAPE_TIMEOUT = 5
+
+class Counter():
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+class Histogram():
+    __slots__ = ('bounds', 'buckets', 'total', 'count', 'recent')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0
+        recent = sorted(self.recent)
+        return recent[int(q * (len(recent) - 1))]
+
+class SnekMetrics():
+    def __init__(self):
+        # name -> (type, help, {labels: metric}), labels being a tuple of (name, value) pairs
+        self.families = dict()
+        # Functions returning (name, type, help, [(labels, value)]) for state read at scrape time
+        self.collectors = list()
+
+    def _metric(self, name, kind, help, labels, make):
+        family = self.families.setdefault(name, (kind, help, dict()))[2]
+        if labels not in family:
+            family[labels] = make()
+        return family[labels]
+
+    def counter(self, name, help, labels=()):
+        return self._metric(name, 'counter', help, labels, Counter)
+
+    def histogram(self, name, help, bounds=TIME_BUCKETS, labels=()):
+        return self._metric(name, 'histogram', help, labels, lambda: Histogram(bounds))
+
+    def render(self):
+        lines = []
+        for name, (kind, help, family) in sorted(self.families.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in sorted(family.items()):
+                if 'counter' == kind:
+                    lines.append(_sample(name, labels, metric.value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.bounds + ('+Inf',), metric.buckets):
+                    cumulative += count
+                    lines.append(_sample(name + '_bucket', labels + (('le', bound),), cumulative))
+                lines.append(_sample(name + '_sum', labels, metric.total))
+                lines.append(_sample(name + '_count', labels, metric.count))
+
+            if 'histogram' == kind:
+                lines.append('# HELP {}_recent {} over the last {} samples'.format(name, help, RECENT_SAMPLES))
+                lines.append('# TYPE {}_recent gauge'.format(name))
+                for labels, metric in sorted(family.items()):
+                    for q in QUANTILES:
+                        lines.append(_sample(name + '_recent', labels + (('quantile', q),), metric.quantile(q)))
+
+        for collect in self.collectors:
+            for name, kind, help, samples in collect():
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in samples:
+                    lines.append(_sample(name, labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+    # Answer HTTP GETs on a local port with the metrics
+    async def serve(self, host, port):
+        return await asyncio.start_server(self._handle_scrape, host, port)
+
+    async def _handle_scrape(self, reader, writer):
+        try:
+            # Skip the request line and headers, every path gets the metrics
+            while True:
+                line = await asyncio.wait_for(reader.readline(), SCRAPE_TIMEOUT)
+                if not line.strip():
+                    break
+            body = self.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+    return '{} {}'.format(name, value)
@@ -1,4 +1,42 @@
-CLIENT_MSG_LEN = 2
+import struct
+import zlib
+import numpy
+
+# Protocol versions. v1 packs coordinates, snek ids and squares into single
+# bytes, which caps boards at 256x256 and arenas at 16 sneks. v2 widens them
+# all to 16 bits. A client picks its version with the join request it sends.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+V1_MAX_SNEKS = 16
+V1_MAX_SIDE  = 256
+
+# v1 client messages are [snek id, cmd]. A v2 client sends [snek id, cmd, arg]
+# messages instead, starting with a join whose first two bytes no v1 message
+# starts with, so the server can tell the versions apart.
+CLIENT_MSG_LEN    = 2
+CLIENT_MSG_LEN_V2 = 4
+CLIENT_MSG_V2     = struct.Struct('!HBB') # snek id, cmd, arg
+
+# Turn cmds are directions. A v2 turn's arg is an input sequence number,
+# 1-255 and wrapping, or 0 for none. Before the update for the tick that
+# applied a turn, the server acks its sequence number to the client, which
+# tells it which of the turns it predicted the server has caught up with.
+NORTH = 0
+EAST  = 1
+SOUTH = 2
+WEST  = 3
+
+JOIN_REQUEST    = b'\xff\xff'
+JOIN_REQUEST_V2 = 0xfffe # As the snek id, with the version as the cmd and ACCEPT_* flags as the arg
+JOIN_V2_PREFIX  = b'\xff\xfe'
+
+# A v2 spectator watches an arena without a snek. It sends SPECTATE_V2 as
+# the snek id, with the arena id as the cmd and ACCEPT_* flags as the arg,
+# and gets a join with SPECTATE_V2 as the snek id back, then keyframes and
+# updates for the whole board and every info message. It can't join or turn.
+SPECTATE_V2        = 0xfffd
+SPECTATE_V2_PREFIX = b'\xff\xfd'
 
 # Message types
 MSG_TYPE_JOIN   = 0
@@ -6,50 +44,316 @@ MSG_TYPE_BOARD  = 1
 MSG_TYPE_UPDATE = 2
 MSG_TYPE_INFO   = 3
 MSG_TYPE_TXT    = 4
+MSG_TYPE_REGION = 5 # v2 only
+MSG_TYPE_ACK    = 6 # v2 only, and only to clients sending sequence numbers
+MSG_TYPE_UDP    = 7 # v2 only, the token and port for a UDP state channel
+MSG_TYPE_STATE  = 8 # v2 only, a state datagram too big for UDP, sent over TCP instead
 
-JOIN_REJECT = 255
+JOIN_REJECT    = 255
+JOIN_REJECT_V2 = 0xffff
 
 INFO_TYPE_JOIN = 0
 INFO_TYPE_KILL = 1
 
-# Snek data goes in board messages and update messages
-def _msg_field_snek_data(snek_list):
-    msg = bytes([len(snek_list)])
+# Encodings. A v2 client lists the ones it accepts as ACCEPT_* flags in the
+# arg of its join. If it accepts any, board, region and update payloads start
+# with a byte naming the encoding the server picked for that frame, whichever
+# is smallest. Without encodings, frames are raw and have no encoding byte.
+# Encoded squares, coordinates and counts are 16 bits.
+ENC_RAW    = 0 # Keyframes: every square in order. Updates: (x, y, square) per change.
+ENC_RLE    = 1 # Keyframes: (count, square) per run of equal squares
+ENC_ZLIB   = 2 # Keyframes: zlib compressed raw squares
+ENC_RUNS   = 3 # Updates: (x, y, count) and then count squares, per run of changes along a row
+ENC_BITMAP = 4 # Updates: a bit per square of the board or region, row major, then the changed squares in that order
+
+ACCEPT_RLE    = 1 << ENC_RLE
+ACCEPT_ZLIB   = 1 << ENC_ZLIB
+ACCEPT_RUNS   = 1 << ENC_RUNS
+ACCEPT_BITMAP = 1 << ENC_BITMAP
+ACCEPT_ALL    = ACCEPT_RLE | ACCEPT_ZLIB | ACCEPT_RUNS | ACCEPT_BITMAP
+
+# UDP state channel. A v2 client that sets JOIN_UDP in its join's arg gets
+# a token and a port over TCP, if the server has UDP on. It says hello by
+# sending the port a UDP_ACK with the token and sequence number 0, and from
+# then on each tick's board, region or update frame comes as a datagram
+# with a UDP_STATE header in front. Every state is numbered, per client.
+# It's a keyframe if its base is 0, otherwise it's the changes since the
+# state numbered base, which applies to any state from base on. The client
+# acks the number of each state it applies. Joins, rejects and info stay on
+# TCP, and if the client goes quiet the server goes back to TCP for good.
+JOIN_UDP = 0x80
+
+MAX_DATAGRAM = 8192
+
+# Square values. Sneks 0-15 are 1-32 and foods are 33-63, which is all a v1
+# client understands. Wider snek ids carry on above the foods. Heads are
+# always odd and bodies are always the even value after them.
+SQ_BLANK         = 0
+SQ_FOOD_MIN      = 33
+SQ_FOOD_MAX      = 63
+SQ_WIDE_SNEK_MIN = 65
+
+MAX_SNEKS_V2 = (0xffff - SQ_WIDE_SNEK_MIN) // 2
+
+def snek_head_square(snek_id):
+    if V1_MAX_SNEKS > snek_id:
+        return snek_id*2+1
+    return snek_id*2+SQ_WIDE_SNEK_MIN-V1_MAX_SNEKS*2
+
+def is_snek_square(square):
+    return (0 < square and SQ_FOOD_MIN > square) or SQ_WIDE_SNEK_MIN <= square
+
+def is_food_square(square):
+    return SQ_FOOD_MIN <= square and SQ_FOOD_MAX >= square
+
+def is_head_square(square):
+    return 1 == square % 2 and is_snek_square(square)
+
+# The square a step away in a direction, the board wraps around at the edges
+def step_square(x, y, direction, width, height):
+    if NORTH == direction:
+        y = y - 1 if y != 0 else height - 1
+    elif EAST == direction:
+        x = (x + 1) % width
+    elif SOUTH == direction:
+        y = (y + 1) % height
+    elif WEST == direction:
+        x = x - 1 if x != 0 else width - 1
+    return (x, y)
+
+def square_snek_id(square):
+    if SQ_FOOD_MIN > square:
+        return (square-1) // 2
+    return (square-SQ_WIDE_SNEK_MIN) // 2 + V1_MAX_SNEKS
+
+# Wire layouts
+HEADER       = struct.Struct('!BI')   # message type, length of the rest
+SNEK_COUNT   = struct.Struct('!B')
+SNEK_COUNT_2 = struct.Struct('!H')
+SNEK_DATA    = struct.Struct('!BHH')  # snek id, score, health
+SNEK_DATA_2  = struct.Struct('!HHH')
+JOIN         = struct.Struct('!BB')   # message type, snek id
+JOIN_2       = struct.Struct('!BHHH') # message type, snek id, board width, board height
+INFO         = struct.Struct('!BBB')  # message type, info type, snek id
+INFO_2       = struct.Struct('!BBH')
+REGION       = struct.Struct('!HHHH') # x, y, width, height
+ACK          = struct.Struct('!BB')   # message type, input sequence number
+UDP_INFO     = struct.Struct('!BIH')  # message type, token, port
+UDP_STATE    = struct.Struct('!IIB')  # sequence number, base, input sequence number acked or 0
+UDP_ACK      = struct.Struct('!II')   # token, sequence number of the last state applied
+
+SQUARE_V2 = numpy.dtype('>u2')
+
+# Per version: snek count, snek data, square type
+LAYOUTS = {
+    PROTOCOL_V1: (SNEK_COUNT, SNEK_DATA, numpy.dtype(numpy.uint8)),
+    PROTOCOL_V2: (SNEK_COUNT_2, SNEK_DATA_2, SQUARE_V2),
+}
+
+# Frames are encoded into one reusable buffer and copied out exactly once.
+# The same bytes then go to every client, so a frame costs one allocation
+# however many clients receive it.
+_scratch = bytearray(1 << 16)
+
+def _reserve(size):
+    global _scratch
+    if len(_scratch) < size:
+        _scratch = bytearray(max(size, 2 * len(_scratch)))
+    return _scratch
+
+# Write the header and the snek data, which goes in board messages and
+# update messages. Returns the buffer, where the payload starts and the frame size.
+def _begin_frame(msg_type, snek_list, payload_len, version):
+    count, snek_data, _ = LAYOUTS[version]
+    body_len = count.size + len(snek_list) * snek_data.size + payload_len
+    frame_len = HEADER.size + body_len
+    buf = _reserve(frame_len)
+
+    HEADER.pack_into(buf, 0, msg_type, body_len)
+    count.pack_into(buf, HEADER.size, len(snek_list))
+    offset = HEADER.size + count.size
     for snek in snek_list:
-        msg += bytes([snek.snek_id])
-        msg += snek.score.to_bytes(2, byteorder='big')
-        msg += b'\x00\x00'
-    return msg
-
-def msg_join_accept(snek_id):
-    return bytes([MSG_TYPE_JOIN, snek_id])
-
-def msg_join_reject():
-    return bytes([MSG_TYPE_JOIN, JOIN_REJECT])
-
-def msg_board(board, snek_list):
-    msg = _msg_field_snek_data(snek_list)
-    for y in range(len(board)):
-        for x in range(len(board[0])):
-            msg += bytes([board[y][x]])
-
-    msg = bytes([MSG_TYPE_BOARD]) + len(msg).to_bytes(4, byteorder='big') + msg 
-    return msg
-
-# Generate board update message
-def msg_update(board, last_board, snek_list):
-    msg = _msg_field_snek_data(snek_list)
-    for y in range(len(board)):
-        for x in range(len(board[0])):
-            new_square = board[y][x]
-            old_square = last_board[y][x]
-            if old_square != new_square:
-                msg += bytes([x, y, new_square])
-
-    msg = bytes([MSG_TYPE_UPDATE]) + len(msg).to_bytes(4, byteorder='big') + msg 
-    return msg
+        snek_data.pack_into(buf, offset, snek.snek_id, snek.score, 0)
+        offset += snek_data.size
+
+    return buf, offset, frame_len
+
+# A writable view of the payload, so numpy fills the frame in place
+def _payload(buf, offset, frame_len, dtype=numpy.uint8):
+    dtype = numpy.dtype(dtype)
+    return numpy.frombuffer(buf, dtype=dtype, count=(frame_len - offset) // dtype.itemsize, offset=offset)
+
+def _end_frame(buf, frame_len):
+    with memoryview(buf) as view:
+        return bytes(view[:frame_len])
+
+def msg_join_accept(snek_id, version=PROTOCOL_V1, width=0, height=0):
+    if PROTOCOL_V1 == version:
+        return JOIN.pack(MSG_TYPE_JOIN, snek_id)
+    return JOIN_2.pack(MSG_TYPE_JOIN, snek_id, width, height)
+
+def msg_join_reject(version=PROTOCOL_V1):
+    if PROTOCOL_V1 == version:
+        return JOIN.pack(MSG_TYPE_JOIN, JOIN_REJECT)
+    return JOIN_2.pack(MSG_TYPE_JOIN, JOIN_REJECT_V2, 0, 0)
+
+def msg_board(board, snek_list, version=PROTOCOL_V1, encodings=0):
+    if encodings:
+        encoding, parts = _encode_keyframe(board.reshape(-1), encodings)
+        return _frame(MSG_TYPE_BOARD, snek_list, version, bytes([encoding]), *parts)
+
+    square = LAYOUTS[version][2]
+    buf, offset, frame_len = _begin_frame(MSG_TYPE_BOARD, snek_list, board.size * square.itemsize, version)
+
+    # The board is row major, so its squares go out in order
+    _payload(buf, offset, frame_len, square)[:] = board.reshape(-1)
+
+    return _end_frame(buf, frame_len)
+
+# A region is the part of a board a client can see, (x, y, width, height).
+# It wraps around the edges of the board like the sneks do. The keyframe for
+# it is sent when a client moves into it, and updates are filtered to it after that.
+def msg_region(board, region, snek_list, version=PROTOCOL_V2, encodings=0):
+    x, y, width, height = region
+    rows = (y + numpy.arange(height)) % board.shape[0]
+    columns = (x + numpy.arange(width)) % board.shape[1]
+    squares = board[numpy.ix_(rows, columns)].reshape(-1)
+
+    if encodings:
+        encoding, parts = _encode_keyframe(squares, encodings)
+        return _frame(MSG_TYPE_REGION, snek_list, version, bytes([encoding]), REGION.pack(*region), *parts)
+
+    square = LAYOUTS[version][2]
+    buf, offset, frame_len = _begin_frame(MSG_TYPE_REGION, snek_list, REGION.size + squares.size * square.itemsize, version)
+
+    REGION.pack_into(buf, offset, x, y, width, height)
+    offset += REGION.size
+    _payload(buf, offset, frame_len, square)[:] = squares
+
+    return _end_frame(buf, frame_len)
+
+# Generate board update message from the flat indices of the changed squares.
+# The region, if the update is filtered to one, is what a bitmap covers.
+def msg_update(board, squares, snek_list, version=PROTOCOL_V1, encodings=0, region=None):
+    if encodings:
+        encoding, parts = _encode_update(board, squares, encodings, region)
+        return _frame(MSG_TYPE_UPDATE, snek_list, version, bytes([encoding]), *parts)
+
+    square = LAYOUTS[version][2]
+    buf, offset, frame_len = _begin_frame(MSG_TYPE_UPDATE, snek_list, len(squares) * 3 * square.itemsize, version)
+
+    # Each change is (x, y, square) using the version's square type
+    ys, xs = numpy.divmod(squares, board.shape[1])
+    changes = _payload(buf, offset, frame_len, square).reshape(-1, 3)
+    changes[:, 0] = xs
+    changes[:, 1] = ys
+    changes[:, 2] = board.reshape(-1)[squares]
+
+    return _end_frame(buf, frame_len)
+
+# Frame a payload that was encoded up front, from a list of bytes-like parts
+def _frame(msg_type, snek_list, version, *parts):
+    parts = [numpy.frombuffer(part, dtype=numpy.uint8) for part in parts]
+    buf, offset, frame_len = _begin_frame(msg_type, snek_list, sum(part.size for part in parts), version)
+    payload = _payload(buf, offset, frame_len, numpy.uint8)
+    offset = 0
+    for part in parts:
+        payload[offset:offset + part.size] = part
+        offset += part.size
+    return _end_frame(buf, frame_len)
+
+# Pick the smallest encoding the client accepts for a keyframe's squares.
+# Returns the encoding and the parts of the payload.
+def _encode_keyframe(squares, encodings):
+    squares = squares.astype(SQUARE_V2)
+    best = (ENC_RAW, [squares])
+    best_len = squares.nbytes
+
+    if encodings & ACCEPT_RLE:
+        # Runs break wherever the square changes, and at least every 0xffff
+        # squares so their counts fit
+        starts = numpy.flatnonzero(numpy.r_[True, squares[1:] != squares[:-1]])
+        starts = numpy.union1d(starts, numpy.arange(0, len(squares), 0xffff))
+        if len(starts) * 4 < best_len:
+            runs = numpy.empty((len(starts), 2), dtype=SQUARE_V2)
+            runs[:, 0] = numpy.diff(numpy.r_[starts, len(squares)])
+            runs[:, 1] = squares[starts]
+            best = (ENC_RLE, [runs])
+            best_len = runs.nbytes
+
+    if encodings & ACCEPT_ZLIB:
+        packed = zlib.compress(squares.tobytes())
+        if len(packed) < best_len:
+            best = (ENC_ZLIB, [packed])
+
+    return best
+
+# Pick the smallest encoding the client accepts for an update. The sizes
+# are worked out first so only the winner gets built.
+def _encode_update(board, squares, encodings, region):
+    height, width = board.shape
+    ys, xs = numpy.divmod(squares, width)
+    values = board.reshape(-1)[squares].astype(SQUARE_V2)
+    count = len(squares)
+
+    encoding = ENC_RAW
+    best_len = count * 6
+
+    if encodings & ACCEPT_RUNS:
+        # A run is squares next to each other in one row, which sorted squares make easy to spot
+        is_start = numpy.r_[True, (squares[1:] != squares[:-1] + 1) | (0 == xs[1:])] if count else numpy.zeros(0, dtype=bool)
+        starts = numpy.flatnonzero(is_start)
+        runs_len = (len(starts) * 3 + count) * 2
+        if runs_len < best_len:
+            encoding, best_len = ENC_RUNS, runs_len
+
+    if encodings & ACCEPT_BITMAP:
+        x, y, area_w, area_h = region or (0, 0, width, height)
+        bitmap_len = (area_w * area_h + 7) // 8 + count * 2
+        if bitmap_len < best_len:
+            encoding, best_len = ENC_BITMAP, bitmap_len
+
+    if ENC_RUNS == encoding:
+        runs = numpy.empty(len(starts) * 3 + count, dtype=SQUARE_V2)
+        run_of = numpy.cumsum(is_start) - 1
+        runs[(run_of + 1) * 3 + numpy.arange(count)] = values
+        headers = numpy.arange(len(starts)) * 3 + starts
+        runs[headers] = xs[starts]
+        runs[headers + 1] = ys[starts]
+        runs[headers + 2] = numpy.diff(numpy.r_[starts, count])
+        return encoding, [runs]
+
+    if ENC_BITMAP == encoding:
+        # Bits go in row major order of the area, which wraps like a region does
+        at = (ys - y) % height * area_w + (xs - x) % width
+        bits = numpy.zeros(area_w * area_h, dtype=bool)
+        bits[at] = True
+        return encoding, [numpy.packbits(bits), values[numpy.argsort(at, kind='stable')]]
+
+    changes = numpy.empty((count, 3), dtype=SQUARE_V2)
+    changes[:, 0] = xs
+    changes[:, 1] = ys
+    changes[:, 2] = values
+    return encoding, [changes]
 
 # Generate info message
-def msg_info(info_type, snek_id):
-   msg = bytes([MSG_TYPE_INFO, info_type, snek_id])
-   return msg
+def msg_info(info_type, snek_id, version=PROTOCOL_V1):
+    if PROTOCOL_V1 == version:
+        return INFO.pack(MSG_TYPE_INFO, info_type, snek_id)
+    return INFO_2.pack(MSG_TYPE_INFO, info_type, snek_id)
+
+# Acknowledge a client's input, v2 only
+def msg_ack(seq):
+    return ACK.pack(MSG_TYPE_ACK, seq)
+
+# Tell a client where to send its UDP acks, v2 only
+def msg_udp(token, port):
+    return UDP_INFO.pack(MSG_TYPE_UDP, token, port)
+
+# A state for the UDP channel, from an encoded board, region or update frame
+def msg_state(seq, base, input_seq, frame):
+    return UDP_STATE.pack(seq, base, input_seq) + frame
+
+# A state sent over TCP
+def msg_state_tcp(state):
+    return HEADER.pack(MSG_TYPE_STATE, len(state)) + state
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Fans one arena out to a crowd of spectators. The relay watches the arena
+# itself, once per set of encodings its watchers take, and passes the frames
+# the server already encoded straight on, so the server writes each tick
+# once however many are watching. It keeps its own copy of the board to give
+# watchers who turn up late, or fall behind, a keyframe of their own.
+# Watchers speak the spectator protocol, so relays can watch other relays.
+
+import asyncio
+import argparse
+import numpy
+
+from snek_pkts import *
+from snek_decode import *
+import snek_web
+
+# Seconds to wait before watching the arena again, after losing it or being turned away
+RETRY_DELAY = 2.0
+
+# Per watcher write buffer limits, in bytes, as on the server. Frames stop
+# at the high water mark and resume with a keyframe below the low water
+# mark. A watcher that stops reading altogether is dropped at the max.
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER  = 16 * 1024
+MAX_WRITE_BUFFER = 1024 * 1024
+
+# Messages a watcher that's behind can miss, the keyframe it gets later covers them
+SKIPPABLE = (MSG_TYPE_BOARD, MSG_TYPE_UPDATE)
+
+# A snek as the frames tell it, which is all a keyframe needs
+class WatchedSnek():
+    def __init__(self, snek_id, score, health):
+        self.snek_id = snek_id
+        self.score = score
+        self.health = health
+
+# A message as the server sent it, from what the reader made of it
+def reframe(msg_type, body):
+    if msg_type in FRAMED:
+        return HEADER.pack(msg_type, len(body)) + body
+    return bytes([msg_type]) + body
+
+# The relay's view of the arena with one set of encodings, and everyone watching through it
+class SnekFeed(asyncio.Protocol):
+    def __init__(self, relay, encodings):
+        self.relay = relay
+        self.encodings = encodings
+        self.transport = None
+        self.reader = None
+        self.watchers = set()
+        self.width = 0
+        self.height = 0
+        self.board = None
+        self.sneks = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reader = FrameReader(PROTOCOL_V2)
+        transport.write(CLIENT_MSG_V2.pack(SPECTATE_V2, self.relay.arena_id, self.encodings))
+
+    # Watchers stay and get the board again once the feed is back
+    def connection_lost(self, exc):
+        print('Stopped watching arena {}, watching again in {}s.'.format(self.relay.arena_id, RETRY_DELAY))
+        self.transport = None
+        self.board = None
+        asyncio.ensure_future(self.relay.subscribe(self, RETRY_DELAY))
+
+    # Keep the board up to date, and pass every message on in one write per watcher
+    def data_received(self, data):
+        self.reader.feed(data)
+        msgs = []
+        kept = []
+        for msg_type, body in self.reader.frames():
+            if MSG_TYPE_JOIN == msg_type:
+                snek_id, width, height = unpack_join(body, PROTOCOL_V2)
+                if SPECTATE_V2 != snek_id:
+                    print('Arena {} turned us away.'.format(self.relay.arena_id))
+                    self.transport.close()
+                    return
+                self.width = width
+                self.height = height
+                self.board = numpy.zeros((height, width), dtype=numpy.uint16)
+            elif msg_type in SKIPPABLE:
+                self._apply(msg_type, body)
+            elif MSG_TYPE_INFO != msg_type and MSG_TYPE_TXT != msg_type:
+                continue
+
+            msg = reframe(msg_type, body)
+            msgs.append(msg)
+            if msg_type not in SKIPPABLE:
+                kept.append(msg)
+
+        if msgs:
+            msgs = b''.join(msgs)
+            kept = b''.join(kept)
+            for watcher in list(self.watchers):
+                watcher.send_frames(msgs, kept)
+
+    def _apply(self, msg_type, body):
+        sneks, payload = split_frame(body, PROTOCOL_V2)
+        self.sneks = [WatchedSnek(*snek) for snek in sneks]
+        encoding = ENC_RAW
+        if self.encodings:
+            encoding = payload[0]
+            payload = payload[1:]
+
+        if MSG_TYPE_BOARD == msg_type:
+            self.board[:] = decode_squares(encoding, payload).reshape(self.height, self.width)
+        else:
+            xs, ys, squares = decode_changes(encoding, payload, (0, 0, self.width, self.height), self.width, self.height)
+            self.board[ys, xs] = squares
+
+    def msg_join(self):
+        return msg_join_accept(SPECTATE_V2, PROTOCOL_V2, self.width, self.height)
+
+    def msg_keyframe(self):
+        return msg_board(self.board, self.sneks, PROTOCOL_V2, self.encodings)
+
+class SnekWatcher(asyncio.Protocol):
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.peername = ""
+        self.feed = None
+        self.inbuf = bytearray()
+        self.paused = False
+        self.needs_board = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info('peername')
+        self.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+
+    def connection_lost(self, exc):
+        if self.feed:
+            self.feed.watchers.discard(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    # Frames were dropped while paused, so start over from the relay's board, if it has one yet
+    def resume_writing(self):
+        self.paused = False
+        if self.needs_board and self.feed.board is not None:
+            self.needs_board = False
+            self.send(self.feed.msg_keyframe())
+
+    # A watcher only ever asks one thing, to watch the relay's arena
+    def data_received(self, data):
+        if self.feed:
+            return
+        self.inbuf += data
+        if CLIENT_MSG_LEN_V2 > len(self.inbuf):
+            return
+
+        snek_id, cmd, arg = CLIENT_MSG_V2.unpack_from(self.inbuf)
+        if SPECTATE_V2 != snek_id or self.relay.arena_id != cmd:
+            self.transport.write(msg_join_reject(PROTOCOL_V2))
+            self.transport.close()
+            return
+
+        # Until the feed has the board, the server's join and keyframe get passed on instead
+        self.feed = self.relay.feed_for(arg & ACCEPT_ALL)
+        self.feed.watchers.add(self)
+        if self.feed.board is not None:
+            self.send(self.feed.msg_join())
+            self.send(self.feed.msg_keyframe())
+
+    def send(self, msg):
+        if self.transport.is_closing():
+            return
+        if self.paused and self.transport.get_write_buffer_size() + len(msg) > MAX_WRITE_BUFFER:
+            print("{}:{} stopped reading, dropping it.".format(*self.peername))
+            self.transport.abort()
+            return
+        self.transport.write(msg)
+
+    # A watcher that's behind only gets what a keyframe won't cover
+    def send_frames(self, msgs, kept):
+        if self.paused:
+            if len(kept) < len(msgs):
+                self.needs_board = True
+            if kept:
+                self.send(kept)
+            return
+        self.send(msgs)
+
+class SnekRelay():
+    def __init__(self, server_addr, server_port, arena_id):
+        self.server_addr = server_addr
+        self.server_port = server_port
+        self.arena_id = arena_id
+
+        # Feeds by the encodings they take. Once a feed is started it stays, watched or not.
+        self.feeds = dict()
+
+    def feed_for(self, encodings):
+        if encodings not in self.feeds:
+            self.feeds[encodings] = SnekFeed(self, encodings)
+            asyncio.ensure_future(self.subscribe(self.feeds[encodings]))
+        return self.feeds[encodings]
+
+    async def subscribe(self, feed, delay=0):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                await loop.create_connection(lambda: feed, self.server_addr, self.server_port)
+                return
+            except OSError as e:
+                print('Could not reach {}:{}, {}'.format(self.server_addr, self.server_port, e))
+                await asyncio.sleep(RETRY_DELAY)
+
+async def serve(args):
+    relay = SnekRelay(args["server_addr"], args["server_port"], args["arena"])
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: SnekWatcher(relay), args["addr"], args["port"])
+
+    print('Relaying arena {} of {}:{} on {}:{}'.format(args["arena"], args["server_addr"], args["server_port"], *server.sockets[0].getsockname()))
+
+    # Browsers can watch too, with the same web client as the server's
+    if args["web_port"]:
+        web = await snek_web.serve(lambda: SnekWatcher(relay), args["addr"], args["web_port"])
+        print('Web on {}:{}'.format(*web.sockets[0].getsockname()))
+
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snek spectator relay")
+    parser.add_argument("--server-addr", default="127.0.0.1", type=str)
+    parser.add_argument("--server-port", default=55555, type=int)
+    parser.add_argument("--arena", default=0, type=int)
+    parser.add_argument("--addr", default="0.0.0.0", type=str)
+    parser.add_argument("--port", default=55556, type=int)
+    parser.add_argument("--web-port", default=0, type=int, help="port for browsers to watch on, off if 0")
+    args = vars(parser.parse_args())
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Replays. A SnekRecorder archives an arena as an append-only log of the
+# frames it broadcasts. It listens in on the arena like a spectator taking
+# every encoding, so each tick's record is the update already encoded for
+# whole-board clients, and it costs a copy into a buffered file. Every
+# keyframe_ticks ticks it writes a keyframe instead, and a side index holds
+# the log offset of every tick. A SnekReplay maps the log and seeks to any
+# tick by decoding forward from the keyframe before it.
+#
+# The log is a REPLAY_HEADER, then records, each a REPLAY_RECORD followed by
+# its body. Keyframe and update bodies are v2 board and update frames, info
+# bodies are v2 info messages and input bodies are REPLAY_INPUTs. A tick's
+# keyframe or update is its last record. Joins, kills and turns are recorded
+# with the tick they lead up to. The index is a REPLAY_OFFSET per tick from
+# 0, where tick 0 is the keyframe the arena opened with.
+
+import asyncio
+import argparse
+import mmap
+import os
+import struct
+import time
+import numpy
+
+from snek_pkts import *
+from snek_decode import *
+
+REPLAY_MAGIC   = b'SNEK'
+REPLAY_VERSION = 1
+
+REPLAY_HEADER = struct.Struct('!4sBHHHHdd') # magic, version, width, height, arena id, keyframe ticks, tps, unix time started
+REPLAY_RECORD = struct.Struct('!IBI')       # tick, record type, length of the body
+REPLAY_INPUT  = struct.Struct('!HB')        # snek id, direction
+REPLAY_OFFSET = struct.Struct('!Q')
+
+REC_KEYFRAME = 0
+REC_UPDATE   = 1
+REC_INFO     = 2
+REC_INPUT    = 3
+
+# Recorded frames are whole board and take every encoding, so they're the smallest the server makes
+REPLAY_ENCODINGS = ACCEPT_ALL
+
+KEYFRAME_TICKS = 64
+
+# Records go to the disk in chunks this big, and at every keyframe
+WRITE_BUFFER = 256 * 1024
+
+# Updates in a recording are runs, bitmaps or raw, so that's what a viewer needs to take
+PLAYBACK_ENCODINGS = ACCEPT_RUNS | ACCEPT_BITMAP
+
+class SnekRecorder():
+    def __init__(self, server, record_dir, keyframe_ticks=KEYFRAME_TICKS):
+        self.server = server
+        self.keyframe_ticks = keyframe_ticks
+
+        # What the arena's broadcasts look for in a client
+        self.version = PROTOCOL_V2
+        self.encodings = REPLAY_ENCODINGS
+        self.region = None
+        self.snek = None
+        self.udp_addr = None
+        self.input_seq = 0
+        self.acked_seq = 0
+
+        started = time.time()
+        name = 'arena{}-{}-{:03d}'.format(server.arena_id, time.strftime('%Y%m%d-%H%M%S', time.localtime(started)), int(started * 1000) % 1000)
+        self.path = os.path.join(record_dir, name + '.snek')
+        self.log = open(self.path, 'xb', buffering=WRITE_BUFFER)
+        self.index = open(os.path.join(record_dir, name + '.idx'), 'xb', buffering=WRITE_BUFFER)
+
+        header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, server.width, server.height, server.arena_id,
+                                    keyframe_ticks, server.tps, started)
+        self.log.write(header)
+        self.offset = len(header)
+        self._write_tick(REC_KEYFRAME, server.msg_keyframe(self))
+        self.flush()
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+    # The log goes first, so the index never points past what's on disk
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+
+    def _write(self, tick, record_type, body):
+        self.log.write(REPLAY_RECORD.pack(tick, record_type, len(body)))
+        self.log.write(body)
+        self.offset += REPLAY_RECORD.size + len(body)
+
+    def _write_tick(self, record_type, body):
+        self.index.write(REPLAY_OFFSET.pack(self.offset))
+        self._write(self.server.tick_number, record_type, body)
+
+    # The arena's info broadcasts
+    def send(self, msg):
+        self._write(self.server.tick_number + 1, REC_INFO, msg)
+
+    # The arena's update for the tick just run, unless it's time for a
+    # keyframe. Keyframes go to disk straight away, so a crash loses at most
+    # keyframe_ticks ticks.
+    def send_update(self, msg):
+        if 0 == self.server.tick_number % self.keyframe_ticks:
+            msg = self.server.msg_keyframe(self)
+            self._write_tick(REC_KEYFRAME, msg)
+            self.flush()
+        else:
+            self._write_tick(REC_UPDATE, msg)
+
+    def record_input(self, snek_id, direction):
+        self._write(self.server.tick_number + 1, REC_INPUT, REPLAY_INPUT.pack(snek_id, direction))
+
+# A snek as a recording tells it, which is all a keyframe needs
+class ReplaySnek():
+    def __init__(self, snek_id, score, health):
+        self.snek_id = snek_id
+        self.score = score
+        self.health = health
+
+class SnekReplay():
+    def __init__(self, path):
+        # A recording is at least a header and the start of its first keyframe
+        if os.path.getsize(path) < REPLAY_HEADER.size + REPLAY_RECORD.size:
+            raise ValueError('{} is not a snek replay'.format(path))
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.width, self.height, self.arena_id, self.keyframe_ticks, self.tps, self.started = \
+            REPLAY_HEADER.unpack_from(self.data)
+        if REPLAY_MAGIC != magic or REPLAY_VERSION != version:
+            self.close()
+            raise ValueError('{} is not a snek replay'.format(path))
+
+        # Seeking starts from the first keyframe, so without it there's nothing to play
+        self.index = self._load_index(os.path.splitext(path)[0] + '.idx')
+        if not len(self.index):
+            self.close()
+            raise ValueError('{} has no ticks recorded'.format(path))
+        self.last_tick = len(self.index) - 1
+
+        self.board = numpy.zeros((self.height, self.width), dtype=numpy.uint16)
+        self.sneks = []
+        self.tick = None
+        self.offset = None
+
+    def close(self):
+        self.data.close()
+
+    # Offsets of every tick whose record made it into the log. A recording
+    # that was cut off, or lost its index, is indexed again from the log.
+    def _load_index(self, path):
+        index = numpy.zeros(0, dtype='>u8')
+        if os.path.exists(path):
+            index = numpy.fromfile(path, dtype='>u8')
+        if len(index) and self._complete(int(index[-1])):
+            return index
+        offsets = [offset for tick, record_type, body, offset in self.records(REPLAY_HEADER.size) if record_type in (REC_KEYFRAME, REC_UPDATE)]
+        return numpy.array(offsets, dtype='>u8')
+
+    def _complete(self, offset):
+        if offset + REPLAY_RECORD.size > len(self.data):
+            return False
+        tick, record_type, length = REPLAY_RECORD.unpack_from(self.data, offset)
+        return offset + REPLAY_RECORD.size + length <= len(self.data)
+
+    # (tick, record type, body, offset of the record) from offset on, up to where the log ends or was cut off
+    def records(self, offset):
+        data = self.data
+        while self._complete(offset):
+            tick, record_type, length = REPLAY_RECORD.unpack_from(data, offset)
+            start = offset + REPLAY_RECORD.size
+            yield tick, record_type, data[start:start + length], offset
+            offset = start + length
+
+    # Go to the board as it was after a tick, from the keyframe before it
+    def seek(self, tick):
+        tick = max(0, min(tick, self.last_tick))
+        keyframe = tick // self.keyframe_ticks * self.keyframe_ticks
+        self.offset = int(self.index[keyframe])
+        self.tick = keyframe - 1
+        while self.tick < tick:
+            self.step()
+
+    # Play the next tick. Returns its records, or None at the end.
+    def step(self):
+        if self.tick >= self.last_tick:
+            return None
+        played = []
+        for tick, record_type, body, offset in self.records(self.offset):
+            self._apply(record_type, body)
+            played.append((record_type, body))
+            if record_type in (REC_KEYFRAME, REC_UPDATE):
+                self.offset = offset + REPLAY_RECORD.size + len(body)
+                self.tick = tick
+                break
+        return played
+
+    def _apply(self, record_type, body):
+        if record_type not in (REC_KEYFRAME, REC_UPDATE):
+            return
+        sneks, payload = split_frame(body[HEADER.size:], PROTOCOL_V2)
+        self.sneks = [ReplaySnek(*snek) for snek in sneks]
+        encoding = payload[0]
+        payload = payload[1:]
+        if REC_KEYFRAME == record_type:
+            self.board[:] = decode_squares(encoding, payload).reshape(self.height, self.width)
+        else:
+            xs, ys, squares = decode_changes(encoding, payload, (0, 0, self.width, self.height), self.width, self.height)
+            self.board[ys, xs] = squares
+
+    def msg_keyframe(self, encodings):
+        return msg_board(self.board, self.sneks, PROTOCOL_V2, encodings)
+
+# Plays a recording to a spectator, from where the player was asked to
+# start, at the speed it was recorded times the speed asked for
+class SnekPlayback(asyncio.Protocol):
+    def __init__(self, args):
+        self.args = args
+        self.transport = None
+        self.inbuf = bytearray()
+        self.task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.task:
+            self.task.cancel()
+
+    def data_received(self, data):
+        if self.task:
+            return
+        self.inbuf += data
+        if CLIENT_MSG_LEN_V2 > len(self.inbuf):
+            return
+        snek_id, cmd, arg = CLIENT_MSG_V2.unpack_from(self.inbuf)
+        if SPECTATE_V2 != snek_id or PLAYBACK_ENCODINGS != arg & PLAYBACK_ENCODINGS:
+            self.transport.write(msg_join_reject(PROTOCOL_V2))
+            self.transport.close()
+            return
+        self.task = asyncio.ensure_future(self.play(arg & ACCEPT_ALL))
+
+    async def play(self, encodings):
+        replay = SnekReplay(self.args["replay"])
+        replay.seek(self.args["tick"])
+        self.transport.write(msg_join_accept(SPECTATE_V2, PROTOCOL_V2, replay.width, replay.height))
+        self.transport.write(replay.msg_keyframe(encodings))
+
+        loop = asyncio.get_running_loop()
+        period = 1 / (replay.tps * self.args["speed"])
+        deadline = loop.time()
+        try:
+            while not self.transport.is_closing():
+                deadline += period
+                await asyncio.sleep(max(0, deadline - loop.time()))
+                played = replay.step()
+                if played is None:
+                    break
+                # Frames go out as they were recorded, except keyframes, which the viewer might not take zlib for
+                msgs = []
+                for record_type, body in played:
+                    if REC_KEYFRAME == record_type:
+                        msgs.append(replay.msg_keyframe(encodings))
+                    elif record_type in (REC_UPDATE, REC_INFO):
+                        msgs.append(body)
+                self.transport.write(b''.join(msgs))
+        finally:
+            replay.close()
+        self.transport.close()
+
+# The board after a tick, a character a square
+def print_board(replay):
+    print('Arena {} tick {} of {}, {}x{}'.format(replay.arena_id, replay.tick, replay.last_tick, replay.width, replay.height))
+    for row in replay.board:
+        print(''.join('@' if is_head_square(v) else 'O' if is_snek_square(v) else '*' if is_food_square(v) else '.' for v in row.tolist()))
+    for snek in sorted(replay.sneks, key=lambda snek: snek.score, reverse=True):
+        print('snek {:<6} score {}'.format(snek.snek_id, snek.score))
+
+async def serve(args):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: SnekPlayback(args), args["addr"], args["port"])
+    print('Playing {} on {}:{}'.format(args["replay"], *server.sockets[0].getsockname()))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snek replay player")
+    parser.add_argument("replay", type=str)
+    parser.add_argument("--tick", default=0, type=int, help="tick to show, or to start playing from")
+    parser.add_argument("--port", default=0, type=int, help="play to spectators on this port instead of showing a tick")
+    parser.add_argument("--addr", default="127.0.0.1", type=str)
+    parser.add_argument("--speed", default=1.0, type=float)
+    args = vars(parser.parse_args())
+
+    if args["speed"] <= 0:
+        parser.error("--speed must be positive")
+
+    try:
+        replay = SnekReplay(args["replay"])
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if not args["port"]:
+        replay.seek(args["tick"])
+        print_board(replay)
+        replay.close()
+    else:
+        replay.close()
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
@@ -2,404 +2,724 @@
 
 import asyncio
 import argparse
-from random import randint
-from copy import deepcopy
-from numpy.random import choice
+import os
+import secrets
+import signal
+from collections import deque
+from time import perf_counter
+import numpy
 
 from snek_pkts import *
-
-SNEK_SERVER = None
-
-# Directions
-NORTH = 0
-EAST  = 1
-SOUTH = 2
-WEST  = 3
-
-# Square types
-SQ_BLANK       = 0
-SQ_SALT        = 33
-SQ_CRACKER     = 34
-SQ_TABASCO     = 35
-SQ_SNACK_BREAD = 36
-SQ_OMLET       = 37
-SQ_WATER       = 38
-
-FOODS = [SQ_SALT, SQ_CRACKER, SQ_TABASCO, SQ_SNACK_BREAD, SQ_OMLET, SQ_WATER]
-FOOD_WEIGHTS = [0.5, 0.15, 0.05, 0.15, 0.05, 0.1]
+from snek_game import *
+from snek_metrics import SnekMetrics, COUNT_BUCKETS
+from snek_replay import SnekRecorder, KEYFRAME_TICKS
+import snek_web
 
 # Limits
-STARTING_MIN_FOOD = 4
-FOOD_MULTIPLIER   = 2
-MAX_SNEKS         = 16
-MAX_X             = 80
-MAX_Y             = 40
-SPAWN_FROM_EDGE   = 15
+MAX_ARENAS = 8
+
+# The lobby opens this arena first and never closes it, so it's always
+# there for spectators and relays to watch
+FIRST_ARENA = 0
 
-# Causes of death
-DISCONNECT = 0
-OTHER      = 1
+KILL_CAUSES = {DISCONNECT: 'disconnect', OTHER: 'collision'}
 
 # Game parameters
 TICKS_PER_SECOND = 7
-
-# Direction to advance
-FORWARD  = 0
-BACKWARD = 1
-
-class Snek():
-    def __init__(self, snek_id, x, y, transport):
-        self.snek_id = snek_id
-        self.head_value = snek_id*2+1
-        self.body_value = snek_id*2+2
-        direction = randint(0,3)
-        self.direction = direction
-
-        # Cache the direction from the begining of the move to ignore turning back on self
-        self.last_direction = direction
-
-        # [block type (head, body), x, y, direction]
-        self.blocks = [(self.head_value, x, y, direction)]
-        self._append_null_tail()
-
-        self.score = 0
-        self.hydration = 50
-        self.salt = 50
-        self.tabasco = False
-        self.poisoned = False
-        self.transport = transport
-
-    def poison(self):
-        self.poisoned = True
-
-    def unpoison(self):
-        self.poisoned = False
-
-    def armor(self):
-        self.tabasco = True
-
-    def unarmor(self):
-        self.tabasco = False
-
-    def hydrate(self, camelbaks):
-        self.hydration += camelbaks
-
-    def dehydrate(self, camelbaks):
-        self.hydration -= camelbaks
-    
-    def slither(self):
-        old_blocks = self.blocks
-
-        if not old_blocks:
-            return []
-
-        old_head = old_blocks[0]
-        
-        # New head
-        x = old_head[1]
-        y = old_head[2]
-
-        new_x, new_y = self._advance_block(x, y, self.direction, FORWARD)
-
-        new_head = (self.head_value, new_x, new_y, self.direction)
-
-        tail = self.blocks[-2]
-        new_null_tail = (SQ_BLANK, tail[1], tail[2], tail[3])
-
-        if 2 == len(old_blocks):
-            self.blocks = [new_head] + [new_null_tail]
-        else:
-            new_neck = (self.body_value, old_head[1], old_head[2], old_head[3])
-            self.blocks = [new_head] + [new_neck] + self.blocks[1:-2] + [new_null_tail]
-
-        self.last_direction = self.direction
-
-        # Return the changes
-        return [block for block in self.blocks if block not in set(old_blocks) and SQ_BLANK != block[0]] # Say that five times fast.
-
-    def change_direction(self, direction):
-        # Ignore turning back on self
-        if 0 != (direction + self.last_direction) % 2:
-            self.direction = direction
-
-    def die(self):
-        self.blocks = None
-
-    def eat(self):
-        self.score += 1
-        terminal_block = self.blocks[-1]
-        if SQ_BLANK != terminal_block[0]:
-            self._append_null_tail()
-            terminal_block = self.blocks[-1]
-
-        x = terminal_block[1]
-        y = terminal_block[2]
-        direction = terminal_block[3]
-
-        self.blocks = self.blocks[:-1]
-        self.blocks.append((self.body_value, x, y, direction))
-        self._append_null_tail()
-
-    def _advance_block(self, x, y, direction, mode):
-        if BACKWARD == mode:
-            direction ^= 2
-
-        if NORTH == direction:
-            y = y - 1 if y != 0 else MAX_Y - 1
-        elif EAST == direction:
-            x = (x + 1) % MAX_X
-        elif SOUTH == direction:
-            y = (y + 1) % MAX_Y
-        elif WEST == direction:
-            x = x - 1 if x != 0 else MAX_X - 1
-
-        return (x, y)
-
-    # The null block at the end of a snek.blocks serves as a placeholder for growth
-    def _append_null_tail(self):
-        terminal_block = self.blocks[-1]
-        # Null block already exists
-        if SQ_BLANK == terminal_block[0]:
-            return
-
-        # Position null block based on direction of terminal block
-        direction = terminal_block[3]
-        x = terminal_block[1]
-        y = terminal_block[2]
-
-        x, y = self._advance_block(x, y, direction, BACKWARD)
-
-        self.blocks.append((SQ_BLANK, x, y, direction))
+STATS_ADDR = "127.0.0.1"
+# An arena that falls further behind than this skips the missed ticks instead of catching up
+MAX_CATCHUP_TICKS = 3
+
+# Parts of a tick that are timed separately
+TICK_PHASES = ('slither', 'commit', 'spawn_food', 'cache', 'encode', 'broadcast')
+
+# v2 clients on big boards only hear about the region around their head.
+# Regions snap to a grid of REGION_STEP squares, so clients near each other
+# share one encoded update, and are big enough to hold the client's view
+# wherever the head is inside its grid cell.
+VIEW_W      = 80
+VIEW_H      = 40
+REGION_STEP = 16
+
+# Per client write buffer limits, in bytes. Updates stop at the high water
+# mark and resume with a fresh board below the low water mark. A client that
+# stops reading altogether is dropped at the max.
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER  = 16 * 1024
+MAX_WRITE_BUFFER = 1024 * 1024
+
+# UDP state channel. States are the changes since the last state a client
+# acked, so arenas remember the squares that changed in their last
+# UDP_HISTORY_TICKS ticks, and a client further behind than that gets a
+# keyframe. So does one that hasn't had one for UDP_KEYFRAME_TICKS. A
+# client that hasn't acked anything for UDP_TIMEOUT seconds goes back to TCP.
+UDP_HISTORY_TICKS  = 32
+UDP_KEYFRAME_TICKS = 64
+UDP_TIMEOUT        = 3.0
 
 class SnekProtocol(asyncio.Protocol):
-    def __init__(self, sneks, available_snek_ids, board):
-        self.sneks = sneks
-        self.available_snek_ids = available_snek_ids
-        self.board = board
+    def __init__(self, lobby):
+        self.lobby = lobby
+        self.server = None
         self.peername = ""
         self.snek = None
+        self.spectating = False
+        self.version = PROTOCOL_V1
+        self.encodings = 0
+        self.inbuf = bytearray()
+        self.region = None
+        self.paused = False
+        self.needs_board = False
+        self.bytes_sent = 0
+
+        # The last input sequence number the client sent, and the last acked
+        self.input_seq = 0
+        self.acked_seq = 0
+
+        # UDP state channel. The address is where the hello came from, and
+        # states go there until the client stops acking them.
+        self.udp_token = None
+        self.udp_addr = None
+        self.udp_failed = False
+        self.udp_heard = 0
+        self.udp_seq = 0
+        self.udp_sent = dict() # state number: arena tick it's from
+        self.udp_acked = 0
+        self.udp_keyframe = 0
+        self.udp_keyframe_tick = 0
 
     def connection_made(self, transport):
+        self.lobby.clients.add(self)
         self.peername = transport.get_extra_info('peername')
         print('{}:{} connected.'.format(*self.peername))
         self.transport = transport
-        
+        self.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+
+    # The client isn't keeping up. Drop its updates until it drains.
+    def pause_writing(self):
+        self.paused = True
+
+    # Updates were dropped while paused, so resync with the whole board
+    def resume_writing(self):
+        self.paused = False
+        if self.needs_board:
+            self.needs_board = False
+            self.send(self.server.msg_keyframe(self))
+
+    # Join and info messages always go out, they are small and can't be resent
+    def send(self, msg):
+        if self.transport.is_closing():
+            return
+        if self.paused and self.transport.get_write_buffer_size() + len(msg) > MAX_WRITE_BUFFER:
+            print("{}:{} stopped reading, dropping it.".format(*self.peername))
+            self.transport.abort()
+            return
+        self._write(msg)
+
+    # Updates are only good until the next one, so a paused client misses them
+    def send_update(self, msg):
+        if self.paused:
+            self.needs_board = True
+            self.lobby.dropped_updates.value += 1
+            return
+        self._write(msg)
+
+    def _write(self, msg):
+        self.transport.write(msg)
+        self.bytes_sent += len(msg)
+        self.lobby.bytes_sent.value += len(msg)
+
+    # A state goes over UDP, unless it's too big for a datagram
+    def send_state(self, state):
+        if MAX_DATAGRAM < len(state):
+            self.send_update(msg_state_tcp(state))
+            return
+        self.lobby.udp.sendto(state, self.udp_addr)
+        self.bytes_sent += len(state)
+        self.lobby.bytes_sent.value += len(state)
+
+    # A hello or an ack came in over UDP
+    def udp_received(self, addr, seq):
+        self.udp_addr = addr
+        self.udp_heard = perf_counter()
+        if self.udp_acked < seq and seq in self.udp_sent:
+            self.udp_acked = seq
+
+    # The client stopped hearing us over UDP, it's TCP from here on
+    def udp_fallback(self):
+        print("{}:{} went quiet on UDP, back to TCP.".format(*self.peername))
+        self.lobby.udp_tokens.pop(self.udp_token, None)
+        self.lobby.udp_fallbacks.value += 1
+        self.udp_token = None
+        self.udp_addr = None
+        self.udp_failed = True
+
+    def reject(self):
+        self.lobby.rejects.value += 1
+        msg = msg_join_reject(self.version)
+        self.send(msg)
+        self.transport.close()
+
     def connection_lost(self, exc):
+        self.lobby.clients.discard(self)
+        self.lobby.udp_tokens.pop(self.udp_token, None)
+        if self.spectating:
+            self.server.spectators.discard(self)
         if exc:
             print(exc)
         if self.snek and self.snek.blocks:
-            SNEK_SERVER.kill_snek(self.snek, DISCONNECT)
+            self.server.kill_snek(self.snek, DISCONNECT)
         print("{}:{} disconnected.".format(*self.peername))
 
-    # Got message from client.
+    # Got data from client. Messages can arrive split up or several at once.
     def data_received(self, data):
-        if data and CLIENT_MSG_LEN == len(data):
-
-            # Parse command
-            snek_id = int(data[0])
-            cmd = int(data[1])
-
-            # Command is a join request.
-            if 255 == snek_id and 255 == cmd:
-
-                # Connection already has a snek but requested a new one. 
-                # That is not legitimate.
-                if self.snek and self.snek.blocks:
-                    print("ignoring bad join request")
-                    return
-
-                # Assign a snek id, iff the server isn't full of sneks.
-                if 0 != len(self.available_snek_ids):
-
-                    assigned_snek_id = self.available_snek_ids.pop()
-
-                    # Determine where to spawn. Don't spawn on top of things.
-                    x = randint(SPAWN_FROM_EDGE, MAX_X - SPAWN_FROM_EDGE)
-                    y = randint(SPAWN_FROM_EDGE, MAX_Y - SPAWN_FROM_EDGE)
-                    while 0 != self.board[y][x]:
-                        x = randint(SPAWN_FROM_EDGE, MAX_X - SPAWN_FROM_EDGE)
-                        y = randint(SPAWN_FROM_EDGE, MAX_Y - SPAWN_FROM_EDGE)
-
-                    # Spawn or respawn snek
-                    new_snek = Snek(assigned_snek_id, x, y, self.transport)
-                    self.snek = new_snek
-
-                    self.sneks[assigned_snek_id] = new_snek
-
-                    # Send client its assigned snek id
-                    msg = msg_join_accept(assigned_snek_id)
-                    self.transport.write(msg)
-
-                    # Send whole board one time
-                    msg = msg_board(self.board, self.sneks.values())
-                    self.transport.write(msg)
-
-                    # Announce join to all players
-                    msg = msg_info(INFO_TYPE_JOIN, assigned_snek_id)
-                    SNEK_SERVER.broadcast(msg)
-
-                # Server is full of sneks. Close failed request.
-                else:
-                    msg = msg_join_reject()
-                    self.transport.write(msg)
-                    self.transport.close()
-
-            elif self.snek and self.snek.blocks:
-                if snek_id != self.snek.snek_id or cmd < 0 or cmd > 3:
-                    print("ignoring bad command")
-                    return
-
-                # Handle directional commands.
-                self.snek.change_direction(cmd)
-
-# The SnekServer runs the game.
+        self.inbuf += data
+        offset = 0
+        while True:
+            if PROTOCOL_V1 == self.version and self.inbuf[offset:offset+2] in (JOIN_V2_PREFIX, SPECTATE_V2_PREFIX):
+                self.version = PROTOCOL_V2
+
+            if PROTOCOL_V1 == self.version:
+                if len(self.inbuf) - offset < CLIENT_MSG_LEN:
+                    break
+                snek_id = self.inbuf[offset]
+                cmd = self.inbuf[offset+1]
+                arg = 0
+                offset += CLIENT_MSG_LEN
+            else:
+                if len(self.inbuf) - offset < CLIENT_MSG_LEN_V2:
+                    break
+                snek_id, cmd, arg = CLIENT_MSG_V2.unpack_from(self.inbuf, offset)
+                offset += CLIENT_MSG_LEN_V2
+
+            self._handle_msg(snek_id, cmd, arg)
+        del self.inbuf[:offset]
+
+    def _handle_msg(self, snek_id, cmd, arg):
+        # Command is a join request.
+        if (PROTOCOL_V1 == self.version and 255 == snek_id and 255 == cmd) or \
+           (PROTOCOL_V2 == self.version and JOIN_REQUEST_V2 == snek_id):
+
+            # Connection already has a snek but requested a new one, or
+            # is watching. That is not legitimate.
+            if (self.snek and self.snek.blocks) or self.spectating:
+                print("ignoring bad join request")
+                return
+
+            # Find an arena with room for another snek that speaks this
+            # client's version, iff the lobby isn't full of sneks.
+            server = None
+            if PROTOCOL_V1 == self.version or PROTOCOL_V2 == cmd:
+                server = self.lobby.find_arena(self.server, self.version)
+
+            # Spawn or respawn snek, unless there's no room on the board for it
+            snek = server.spawn_snek(self) if server else None
+
+            if snek:
+                self.server = server
+                self.snek = snek
+                self.lobby.joins.value += 1
+                if PROTOCOL_V2 == self.version:
+                    self.encodings = arg & ACCEPT_ALL
+
+                # Send client its assigned snek id
+                msg = msg_join_accept(self.snek.snek_id, self.version, server.width, server.height)
+                self.send(msg)
+
+                # States start over with a keyframe in the new arena. The
+                # first join that asks gets a UDP channel, if there is one.
+                self.udp_sent.clear()
+                self.udp_heard = perf_counter()
+                if PROTOCOL_V2 == self.version and arg & JOIN_UDP and self.lobby.udp and not self.udp_token and not self.udp_failed:
+                    self.udp_token = self.lobby.new_udp_token(self)
+                    self.send(msg_udp(self.udp_token, self.lobby.udp_port))
+
+                # Send whole board, or the region around the snek, one time
+                msg = server.msg_keyframe(self)
+                self.send(msg)
+                self.needs_board = False
+
+                # Announce join to all players in the arena
+                snek_id = self.snek.snek_id
+                server.broadcast(lambda version: msg_info(INFO_TYPE_JOIN, snek_id, version))
+
+            # Every arena is full of sneks, or of everything else. Close failed request.
+            else:
+                self.reject()
+
+        # Command is a request to watch an arena, whole board and no snek
+        elif PROTOCOL_V2 == self.version and SPECTATE_V2 == snek_id:
+            if self.snek or self.spectating:
+                print("ignoring bad spectate request")
+                return
+
+            server = self.lobby.arenas.get(cmd)
+            if not server:
+                self.reject()
+                return
+
+            self.server = server
+            self.spectating = True
+            self.encodings = arg & ACCEPT_ALL
+            server.spectators.add(self)
+            self.lobby.spectates.value += 1
+            self.send(msg_join_accept(SPECTATE_V2, self.version, server.width, server.height))
+            self.send(server.msg_keyframe(self))
+
+        elif self.snek and self.snek.blocks:
+            if snek_id != self.snek.snek_id or cmd < 0 or cmd > 3:
+                print("ignoring bad command")
+                return
+
+            # Handle directional commands.
+            self.snek.change_direction(cmd)
+            if self.server.recorder:
+                self.server.recorder.record_input(snek_id, cmd)
+            if PROTOCOL_V2 == self.version and arg:
+                self.input_seq = arg
+
+# Hellos and acks from clients on the UDP state channel
+class SnekUdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, lobby):
+        self.lobby = lobby
+
+    def datagram_received(self, data, addr):
+        if UDP_ACK.size != len(data):
+            return
+        token, seq = UDP_ACK.unpack(data)
+        client = self.lobby.udp_tokens.get(token)
+        if client:
+            client.udp_received(addr, seq)
+
+# The SnekLobby routes joins to arenas, opening and closing them as needed.
+class SnekLobby():
+    def __init__(self, max_arenas, width=MAX_X, height=MAX_Y, arena_sneks=MAX_SNEKS, tps=TICKS_PER_SECOND, seed=None,
+                 record_dir=None, keyframe_ticks=KEYFRAME_TICKS):
+        self.arenas = dict()
+        self.available_arena_ids = [i for i in range(max_arenas-1, -1, -1)]
+        self.width = width
+        self.height = height
+        self.arena_sneks = arena_sneks
+        self.tps = tps
+        self.seed = seed
+
+        # Every arena is recorded here, if anywhere
+        self.record_dir = record_dir
+        self.keyframe_ticks = keyframe_ticks
+
+        self.clients = set()
+        self.metrics = SnekMetrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.joins = self.metrics.counter('snek_joins_total', 'Sneks spawned')
+        self.rejects = self.metrics.counter('snek_join_rejects_total', 'Joins turned away')
+        self.spectates = self.metrics.counter('snek_spectates_total', 'Spectators that started watching an arena')
+        self.bytes_sent = self.metrics.counter('snek_bytes_sent_total', 'Bytes written to all clients')
+        self.dropped_updates = self.metrics.counter('snek_dropped_updates_total', 'Updates not sent to clients that were behind')
+        self.udp_fallbacks = self.metrics.counter('snek_udp_fallbacks_total', 'Clients that went quiet on UDP and went back to TCP')
+
+        # The UDP state channel, if it's on, and its clients by token
+        self.udp = None
+        self.udp_port = 0
+        self.udp_tokens = dict()
+
+        self.open_arena()
+
+    def open_arena(self):
+        arena_id = self.available_arena_ids.pop()
+        # Each arena plays out its own way, the same way every time the lobby has a seed
+        seed = None if self.seed is None else self.seed + arena_id
+        arena = SnekServer(self, arena_id, self.width, self.height, self.arena_sneks, self.tps, seed)
+        self.arenas[arena_id] = arena
+        print("Arena {} opened.".format(arena_id))
+        return arena
+
+    # Rejoin the last arena if it has room, otherwise fill the busiest arena
+    # that has room so players find each other. Open a new arena when they're all full.
+    # Arenas are all alike, so if one can't speak a version none of them can.
+    def find_arena(self, last_arena=None, version=PROTOCOL_V1):
+        if not next(iter(self.arenas.values())).speaks(version):
+            return None
+
+        if last_arena and not last_arena.is_full() and self.arenas.get(last_arena.arena_id) is last_arena:
+            return last_arena
+
+        open_arenas = [arena for arena in self.arenas.values() if not arena.is_full()]
+        if open_arenas:
+            return max(open_arenas, key=lambda arena: len(arena.sneks))
+
+        if self.available_arena_ids:
+            return self.open_arena()
+
+        return None
+
+    def new_udp_token(self, client):
+        token = 0
+        while not token or token in self.udp_tokens:
+            token = secrets.randbits(32)
+        self.udp_tokens[token] = client
+        return token
+
+    # Live state for the metrics, read when they're scraped
+    def collect_metrics(self):
+        arenas = sorted(self.arenas.items())
+        clients = sorted(('{}:{}'.format(*client.peername[:2]), client.bytes_sent) for client in self.clients)
+        return [
+            ('snek_connected_clients', 'gauge', 'Connected clients',
+                [((), len(self.clients))]),
+            ('snek_client_bytes_sent_total', 'counter', 'Bytes written to each connected client',
+                [((('client', peer),), bytes_sent) for peer, bytes_sent in clients]),
+            ('snek_arena_sneks', 'gauge', 'Sneks in each arena',
+                [((('arena', arena_id),), len(arena.sneks)) for arena_id, arena in arenas]),
+            ('snek_arena_spectators', 'gauge', 'Spectators watching each arena',
+                [((('arena', arena_id),), len(arena.spectators)) for arena_id, arena in arenas]),
+            ('snek_ticks_total', 'counter', 'Ticks run',
+                [((('arena', arena_id),), arena.ticks) for arena_id, arena in arenas]),
+            ('snek_tick_overruns_total', 'counter', 'Ticks that ended past the next deadline',
+                [((('arena', arena_id),), arena.overruns) for arena_id, arena in arenas]),
+            ('snek_ticks_skipped_total', 'counter', 'Ticks skipped after falling too far behind',
+                [((('arena', arena_id),), arena.skipped_ticks) for arena_id, arena in arenas]),
+        ]
+
+    # Close arenas once their last snek is gone, except the first.
+    # Spectators of a closed arena are let go.
+    def arena_emptied(self, arena):
+        if FIRST_ARENA != arena.arena_id:
+            arena.close()
+            for spectator in list(arena.spectators):
+                spectator.transport.close()
+            self.arenas.pop(arena.arena_id)
+            self.available_arena_ids.append(arena.arena_id)
+            print("Arena {} closed.".format(arena.arena_id))
+
+# The SnekServer runs one arena's SnekGame on the event loop and tells the
+# arena's clients what happens in it.
 class SnekServer():
-    def __init__(self, sneks, available_snek_ids, board):
-        self.sneks = sneks
-        self.available_snek_ids = available_snek_ids
-        self.food_count = 0
-        self.board = board
-        self.last_board = board
-
-    def _slither_the_sneks(self):
-        diffs = list()
-        sneks_to_kill = list()
-        sneks_to_feed = list()
-
-        # Advance the sneks!
-        for snek in self.sneks.values():
-            diffs += snek.slither()
-
-        # Process the changes
-        for diff in diffs:
-            # If the diff is a head block
-            if 1 == diff[0] % 2:
-                snek_id = diff[0] // 2
-                new_x = diff[1]
-                new_y = diff[2]
-
-                # Border
-                #if new_x < 0 or new_x >= MAX_X or new_y < 0 or new_y >= MAX_Y:
-                #    sneks_to_kill.append(self.sneks[snek_id])
-                #    continue
-
-                # Detect other types of conflicts
-                conflicts = [d for d in diffs if d != diff and d[1] == new_x and d[2] == new_y]
-                if 0 == len(conflicts):
-                    conflicts.append((self.board[new_y][new_x], new_x, new_y, 0))
-
-                # The only conflict is a blank square. Do nothing exciting.
-                if 1 == len(conflicts) and SQ_BLANK == conflicts[0][0]:
-                    continue
-
-                for conflict in conflicts:
-                    square_type = conflict[0]
-                    # Head hit body square or head square
-                    if MAX_SNEKS*2 >= square_type and 0 < square_type:
-                        sneks_to_kill.append(self.sneks[snek_id])
-                        continue
-                    # Head hit food square
-                    elif 32 < square_type:
-                        sneks_to_feed.append(self.sneks[snek_id])
-
-        sneks_to_feed = [s for s in sneks_to_feed if s not in set(sneks_to_kill)] # snek
-
-        for snek in sneks_to_kill:
-            self.kill_snek(snek, OTHER)
-
-        for snek in sneks_to_feed:
-            self._feed_snek(snek)
-
-        self._commit_sneks()
-        self._spawn_food()
-
-    def _commit_sneks(self):
-        for snek in self.sneks.values():
-            for block in snek.blocks:
-                x = block[1]
-                y = block[2]
-                self.board[y][x] = block[0]
-
-    def broadcast(self, msg):
-        for snek in self.sneks.values():
-            snek.transport.write(msg)
+    def __init__(self, lobby, arena_id, width=MAX_X, height=MAX_Y, max_sneks=MAX_SNEKS, tps=TICKS_PER_SECOND, seed=None):
+        self.lobby = lobby
+        self.arena_id = arena_id
+        self.width = width
+        self.height = height
+        self.max_sneks = max_sneks
+        self.game = SnekGame(width, height, max_sneks, seed)
+        self.board = self.game.board
+        self.sneks = self.game.sneks
+
+        # The client playing each snek, by snek id, and the clients watching
+        self.clients = dict()
+        self.spectators = set()
+
+        # The squares that changed in each of the last few ticks, for UDP states
+        self.tick_number = 0
+        self.history = deque(maxlen=UDP_HISTORY_TICKS)
+
+        # Tick stats, see update_periodically
+        self.tps = tps
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+
+        # Metrics live on in the lobby after the arena closes, and carry on if its id is reused
+        metrics = lobby.metrics
+        labels = (('arena', arena_id),)
+        self.tick_time = metrics.histogram('snek_tick_seconds', 'Time spent in a tick', labels=labels)
+        self.phase_times = {phase: metrics.histogram('snek_tick_phase_seconds', 'Time spent in each part of a tick', labels=labels + (('phase', phase),))
+                            for phase in TICK_PHASES}
+        self.tick_writes = metrics.histogram('snek_tick_writes', 'Updates sent to clients in a tick', COUNT_BUCKETS, labels)
+        self.kills = {cause: metrics.counter('snek_kills_total', 'Sneks killed', labels + (('cause', name),))
+                      for cause, name in KILL_CAUSES.items()}
+        self.game.phase_times = self.phase_times
+
+        # The recorder gets every tick's broadcast, like a spectator
+        self.recorder = None
+        if lobby.record_dir:
+            self.recorder = SnekRecorder(self, lobby.record_dir, lobby.keyframe_ticks)
+            print("Recording arena {} to {}.".format(arena_id, self.recorder.path))
+
+        self.tick_task = asyncio.ensure_future(self.update_periodically())
+
+    def close(self):
+        self.tick_task.cancel()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def is_full(self):
+        return self.game.is_full()
+
+    # v1 only has a byte each for coordinates and squares
+    def speaks(self, version):
+        if PROTOCOL_V1 == version:
+            return V1_MAX_SNEKS >= self.max_sneks and V1_MAX_SIDE >= self.width and V1_MAX_SIDE >= self.height
+        return PROTOCOL_V2 == version
+
+    def spawn_snek(self, client):
+        snek = self.game.spawn_snek()
+        if snek:
+            self.clients[snek.snek_id] = client
+        return snek
 
     def kill_snek(self, snek, cause_of_death):
-        snek_id = snek.snek_id
-        for block in snek.blocks:
-            if (SQ_BLANK != block[0] and DISCONNECT == cause_of_death) or (snek.head_value != block[0] and DISCONNECT != cause_of_death):
-                x = block[1]
-                y = block[2]
-                if randint(0, 1):
-                    self.board[y][x] = SQ_SALT
-                    self.food_count += 1
-                else:
-                    self.board[y][x] = SQ_BLANK
-        msg = msg_info(INFO_TYPE_KILL, snek.snek_id)
-        self.broadcast(msg)
-        self.available_snek_ids.insert(0, snek.snek_id)
-        snek.die()
-        self.sneks.pop(snek.snek_id)
-
-    def _feed_snek(self, snek):
-        snek.eat()
-        tail = snek.blocks[-1]
-        self.board[tail[2]][tail[1]] = tail[0]
-        self.food_count -= 1
-
-    def _spawn_food(self):
-        min_food = max(len(self.sneks.keys()) * FOOD_MULTIPLIER, STARTING_MIN_FOOD)
-        while min_food > self.food_count:
-            food_type = choice(FOODS, p=FOOD_WEIGHTS)
-            x = randint(0, MAX_X - 1)
-            y = randint(0, MAX_Y - 1)
-            if SQ_BLANK == self.board[y][x]:
-                self.board[y][x] = food_type
-                self.food_count += 1
+        self.game.kill_snek(snek, cause_of_death)
+        self._announce_kills([snek.snek_id], cause_of_death)
+
+    # Everyone hears about a kill, the dead snek's client too, and then the client is let go
+    def _announce_kills(self, snek_ids, cause_of_death):
+        for snek_id in snek_ids:
+            self.broadcast(lambda version: msg_info(INFO_TYPE_KILL, snek_id, version))
+            self.kills[cause_of_death].value += 1
+            self.clients.pop(snek_id)
+
+        if snek_ids and not self.sneks:
+            self.lobby.arena_emptied(self)
+
+    # Encode a message once for each protocol version in use and send it to every client, spectators too
+    def broadcast(self, encode):
+        msgs = dict()
+        for client in self.watchers():
+            if client.version not in msgs:
+                msgs[client.version] = encode(client.version)
+            client.send(msgs[client.version])
+
+    def watchers(self):
+        if self.recorder:
+            return [*self.clients.values(), *self.spectators, self.recorder]
+        return [*self.clients.values(), *self.spectators]
+
+    # The part of the board a client needs to see, or None for all of it
+    def region_for(self, client):
+        if PROTOCOL_V1 == client.version or not client.snek or not client.snek.blocks:
+            return None
+
+        head = client.snek.blocks[0]
+        region_w = VIEW_W + REGION_STEP
+        region_h = VIEW_H + REGION_STEP
+        if self.width <= region_w and self.height <= region_h:
+            return None
+
+        x, width = 0, self.width
+        if self.width > region_w:
+            x, width = (head[1] - VIEW_W // 2) // REGION_STEP * REGION_STEP % self.width, region_w
+        y, height = 0, self.height
+        if self.height > region_h:
+            y, height = (head[2] - VIEW_H // 2) // REGION_STEP * REGION_STEP % self.height, region_h
+        return (x, y, width, height)
+
+    # Everything a client needs to draw from scratch
+    def msg_keyframe(self, client):
+        client.region = self.region_for(client)
+        if client.region:
+            return msg_region(self.board, client.region, self.sneks.values(), client.version, client.encodings)
+        return msg_board(self.board, self.sneks.values(), client.version, client.encodings)
+
+    # Clients that see the same part of the board and take the same encodings share one encoded update.
+    # A client whose head crossed into a new region gets a keyframe for just that region.
+    # Spectators see the whole board, so they share the update of clients on small boards.
+    # Encoding time is counted apart from the rest of the broadcast.
+    def broadcast_update(self, squares):
+        started = perf_counter()
+        encoding = 0
+        msgs = dict()
+        ys, xs = numpy.divmod(squares, self.width)
+        self.tick_number += 1
+        if self.lobby.udp:
+            self.history.append((self.tick_number, squares))
+
+        udp_clients = []
+        clients = self.watchers()
+        for client in clients:
+            if client.udp_addr:
+                udp_clients.append(client)
+                continue
+            region = self.region_for(client)
+            if region != client.region:
+                client.region = region
+                key = (MSG_TYPE_REGION, client.version, client.encodings, region)
+                if key not in msgs:
+                    encode_started = perf_counter()
+                    msgs[key] = msg_region(self.board, region, self.sneks.values(), client.version, client.encodings)
+                    encoding += perf_counter() - encode_started
+            else:
+                key = (MSG_TYPE_UPDATE, client.version, client.encodings, region)
+                if key not in msgs:
+                    encode_started = perf_counter()
+                    visible = squares
+                    if region:
+                        x, y, width, height = region
+                        visible = squares[((xs - x) % self.width < width) & ((ys - y) % self.height < height)]
+                    msgs[key] = msg_update(self.board, visible, self.sneks.values(), client.version, client.encodings, region)
+                    encoding += perf_counter() - encode_started
+
+            # Turns the tick just applied are acked ahead of the update that shows them
+            if client.input_seq != client.acked_seq:
+                client.acked_seq = client.input_seq
+                client.send(msg_ack(client.input_seq))
+            client.send_update(msgs[key])
+
+        if udp_clients:
+            encoding += self.send_states(udp_clients)
+
+        self.tick_writes.observe(len(clients))
+        self.phase_times['encode'].observe(encoding)
+        self.phase_times['broadcast'].observe(perf_counter() - started - encoding)
+
+    # Send this tick's state to clients on UDP. Frames are shared by every
+    # client with the same base tick, region and encodings. Returns the time spent encoding.
+    def send_states(self, clients):
+        now = perf_counter()
+        encoding = 0
+        frames = dict()
+        for client in clients:
+            if UDP_TIMEOUT < now - client.udp_heard:
+                client.udp_fallback()
+                client.send_update(self.msg_keyframe(client))
+                continue
+
+            region = self.region_for(client)
+            base_tick = client.udp_sent.get(client.udp_acked)
+            keyframe = region != client.region or base_tick is None or client.udp_acked < client.udp_keyframe or \
+                       not self.history or base_tick < self.history[0][0] - 1 or \
+                       UDP_KEYFRAME_TICKS <= self.tick_number - client.udp_keyframe_tick
+
+            client.udp_seq += 1
+            client.udp_sent[client.udp_seq] = self.tick_number
+            client.udp_sent.pop(client.udp_seq - UDP_HISTORY_TICKS, None)
+
+            encode_started = perf_counter()
+            if keyframe:
+                client.region = region
+                client.udp_keyframe = client.udp_seq
+                client.udp_keyframe_tick = self.tick_number
+                key = (MSG_TYPE_REGION, client.encodings, region)
+                if key not in frames:
+                    if region:
+                        frames[key] = msg_region(self.board, region, self.sneks.values(), client.version, client.encodings)
+                    else:
+                        frames[key] = msg_board(self.board, self.sneks.values(), client.version, client.encodings)
+                base = 0
+            else:
+                key = (MSG_TYPE_UPDATE, client.encodings, region, base_tick)
+                if key not in frames:
+                    # Everything that changed since the base, filtered to the region
+                    squares = numpy.unique(numpy.concatenate([changed for tick, changed in self.history if tick > base_tick]))
+                    if region:
+                        x, y, width, height = region
+                        ys, xs = numpy.divmod(squares, self.width)
+                        squares = squares[((xs - x) % self.width < width) & ((ys - y) % self.height < height)]
+                    frames[key] = msg_update(self.board, squares, self.sneks.values(), client.version, client.encodings, region)
+                base = client.udp_acked
+            encoding += perf_counter() - encode_started
+
+            # The input acked is repeated in every state, in case one is lost
+            client.acked_seq = client.input_seq
+            client.send_state(msg_state(client.udp_seq, base, client.input_seq, frames[key]))
+        return encoding
 
     # This will advance the game one "tick" and tell the clients about it.
     def _tick(self):
-        self._cache_board()
-        self._slither_the_sneks()
-        msg = msg_update(self.board, self.last_board, self.sneks.values())
-        self.broadcast(msg)
-
-    # Caching the board from the last game tick enables sending 
-    # board updates to clients rather than the entire board.
-    def _cache_board(self):
-        self.last_board = deepcopy(self.board)
-
-@asyncio.coroutine
-def update_periodically():
-    while True:
-        yield from asyncio.sleep(1/TICKS_PER_SECOND)
-        SNEK_SERVER._tick()
+        started = perf_counter()
+        squares, killed = self.game.step()
+        self._announce_kills(killed, OTHER)
+        self.broadcast_update(squares)
+        self.tick_time.observe(perf_counter() - started)
+
+    # Ticks are due on a fixed schedule from the loop's monotonic clock, so
+    # time spent ticking doesn't stretch the period. A tick that ends past the
+    # next deadline is an overrun, and the ticks after it run back to back
+    # until the arena catches up. If it's more than MAX_CATCHUP_TICKS behind,
+    # the missed ticks are skipped instead and the schedule picks up from now.
+    async def update_periodically(self):
+        loop = asyncio.get_running_loop()
+        period = 1 / self.tps
+        deadline = loop.time() + period
+        while True:
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            self._tick()
+            self.ticks += 1
+
+            deadline += period
+            late = loop.time() - deadline
+            if late > 0:
+                self.overruns += 1
+                behind = int(late / period)
+                if behind > MAX_CATCHUP_TICKS:
+                    self.skipped_ticks += behind
+                    deadline += behind * period
+
+async def serve(args):
+    # Each arena ticks on its own once it's opened
+    lobby = SnekLobby(args["arenas"], args["width"], args["height"], args["arena_sneks"], args["tps"], args["seed"],
+                      args["record_dir"], args["keyframe_ticks"])
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: SnekProtocol(lobby), args["addr"], args["port"])
+
+    print('Serving on {}:{}'.format(*server.sockets[0].getsockname()))
+
+    # Clients can ask for their ticks over UDP instead
+    if args["udp_port"]:
+        lobby.udp, protocol = await loop.create_datagram_endpoint(lambda: SnekUdpProtocol(lobby), (args["addr"], args["udp_port"]))
+        lobby.udp_port = lobby.udp.get_extra_info('sockname')[1]
+        print('UDP on {}:{}'.format(args["addr"], lobby.udp_port))
+
+    # Browsers get the web client and a WebSocket to play over
+    if args["web_port"]:
+        web = await snek_web.serve(lambda: SnekProtocol(lobby), args["addr"], args["web_port"])
+        print('Web on {}:{}'.format(*web.sockets[0].getsockname()))
+
+    # Metrics are only served locally
+    if args["stats_port"]:
+        stats = await lobby.metrics.serve(STATS_ADDR, args["stats_port"])
+        print('Stats on {}:{}'.format(*stats.sockets[0].getsockname()))
+
+    # SIGTERM stops the server like ^C does. Either way the arenas are
+    # closed, so their recordings are written out.
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for arena in list(lobby.arenas.values()):
+            arena.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Server settings")
     parser.add_argument("--addr", default="127.0.0.1", type=str)
     parser.add_argument("--port", default=55555, type=int)
+    parser.add_argument("--arenas", default=MAX_ARENAS, type=int)
+    parser.add_argument("--width", default=MAX_X, type=int)
+    parser.add_argument("--height", default=MAX_Y, type=int)
+    parser.add_argument("--arena-sneks", default=MAX_SNEKS, type=int)
+    parser.add_argument("--tps", default=TICKS_PER_SECOND, type=float)
+    parser.add_argument("--stats-port", default=0, type=int)
+    parser.add_argument("--udp-port", default=0, type=int, help="port for the UDP state channel, off if 0")
+    parser.add_argument("--web-port", default=0, type=int, help="port for browsers to play on, off if 0")
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("--record-dir", default=None, type=str, help="directory to record every arena to, off if not given")
+    parser.add_argument("--keyframe-ticks", default=KEYFRAME_TICKS, type=int, help="ticks between keyframes in recordings")
     args = vars(parser.parse_args())
 
-    # Initialize the server.
-    sneks = dict()
-    available_snek_ids = [i for i in range(MAX_SNEKS-1, -1, -1)]
-    board = [[0 for i in range(MAX_X)] for j in range(MAX_Y)]
+    if not 1 <= args["arenas"] <= MAX_ARENAS:
+        parser.error("--arenas must be from 1 to {}".format(MAX_ARENAS))
 
-    SNEK_SERVER = SnekServer(sneks, available_snek_ids, board)
+    # Sides go out in 16 bits, and regions step across the board REGION_STEP squares at a time
+    for side in ("width", "height"):
+        if not REGION_STEP <= args[side] <= 0xffff:
+            parser.error("--{} must be from {} to {}".format(side, REGION_STEP, 0xffff))
 
-    # Run the server.
-    loop = asyncio.get_event_loop()
-    coro = loop.create_server(lambda: SnekProtocol(sneks, available_snek_ids, board), args["addr"], args["port"])
-    server = loop.run_until_complete(coro)
+    if args["arena_sneks"] > MAX_SNEKS_V2:
+        parser.error("an arena can hold at most {} sneks".format(MAX_SNEKS_V2))
+
+    if args["tps"] <= 0:
+        parser.error("--tps must be positive")
+
+    # It goes in a 16-bit field of the recording's header
+    if not 1 <= args["keyframe_ticks"] <= 0xffff:
+        parser.error("--keyframe-ticks must be from 1 to {}".format(0xffff))
+
+    if args["record_dir"] and not os.path.isdir(args["record_dir"]):
+        parser.error("--record-dir {} is not a directory".format(args["record_dir"]))
 
-    print('Serving on {}:{}'.format(*server.sockets[0].getsockname()))
-    asyncio.async(update_periodically())
     try:
-        loop.run_forever()
-    except KeyboardInterrupt:
+        asyncio.run(serve(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
-
-    server.close()
-    loop.run_until_complete(server.wait_closed())
-    loop.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Headless load generator. Opens a swarm of bots against a real snek server,
+# each joining, steering with a policy and respawning when it's killed, then
+# reports how the ticks arrived, how long turns took to show up in updates,
+# what every bot received and how many joins were turned away.
+
+import asyncio
+import argparse
+import random
+import numpy
+
+from snek_pkts import *
+from snek_decode import *
+
+TICKS_PER_SECOND = 7
+MAX_X = 80
+MAX_Y = 40
+
+# Sneks in the direction they'd go to get from one head to the next, by (dx, dy)
+MOVES = {(0, -1): NORTH, (1, 0): EAST, (0, 1): SOUTH, (-1, 0): WEST}
+
+# Policies pick a direction to turn to after each tick, or None to carry on.
+# They only turn sideways, as the server ignores turning back on yourself.
+def policy_straight(bot):
+    return None
+
+def policy_random(bot):
+    if bot.swarm.rng.random() < bot.swarm.turn_chance:
+        return (bot.direction + bot.swarm.rng.choice((1, 3))) % 4
+    return None
+
+def policy_circle(bot):
+    if 0 == bot.ticks % bot.swarm.turn_every:
+        return (bot.direction + 1) % 4
+    return None
+
+POLICIES = {
+    'straight': policy_straight,
+    'random': policy_random,
+    'circle': policy_circle,
+}
+
+class SnekBot(asyncio.Protocol):
+    def __init__(self, swarm):
+        self.swarm = swarm
+        self.transport = None
+        self.reader = FrameReader(swarm.version)
+        self.snek_id = None
+        self.width = swarm.width
+        self.height = swarm.height
+        self.head = None
+        self.direction = None
+        self.ticks = 0
+        self.last_tick = None
+        self.keyframe_pending = False
+        self.turn = None # (direction, when it was sent)
+        self.bytes_received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.swarm.bots.append(self)
+        self.join()
+
+    def connection_lost(self, exc):
+        if not self.swarm.done:
+            self.swarm.lost += 1
+
+    def join(self):
+        if self.transport.is_closing():
+            return
+        if PROTOCOL_V1 == self.swarm.version:
+            self.transport.write(JOIN_REQUEST)
+        else:
+            self.transport.write(CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, 0))
+
+    def send_turn(self, direction):
+        if PROTOCOL_V1 == self.swarm.version:
+            self.transport.write(bytes([self.snek_id, direction]))
+        else:
+            self.transport.write(CLIENT_MSG_V2.pack(self.snek_id, direction, 0))
+        self.turn = (direction, self.swarm.loop.time())
+
+    def data_received(self, data):
+        self.bytes_received += len(data)
+        self.reader.feed(data)
+        for msg_type, body in self.reader.frames():
+            if MSG_TYPE_JOIN == msg_type:
+                self._joined(*unpack_join(body, self.swarm.version))
+            elif MSG_TYPE_INFO == msg_type:
+                self._info(*unpack_info(body, self.swarm.version))
+            else:
+                self._frame(msg_type, body)
+
+    def _joined(self, snek_id, width=None, height=None):
+        if snek_id == (JOIN_REJECT if PROTOCOL_V1 == self.swarm.version else JOIN_REJECT_V2):
+            self.swarm.rejects += 1
+            return
+        self.swarm.joins += 1
+        self.snek_id = snek_id
+        if width:
+            self.width = width
+            self.height = height
+        self.head = None
+        self.direction = None
+        self.turn = None
+        self.keyframe_pending = True
+
+    def _info(self, info_type, snek_id):
+        if INFO_TYPE_KILL == info_type and snek_id == self.snek_id:
+            self.swarm.deaths += 1
+            self.snek_id = None
+            self.last_tick = None
+            self.swarm.loop.call_later(self.swarm.respawn_delay, self.join)
+
+    def _frame(self, msg_type, body):
+        now = self.swarm.loop.time()
+        square = LAYOUTS[self.swarm.version][2]
+        sneks, payload = split_frame(body, self.swarm.version)
+
+        # Ticks are timed from one to the next while the snek is alive.
+        # Whole boards come after joins and resyncs, off the tick schedule.
+        if MSG_TYPE_BOARD == msg_type or self.keyframe_pending:
+            self.keyframe_pending = False
+            self.last_tick = None
+        else:
+            if self.last_tick is not None:
+                self.swarm.tick_intervals.append(now - self.last_tick)
+            self.last_tick = now
+
+        if self.snek_id is None:
+            return
+
+        head_value = snek_head_square(self.snek_id)
+        head = None
+        if MSG_TYPE_BOARD == msg_type:
+            found = numpy.flatnonzero(numpy.frombuffer(payload, dtype=square) == head_value)
+            if len(found):
+                head = (int(found[0]) % self.width, int(found[0]) // self.width)
+        elif MSG_TYPE_REGION == msg_type:
+            x, y, width, height = REGION.unpack_from(payload)
+            found = numpy.flatnonzero(numpy.frombuffer(payload[REGION.size:], dtype=square) == head_value)
+            if len(found):
+                head = ((x + int(found[0]) % width) % self.width, (y + int(found[0]) // width) % self.height)
+        elif MSG_TYPE_UPDATE == msg_type:
+            changes = numpy.frombuffer(payload, dtype=square).reshape(-1, 3)
+            found = numpy.flatnonzero(changes[:, 2] == head_value)
+            if len(found):
+                head = (int(changes[found[-1], 0]), int(changes[found[-1], 1]))
+
+        if head is None or head == self.head:
+            return
+        if self.head:
+            dx = (head[0] - self.head[0] + 1) % self.width - 1
+            dy = (head[1] - self.head[1] + 1) % self.height - 1
+            self.direction = MOVES.get((dx, dy), self.direction)
+        self.head = head
+        self.ticks += 1
+
+        # The turn showed up, that's the whole round trip
+        if self.turn and self.turn[0] == self.direction:
+            self.swarm.latencies.append(now - self.turn[1])
+            self.turn = None
+
+        if self.direction is not None and not self.turn:
+            direction = self.swarm.policy(self)
+            if direction is not None:
+                self.send_turn(direction)
+
+class SnekSwarm():
+    def __init__(self, args):
+        self.version = args.protocol
+        self.width = args.width
+        self.height = args.height
+        self.policy = POLICIES[args.policy]
+        self.turn_chance = args.turn_chance
+        self.turn_every = args.turn_every
+        self.respawn_delay = args.respawn_delay
+        self.rng = random.Random(args.seed)
+        self.loop = None
+        self.done = False
+
+        self.bots = list()
+        self.joins = 0
+        self.rejects = 0
+        self.deaths = 0
+        self.lost = 0
+        self.connect_errors = 0
+        self.tick_intervals = list()
+        self.latencies = list()
+
+    async def run(self, addr, port, bots, ramp, duration):
+        self.loop = asyncio.get_running_loop()
+        for i in range(bots):
+            try:
+                await self.loop.create_connection(lambda: SnekBot(self), addr, port)
+            except OSError:
+                self.connect_errors += 1
+            await asyncio.sleep(ramp / bots)
+        await asyncio.sleep(duration)
+        self.done = True
+        for bot in self.bots:
+            bot.transport.close()
+
+    def report(self, tps):
+        period = 1 / tps
+        print('bots {} joins {} rejects {} deaths {} connect errors {} lost {}'.format(
+            len(self.bots), self.joins, self.rejects, self.deaths, self.connect_errors, self.lost))
+        _print_stats('tick interval ms', self.tick_intervals, 1000)
+        _print_stats('tick jitter ms', [abs(interval - period) for interval in self.tick_intervals], 1000)
+        _print_stats('turn latency ms', self.latencies, 1000)
+        _print_stats('bytes per bot', [bot.bytes_received for bot in self.bots], 1)
+
+def _print_stats(name, values, scale):
+    if not values:
+        print('{:<18} no samples'.format(name))
+        return
+    values = numpy.asarray(values) * scale
+    p50, p90, p99 = numpy.percentile(values, (50, 90, 99))
+    print('{:<18} n {:<8} mean {:<10.2f} p50 {:<10.2f} p90 {:<10.2f} p99 {:<10.2f} max {:.2f}'.format(
+        name, len(values), values.mean(), p50, p90, p99, values.max()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snek bot swarm")
+    parser.add_argument("--addr", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=55555, type=int)
+    parser.add_argument("--bots", default=100, type=int)
+    parser.add_argument("--protocol", default=PROTOCOL_V1, type=int, choices=[PROTOCOL_V1, PROTOCOL_V2])
+    parser.add_argument("--policy", default="random", choices=sorted(POLICIES))
+    parser.add_argument("--turn-chance", default=0.2, type=float)
+    parser.add_argument("--turn-every", default=5, type=int)
+    parser.add_argument("--respawn-delay", default=0.5, type=float)
+    parser.add_argument("--ramp", default=1.0, type=float)
+    parser.add_argument("--duration", default=30.0, type=float)
+    parser.add_argument("--tps", default=TICKS_PER_SECOND, type=float)
+    # v1 joins don't carry the board size
+    parser.add_argument("--width", default=MAX_X, type=int)
+    parser.add_argument("--height", default=MAX_Y, type=int)
+    parser.add_argument("--seed", default=None, type=int)
+    args = parser.parse_args()
+
+    swarm = SnekSwarm(args)
+    try:
+        asyncio.run(swarm.run(args.addr, args.port, args.bots, args.ramp, args.duration))
+    except KeyboardInterrupt:
+        pass
+    swarm.report(args.tps)
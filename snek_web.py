@@ -0,0 +1,237 @@
+# Browsers play straight off the server's event loop. A SnekWebSocket
+# answers plain HTTP GETs with the static files in web/, and upgrades
+# requests for WS_PATH to an RFC 6455 WebSocket. After that it carries the
+# same binary protocol as the TCP port, a client message per binary frame
+# one way and a server write per binary frame the other, for a snek
+# protocol that can't tell it isn't talking to a socket.
+
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+
+WS_PATH = b'/snek'
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Opcodes
+OP_CONTINUATION = 0x0
+OP_TEXT         = 0x1
+OP_BINARY       = 0x2
+OP_CLOSE        = 0x8
+OP_PING         = 0x9
+OP_PONG         = 0xa
+
+# Limits
+MAX_REQUEST_HEAD = 8 * 1024
+MAX_MESSAGE      = 64 * 1024
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web')
+CONTENT_TYPES = {
+    '.html': b'text/html; charset=utf-8',
+    '.js': b'text/javascript; charset=utf-8',
+    '.css': b'text/css; charset=utf-8',
+    '.png': b'image/png',
+}
+
+# The static files by path, read once when the server starts. Only these are ever served.
+def load_static(static_dir=STATIC_DIR):
+    files = dict()
+    for name in sorted(os.listdir(static_dir)):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1])
+        if content_type:
+            with open(os.path.join(static_dir, name), 'rb') as f:
+                files[b'/' + name.encode()] = (content_type, f.read())
+    if b'/index.html' in files:
+        files[b'/'] = files[b'/index.html']
+    return files
+
+# Frame a message to a browser. Server frames are never masked.
+def ws_frame(opcode, payload):
+    length = len(payload)
+    if 126 > length:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif 0xffff >= length:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+# Browser frames are always masked, xor the payload with the key a word at a time
+def ws_unmask(mask, payload):
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+# What a snek protocol writes to, in place of the socket
+class WebSocketTransport():
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.transport = websocket.transport
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.transport.set_write_buffer_limits(high, low)
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size()
+
+    def write(self, data):
+        self.transport.write(ws_frame(OP_BINARY, data))
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def close(self):
+        self.websocket.close(1000)
+
+    def abort(self):
+        self.transport.abort()
+
+class SnekWebSocket(asyncio.Protocol):
+    def __init__(self, client_factory, static):
+        self.client_factory = client_factory
+        self.static = static
+        self.transport = None
+        self.inbuf = bytearray()
+        self.client = None
+
+        # The pieces of a fragmented message, and its opcode
+        self.fragments = []
+        self.fragment_op = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.client:
+            self.client.connection_lost(exc)
+
+    def pause_writing(self):
+        if self.client:
+            self.client.pause_writing()
+
+    def resume_writing(self):
+        if self.client:
+            self.client.resume_writing()
+
+    def data_received(self, data):
+        self.inbuf += data
+        if self.client:
+            self._read_frames()
+            return
+
+        end = self.inbuf.find(b'\r\n\r\n')
+        if 0 > end:
+            if MAX_REQUEST_HEAD < len(self.inbuf):
+                self._respond(b'431 Request Header Fields Too Large')
+            return
+        head = bytes(self.inbuf[:end])
+        del self.inbuf[:end + 4]
+        self._handle_request(head)
+
+    def _handle_request(self, head):
+        lines = head.split(b'\r\n')
+        request = lines[0].split()
+        if 3 != len(request) or b'GET' != request[0]:
+            self._respond(b'400 Bad Request')
+            return
+        path = request[1].split(b'?')[0]
+        headers = dict()
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+        if WS_PATH == path:
+            key = headers.get(b'sec-websocket-key')
+            if b'websocket' != headers.get(b'upgrade', b'').lower() or not key:
+                self._respond(b'400 Bad Request')
+                return
+            accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+            self.transport.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                                 b'Upgrade: websocket\r\n'
+                                 b'Connection: Upgrade\r\n'
+                                 b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+            # From here on it's a snek client
+            self.client = self.client_factory()
+            self.client.connection_made(WebSocketTransport(self))
+            self._read_frames()
+            return
+
+        if path not in self.static:
+            self._respond(b'404 Not Found')
+            return
+        content_type, body = self.static[path]
+        self._respond(b'200 OK', content_type, body)
+
+    def _respond(self, status, content_type=b'text/plain', body=b''):
+        if not body:
+            body = status + b'\n'
+        self.transport.write(b'HTTP/1.0 ' + status + b'\r\n'
+                             b'Content-Type: ' + content_type + b'\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        self.transport.close()
+
+    # Take every complete frame off the buffer
+    def _read_frames(self):
+        while not self.transport.is_closing():
+            buf = self.inbuf
+            if 2 > len(buf):
+                return
+            fin = buf[0] & 0x80
+            opcode = buf[0] & 0x0f
+            masked = buf[1] & 0x80
+            length = buf[1] & 0x7f
+            offset = 2
+            if 126 == length:
+                if 4 > len(buf):
+                    return
+                length = struct.unpack_from('!H', buf, 2)[0]
+                offset = 4
+            elif 127 == length:
+                if 10 > len(buf):
+                    return
+                length = struct.unpack_from('!Q', buf, 2)[0]
+                offset = 10
+
+            # Browsers have to mask, and nobody needs to send us anything big
+            if not masked or MAX_MESSAGE < length + sum(len(fragment) for fragment in self.fragments):
+                self.close(1002 if not masked else 1009)
+                return
+            if len(buf) < offset + 4 + length:
+                return
+            payload = ws_unmask(bytes(buf[offset:offset + 4]), bytes(buf[offset + 4:offset + 4 + length]))
+            del buf[:offset + 4 + length]
+            self._handle_frame(fin, opcode, payload)
+
+    def _handle_frame(self, fin, opcode, payload):
+        if OP_PING == opcode:
+            self.transport.write(ws_frame(OP_PONG, payload))
+        elif OP_CLOSE == opcode:
+            self.close(1000)
+        elif OP_PONG == opcode:
+            pass
+        else:
+            # Messages can come in pieces, the first says what they are
+            if OP_CONTINUATION != opcode:
+                self.fragment_op = opcode
+            self.fragments.append(payload)
+            if fin:
+                message = b''.join(self.fragments)
+                self.fragments = []
+                if OP_BINARY == self.fragment_op:
+                    self.client.data_received(message)
+
+    def close(self, code):
+        if not self.transport.is_closing():
+            self.transport.write(ws_frame(OP_CLOSE, struct.pack('!H', code)))
+            self.transport.close()
+
+# Serve browsers on the loop, with a new snek client from client_factory for each WebSocket
+async def serve(client_factory, host, port, static_dir=STATIC_DIR):
+    static = load_static(static_dir)
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: SnekWebSocket(client_factory, static), host, port)
@@ -0,0 +1,26 @@
+# Stand-ins for the sockets the server and clients talk over
+
+ADDR = ('127.0.0.1', 40000)
+
+class FakeTransport():
+    def __init__(self):
+        self.out = bytearray()
+        self.closing = False
+
+    def get_extra_info(self, name, default=None):
+        return ADDR
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write(self, data):
+        self.out += data
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
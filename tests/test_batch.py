@@ -0,0 +1,73 @@
+import random
+import numpy
+import pytest
+
+from snek_pkts import *
+from snek_game import SnekGame, SQ_SALT
+from snek_batch import SnekBatch
+
+WIDTH = 60
+HEIGHT = 40
+SNEKS = 6
+TICKS = 300
+
+# The batch draws from numpy's RNG and the game from Python's, so the same
+# seed doesn't give the same spawns, food or salt. The batch takes the game's
+# spawns and food instead, no new food is spawned, and the dead leave blanks.
+class NoSalt():
+    def __init__(self, rng):
+        self.rng = rng
+
+    def random(self, size):
+        return numpy.ones(size)
+
+    def __getattr__(self, name):
+        return getattr(self.rng, name)
+
+def lockstep_pair(seed):
+    game = SnekGame(WIDTH, HEIGHT, SNEKS, seed)
+    game._spawn_food = lambda: None
+    for i in range(SNEKS):
+        game.spawn_snek()
+    game.rng.randint = lambda a, b: 0
+
+    batch = SnekBatch(1, WIDTH, HEIGHT, SNEKS, seed)
+    batch._spawn_food = lambda: None
+    batch.reset()
+    batch.rng = NoSalt(batch.rng)
+    batch.boards[:] = SQ_BLANK
+    for snek_id, snek in game.sneks.items():
+        x, y, direction = snek.blocks[0][1:]
+        batch.body[0, snek_id, 0] = y * WIDTH + x
+        batch.direction[0, snek_id] = direction
+        batch.boards[0, y, x] = snek.head_value
+        game._set_square(x, y, snek.head_value)
+
+    rng = random.Random(seed)
+    for i in range(60):
+        x, y = rng.randrange(WIDTH), rng.randrange(HEIGHT)
+        if SQ_BLANK == game.board[y, x]:
+            game._set_square(x, y, SQ_SALT)
+            batch.boards[0, y, x] = SQ_SALT
+    return game, batch
+
+@pytest.mark.parametrize("seed", range(20))
+def test_batch_steps_like_game(seed):
+    game, batch = lockstep_pair(seed)
+    rng = random.Random(seed + 1000)
+    for tick in range(TICKS):
+        actions = numpy.full((1, SNEKS), -1)
+        for snek_id in range(SNEKS):
+            if rng.random() < 0.3:
+                actions[0, snek_id] = rng.randint(0, 3)
+        game.step([(snek_id, int(actions[0, snek_id])) for snek_id in range(SNEKS) if 0 <= actions[0, snek_id]])
+        boards, rewards, dones, info = batch.step(actions)
+
+        # A board whose sneks all died starts over, the game's is left empty
+        if dones[0]:
+            assert not game.sneks
+            return
+        assert (game.board == boards[0]).all(), tick
+        assert set(game.sneks) == set(numpy.flatnonzero(batch.alive[0]).tolist())
+        for snek_id, snek in game.sneks.items():
+            assert snek.score == info['scores'][0, snek_id]
@@ -0,0 +1,144 @@
+import numpy
+import pytest
+
+from snek_pkts import *
+from snek_decode import *
+
+WIDTH = 40
+HEIGHT = 24
+
+class Snek():
+    def __init__(self, snek_id, score):
+        self.snek_id = snek_id
+        self.score = score
+
+SNEKS = [Snek(0, 3), Snek(300, 12)]
+
+def random_board(seed, fill=0.5):
+    rng = numpy.random.default_rng(seed)
+    board = rng.integers(1, 600, size=(HEIGHT, WIDTH)).astype(numpy.uint16)
+    board[rng.random((HEIGHT, WIDTH)) >= fill] = SQ_BLANK
+    return board
+
+# The encoding, sneks and payload of a frame
+def unframe(msg):
+    sneks, payload = split_frame(memoryview(msg)[HEADER.size:], PROTOCOL_V2)
+    return payload[0], [snek[:2] for snek in sneks], payload[1:]
+
+def roundtrip_board(board, encodings):
+    encoding, sneks, payload = unframe(msg_board(board, SNEKS, PROTOCOL_V2, encodings))
+    assert [(0, 3), (300, 12)] == sneks
+    return encoding, decode_squares(encoding, payload).reshape(board.shape)
+
+def roundtrip_update(board, squares, encodings, region=None):
+    encoding, sneks, payload = unframe(msg_update(board, squares, SNEKS, PROTOCOL_V2, encodings, region))
+    assert [(0, 3), (300, 12)] == sneks
+    area = region or (0, 0, WIDTH, HEIGHT)
+    xs, ys, values = decode_changes(encoding, payload, area, WIDTH, HEIGHT)
+    return encoding, xs, ys, values
+
+def assert_changes(board, squares, xs, ys, values):
+    ys_sent, xs_sent = numpy.divmod(squares, WIDTH)
+    assert sorted(zip(ys_sent.tolist(), xs_sent.tolist())) == sorted(zip(ys.tolist(), xs.tolist()))
+    assert (board[ys, xs] == values).all()
+
+# Each keyframe encoding wins on the board it's made for
+@pytest.mark.parametrize("encodings, board, expected", [
+    (ACCEPT_RLE, random_board(1, fill=1.0), ENC_RAW),
+    (ACCEPT_RLE, numpy.zeros((HEIGHT, WIDTH), dtype=numpy.uint16), ENC_RLE),
+    (ACCEPT_ZLIB, numpy.tile(numpy.arange(WIDTH, dtype=numpy.uint16), (HEIGHT, 1)), ENC_ZLIB),
+])
+def test_keyframe_encodings(encodings, board, expected):
+    encoding, decoded = roundtrip_board(board, encodings)
+    assert expected == encoding
+    assert (board == decoded).all()
+
+@pytest.mark.parametrize("encodings", [ACCEPT_RLE, ACCEPT_ZLIB, ACCEPT_ALL])
+@pytest.mark.parametrize("seed", range(5))
+def test_keyframe_roundtrip(encodings, seed):
+    board = random_board(seed, fill=seed / 5)
+    encoding, decoded = roundtrip_board(board, encodings)
+    assert (board == decoded).all()
+
+# RLE counts are 16 bits, so long runs are split
+def test_rle_long_runs():
+    board = numpy.zeros((400, 400), dtype=numpy.uint16)
+    board[399, 399] = 7
+    encoding, sneks, payload = unframe(msg_board(board, SNEKS, PROTOCOL_V2, ACCEPT_RLE))
+    assert ENC_RLE == encoding
+    assert (board.reshape(-1) == decode_squares(encoding, payload)).all()
+
+def test_region_roundtrip():
+    board = random_board(3)
+    region = (WIDTH - 8, HEIGHT - 5, 16, 10)
+    for encodings in (ACCEPT_RLE, ACCEPT_ZLIB, ACCEPT_ALL):
+        encoding, sneks, payload = unframe(msg_region(board, region, SNEKS, PROTOCOL_V2, encodings))
+        assert region == REGION.unpack_from(payload)
+        rows = (region[1] + numpy.arange(region[3])) % HEIGHT
+        columns = (region[0] + numpy.arange(region[2])) % WIDTH
+        expected = board[numpy.ix_(rows, columns)].reshape(-1)
+        assert (expected == decode_squares(encoding, payload[REGION.size:])).all()
+
+# Each update encoding wins on the changes it's made for
+@pytest.mark.parametrize("encodings, squares, expected", [
+    (ACCEPT_ALL, numpy.array([5, 200, 701]), ENC_RAW),
+    (ACCEPT_RUNS, numpy.arange(100, 140), ENC_RUNS),
+    (ACCEPT_BITMAP, numpy.arange(0, WIDTH * HEIGHT, 3), ENC_BITMAP),
+])
+def test_update_encodings(encodings, squares, expected):
+    board = random_board(2)
+    encoding, xs, ys, values = roundtrip_update(board, squares, encodings)
+    assert expected == encoding
+    assert_changes(board, squares, xs, ys, values)
+
+@pytest.mark.parametrize("encodings", [0, ACCEPT_RUNS, ACCEPT_BITMAP, ACCEPT_ALL])
+def test_update_empty(encodings):
+    board = random_board(4)
+    squares = numpy.zeros(0, dtype=numpy.intp)
+    if encodings:
+        encoding, xs, ys, values = roundtrip_update(board, squares, encodings)
+    else:
+        sneks, payload = split_frame(memoryview(msg_update(board, squares, SNEKS, PROTOCOL_V2))[HEADER.size:], PROTOCOL_V2)
+        xs, ys, values = decode_changes(ENC_RAW, payload, (0, 0, WIDTH, HEIGHT), WIDTH, HEIGHT)
+    assert 0 == len(xs) == len(ys) == len(values)
+
+# Every square changed. Runs stop at the end of each row.
+@pytest.mark.parametrize("encodings", [ACCEPT_RUNS, ACCEPT_BITMAP, ACCEPT_ALL])
+def test_update_full_board(encodings):
+    board = random_board(5, fill=1.0)
+    squares = numpy.arange(WIDTH * HEIGHT)
+    encoding, xs, ys, values = roundtrip_update(board, squares, encodings)
+    assert_changes(board, squares, xs, ys, values)
+
+# Changes either side of the board's edges, where a row ends and the next begins
+@pytest.mark.parametrize("encodings", [ACCEPT_RUNS, ACCEPT_BITMAP, ACCEPT_ALL])
+def test_update_wraps_edges(encodings):
+    board = random_board(6, fill=1.0)
+    squares = numpy.array(sorted({0, 1, WIDTH - 2, WIDTH - 1, WIDTH, WIDTH + 1,
+                                  (HEIGHT - 1) * WIDTH, WIDTH * HEIGHT - 2, WIDTH * HEIGHT - 1}))
+    encoding, xs, ys, values = roundtrip_update(board, squares, encodings)
+    assert_changes(board, squares, xs, ys, values)
+
+# A bitmap covers a region that wraps around the board's corner
+def test_update_bitmap_region_wraps():
+    board = random_board(7, fill=1.0)
+    region = (WIDTH - 6, HEIGHT - 4, 12, 8)
+    rows = (region[1] + numpy.arange(region[3])) % HEIGHT
+    columns = (region[0] + numpy.arange(region[2])) % WIDTH
+    squares = numpy.sort((rows[:, None] * WIDTH + columns[None, :]).reshape(-1)[::2])
+    for encodings in (ACCEPT_RUNS, ACCEPT_BITMAP, ACCEPT_ALL):
+        encoding, xs, ys, values = roundtrip_update(board, squares, encodings, region)
+        assert_changes(board, squares, xs, ys, values)
+    assert ENC_BITMAP == roundtrip_update(board, squares, ACCEPT_BITMAP, region)[0]
+
+# Messages without a header come out of the reader as the layout less the type byte
+def test_reader_unpacks_headerless():
+    reader = FrameReader(PROTOCOL_V2)
+    stream = msg_join_accept(300, PROTOCOL_V2, 500, 70) + msg_udp(123456, 5555) + msg_info(INFO_TYPE_KILL, 301, PROTOCOL_V2)
+    for i in range(0, len(stream), 3):
+        reader.feed(stream[i:i + 3])
+    frames = [(msg_type, bytes(body)) for msg_type, body in reader.frames()]
+    assert [MSG_TYPE_JOIN, MSG_TYPE_UDP, MSG_TYPE_INFO] == [msg_type for msg_type, body in frames]
+    assert (300, 500, 70) == unpack_join(frames[0][1], PROTOCOL_V2)
+    assert (123456, 5555) == unpack_udp(frames[1][1])
+    assert (INFO_TYPE_KILL, 301) == unpack_info(frames[2][1], PROTOCOL_V2)
@@ -0,0 +1,76 @@
+import asyncio
+
+import snek_server
+from snek_pkts import *
+from snek_decode import *
+from fakes import FakeTransport
+
+def connect(lobby, msg):
+    protocol = snek_server.SnekProtocol(lobby)
+    protocol.connection_made(FakeTransport())
+    protocol.data_received(msg)
+    return protocol
+
+def join(lobby):
+    return connect(lobby, CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, ACCEPT_ALL))
+
+def spectate(lobby, arena_id):
+    return connect(lobby, CLIENT_MSG_V2.pack(SPECTATE_V2, arena_id, ACCEPT_ALL))
+
+# The snek id the client was sent in its join
+def joined_as(protocol):
+    reader = FrameReader(PROTOCOL_V2)
+    reader.feed(bytes(protocol.transport.out))
+    msg_type, body = next(reader.frames())
+    assert MSG_TYPE_JOIN == msg_type
+    return unpack_join(body, PROTOCOL_V2)[0]
+
+def run(test):
+    async def wrapped():
+        lobby = snek_server.SnekLobby(2, 80, 40, 1, 20, seed=1)
+        try:
+            test(lobby)
+        finally:
+            for arena in list(lobby.arenas.values()):
+                arena.close()
+    asyncio.run(wrapped())
+
+# Arena 0 is where spectators and relays look by default, so it stays open when it empties
+def test_first_arena_stays_open():
+    def test(lobby):
+        first = join(lobby)
+        second = join(lobby)
+        assert snek_server.FIRST_ARENA == first.server.arena_id
+        assert 1 == second.server.arena_id
+
+        watcher = spectate(lobby, snek_server.FIRST_ARENA)
+        assert SPECTATE_V2 == joined_as(watcher)
+
+        # Both arenas are open when arena 0 empties
+        first.connection_lost(None)
+        assert snek_server.FIRST_ARENA in lobby.arenas
+        assert not watcher.transport.is_closing()
+        assert SPECTATE_V2 == joined_as(spectate(lobby, snek_server.FIRST_ARENA))
+
+        # The next join fills it again
+        assert snek_server.FIRST_ARENA == join(lobby).server.arena_id
+    run(test)
+
+# Other arenas close once empty and let their spectators go
+def test_other_arenas_close():
+    def test(lobby):
+        # Fills arena 0, so the next join opens arena 1
+        join(lobby)
+        second = join(lobby)
+        watcher = spectate(lobby, 1)
+        assert SPECTATE_V2 == joined_as(watcher)
+
+        second.connection_lost(None)
+        assert 1 not in lobby.arenas
+        assert watcher.transport.is_closing()
+
+        # Spectating a closed arena is turned away
+        rejected = spectate(lobby, 1)
+        assert JOIN_REJECT_V2 == joined_as(rejected)
+        assert rejected.transport.is_closing()
+    run(test)
@@ -0,0 +1,97 @@
+import asyncio
+import glob
+import os
+import random
+
+import pytest
+
+import snek_server
+from snek_pkts import *
+from snek_replay import SnekReplay, REPLAY_HEADER, REPLAY_RECORD
+from fakes import FakeTransport
+
+KEYFRAME_TICKS = 8
+TICKS = 40
+
+# Record an arena of turning sneks, and the board after every tick
+def record(record_dir):
+    boards = []
+    async def wrapped():
+        lobby = snek_server.SnekLobby(1, 80, 40, 8, 20, seed=1, record_dir=str(record_dir), keyframe_ticks=KEYFRAME_TICKS)
+        arena = lobby.arenas[0]
+        arena.tick_task.cancel()
+        boards.append(arena.board.copy())
+
+        rng = random.Random(2)
+        players = []
+        for tick in range(1, TICKS + 1):
+            if len(players) < 6:
+                player = snek_server.SnekProtocol(lobby)
+                player.connection_made(FakeTransport())
+                player.data_received(CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, ACCEPT_ALL))
+                players.append(player)
+            for player in players:
+                if player.snek and player.snek.blocks and rng.random() < 0.3:
+                    player.data_received(CLIENT_MSG_V2.pack(player.snek.snek_id, rng.randint(0, 3), 0))
+            arena._tick()
+            boards.append(arena.board.copy())
+        arena.close()
+    asyncio.run(wrapped())
+    path, = glob.glob(os.path.join(str(record_dir), '*.snek'))
+    return path, boards
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    return record(tmp_path_factory.mktemp("replays"))
+
+# Before, on and after keyframes, and the last tick
+@pytest.mark.parametrize("tick", [1, KEYFRAME_TICKS - 1, KEYFRAME_TICKS, KEYFRAME_TICKS + 1, 3 * KEYFRAME_TICKS + 5, TICKS])
+def test_seek_matches_arena(recording, tick):
+    path, boards = recording
+    replay = SnekReplay(path)
+    assert TICKS == replay.last_tick
+    replay.seek(tick)
+    assert tick == replay.tick
+    assert (boards[tick] == replay.board).all()
+    replay.close()
+
+def test_step_matches_arena(recording):
+    path, boards = recording
+    replay = SnekReplay(path)
+    replay.seek(0)
+    for tick in range(1, TICKS + 1):
+        assert replay.step() is not None
+        assert (boards[tick] == replay.board).all()
+    assert replay.step() is None
+    replay.close()
+
+# A log cut off in the middle of a record is indexed again up to the last whole tick
+def test_cut_off_log(recording, tmp_path):
+    path, boards = recording
+    data = open(path, 'rb').read()
+    replay = SnekReplay(path)
+    middle = int(replay.index[TICKS // 2]) + REPLAY_RECORD.size + 3
+    replay.close()
+
+    cut = tmp_path / os.path.basename(path)
+    cut.write_bytes(data[:middle])
+    cut.with_suffix('.idx').write_bytes(open(os.path.splitext(path)[0] + '.idx', 'rb').read())
+    replay = SnekReplay(str(cut))
+    assert TICKS // 2 - 1 == replay.last_tick
+    replay.seek(replay.last_tick)
+    assert (boards[replay.last_tick] == replay.board).all()
+    replay.close()
+
+def test_empty_log(tmp_path):
+    path = tmp_path / 'empty.snek'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        SnekReplay(str(path))
+
+# A header and no whole first keyframe has nothing to seek from
+def test_log_without_keyframe(recording, tmp_path):
+    path, boards = recording
+    cut = tmp_path / 'cut.snek'
+    cut.write_bytes(open(path, 'rb').read()[:REPLAY_HEADER.size + REPLAY_RECORD.size])
+    with pytest.raises(ValueError):
+        SnekReplay(str(cut))
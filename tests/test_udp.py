@@ -0,0 +1,163 @@
+import asyncio
+
+import client
+import snek_server
+from snek_pkts import *
+from snek_decode import *
+from fakes import ADDR, FakeTransport
+
+# The server's UDP endpoint, holding on to the states it sends
+class FakeServerUdp():
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+# The client's UDP socket. Acks go straight to the server, unless they're lost.
+class FakeClientUdp():
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.lose = False
+        self.acks = []
+
+    def send(self, data):
+        token, seq = UDP_ACK.unpack(data)
+        self.acks.append(seq)
+        if not self.lose:
+            self.protocol.udp_received(ADDR, seq)
+
+# A v2 client on the UDP channel of a one-arena lobby whose ticks are run by hand
+class Channel():
+    def __init__(self):
+        self.lobby = snek_server.SnekLobby(1, 80, 40, 4, 20, seed=1)
+        self.lobby.udp = FakeServerUdp()
+        self.lobby.udp_port = 40001
+        self.arena = self.lobby.arenas[0]
+        self.arena.tick_task.cancel()
+
+        self.protocol = snek_server.SnekProtocol(self.lobby)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+
+        self.game = client.game()
+        self.game.my_snek = client.snek()
+        self.game.udp = FakeClientUdp(self.protocol)
+        self.reader = FrameReader(PROTOCOL_V2)
+        self.protocol.data_received(CLIENT_MSG_V2.pack(JOIN_REQUEST_V2, PROTOCOL_V2, ACCEPT_ALL | JOIN_UDP))
+        self.read_tcp()
+
+    # Everything the server wrote over TCP. The UDP info gets the hello out.
+    def read_tcp(self):
+        self.reader.feed(bytes(self.transport.out))
+        self.transport.out.clear()
+        for msg_type, msg in self.reader.frames():
+            client.handle_msg(self.game, msg_type, msg)
+
+    # Run a tick and return the state it sent
+    def tick(self):
+        self.arena._tick()
+        self.read_tcp()
+        assert 1 == len(self.lobby.udp.sent)
+        return self.lobby.udp.sent.pop()
+
+    def deliver(self, state):
+        self.game.process_state(state)
+
+    def synced(self):
+        return (self.game.board_buff == self.arena.board).all()
+
+def run(test):
+    async def wrapped():
+        test(Channel())
+    asyncio.run(wrapped())
+
+def header(state):
+    seq, base, input_seq = UDP_STATE.unpack_from(state)
+    return seq, base
+
+def test_delta_from_last_acked():
+    def test(channel):
+        assert ADDR == channel.protocol.udp_addr
+
+        # The first state is a keyframe, then each is the changes since the last one acked
+        state = channel.tick()
+        assert (1, 0) == header(state)
+        channel.deliver(state)
+        assert channel.synced()
+        for seq in range(2, 6):
+            state = channel.tick()
+            assert (seq, seq - 1) == header(state)
+            channel.deliver(state)
+            assert channel.synced()
+            assert seq == channel.game.udp_seq
+
+        # With acks lost, the server keeps building on the last state it heard about
+        channel.game.udp.lose = True
+        for seq in range(6, 10):
+            state = channel.tick()
+            assert (seq, 5) == header(state)
+            channel.deliver(state)
+            assert channel.synced()
+
+        # One ack gets through and the base moves up to it
+        channel.game.udp.lose = False
+        channel.game.send_udp_ack()
+        state = channel.tick()
+        assert (10, 9) == header(state)
+        channel.deliver(state)
+        assert channel.synced()
+    run(test)
+
+def test_stale_and_unusable_states_are_dropped():
+    def test(channel):
+        first = channel.tick()
+        channel.deliver(first)
+        second = channel.tick()
+        third = channel.tick()
+
+        # third is based on the first, so it applies without the second
+        assert (3, 1) == header(third)
+        channel.deliver(third)
+        assert channel.synced()
+
+        # the second arriving late is older than what's been applied
+        board = channel.game.board_buff.copy()
+        channel.deliver(second)
+        assert 3 == channel.game.udp_seq
+        assert (board == channel.game.board_buff).all()
+    run(test)
+
+def test_recovers_from_lost_keyframe():
+    def test(channel):
+        # Keyframes keep coming until one is acked
+        lost = channel.tick()
+        assert (1, 0) == header(lost)
+        state = channel.tick()
+        assert (2, 0) == header(state)
+
+        # The next one is acked, so changes are built on it from then on
+        channel.deliver(state)
+        assert channel.synced()
+        state = channel.tick()
+        assert (3, 2) == header(state)
+        channel.deliver(state)
+        assert channel.synced()
+
+        # A lost delta doesn't matter, the next one is still from the last ack
+        channel.tick()
+        state = channel.tick()
+        assert (5, 3) == header(state)
+        channel.deliver(state)
+        assert channel.synced()
+
+        # Without any acks, the client ages out of the server's history and gets a keyframe
+        channel.game.udp.lose = True
+        for i in range(snek_server.UDP_HISTORY_TICKS + 1):
+            state = channel.tick()
+        channel.game.udp.lose = False
+        seq, base = header(state)
+        assert 0 == base
+        channel.deliver(state)
+        assert channel.synced()
+    run(test)
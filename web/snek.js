@@ -0,0 +1,388 @@
+// The snek client for browsers. It speaks protocol v2 to the server's web
+// port over a WebSocket, and draws the board on a canvas the way client.py
+// draws it in a terminal: a view of VIEW_W x VIEW_H squares that follows
+// our snek around, redrawing only the squares that changed.
+'use strict';
+
+const MSG_TYPE_JOIN = 0;
+const MSG_TYPE_BOARD = 1;
+const MSG_TYPE_UPDATE = 2;
+const MSG_TYPE_INFO = 3;
+const MSG_TYPE_TXT = 4;
+const MSG_TYPE_REGION = 5;
+const MSG_TYPE_ACK = 6;
+
+const INFO_TYPE_JOIN = 0;
+const INFO_TYPE_KILL = 1;
+
+const PROTOCOL_V2 = 2;
+const JOIN_REQUEST_V2 = 0xfffe;
+const JOIN_REJECT_V2 = 0xffff;
+const SPECTATE_V2 = 0xfffd;
+
+// ?watch=<arena> watches an arena instead of playing in it
+const WATCH = new URLSearchParams(location.search).get('watch');
+
+// encodings we take, zlib would need an asynchronous decompressor
+const ENC_RAW = 0;
+const ENC_RLE = 1;
+const ENC_RUNS = 3;
+const ENC_BITMAP = 4;
+const ACCEPT = (1 << ENC_RLE) | (1 << ENC_RUNS) | (1 << ENC_BITMAP);
+
+const SQ_FOOD_MIN = 33;
+const SQ_WIDE_SNEK_MIN = 65;
+
+const VIEW_W = 80;
+const VIEW_H = 40;
+const VIEW_MARGIN = 10;
+const CELL_W = 10;
+const CELL_H = 16;
+
+// name, symbols for body and head, xterm colour
+const THE_SNEKS = [
+  ['Bob', 'O@', 9], ['Alice', 'O@', 10], ['Fred', 'O@', 11], ['Karen', 'O@', 12],
+  ['Chris', 'O@', 13], ['Mary', 'O@', 14], ['Pete', 'O@', 15], ['Janice', 'O@', 19],
+  ['Snuffy', 'O&', 238], ['Jody', 'O&', 160], ['Leo', 'O&', 155], ['Tricia', 'O&', 220],
+  ['Scott', 'O&', 21], ['Matt', 'O&', 129], ['Morne', 'O&', 159], ['Tammi', 'O&', 252],
+  ['Dave', 'O&', 56],
+];
+
+const THE_FOODS = {
+  33: ['.', 231], 34: ['#', 227], 35: ['i', 124], 36: ['B', 180], 37: ['_', 185], 38: ['U', 123],
+};
+
+// the xterm 256 colour palette
+function xterm(i) {
+  const base = ['#000', '#800', '#080', '#880', '#008', '#808', '#088', '#ccc',
+                '#888', '#f00', '#0f0', '#ff0', '#00f', '#f0f', '#0ff', '#fff'];
+  if (i < 16) return base[i];
+  if (i < 232) {
+    const level = (n) => (n ? 55 + n * 40 : 0);
+    i -= 16;
+    return `rgb(${level(Math.floor(i / 36))},${level(Math.floor(i / 6) % 6)},${level(i % 6)})`;
+  }
+  const gray = 8 + (i - 232) * 10;
+  return `rgb(${gray},${gray},${gray})`;
+}
+
+function isSnekSquare(v) {
+  return (v > 0 && v < SQ_FOOD_MIN) || v >= SQ_WIDE_SNEK_MIN;
+}
+
+function squareSnekId(v) {
+  return v < SQ_FOOD_MIN ? (v - 1) >> 1 : ((v - SQ_WIDE_SNEK_MIN) >> 1) + 16;
+}
+
+function snekHeadSquare(id) {
+  return id < 16 ? id * 2 + 1 : id * 2 + SQ_WIDE_SNEK_MIN - 32;
+}
+
+class Game {
+  constructor(canvas) {
+    this.canvas = canvas;
+    this.ctx = canvas.getContext('2d');
+    canvas.width = VIEW_W * CELL_W;
+    canvas.height = VIEW_H * CELL_H;
+    this.ctx.font = `${CELL_H - 2}px monospace`;
+    this.ctx.textBaseline = 'top';
+
+    this.snekId = null;
+    this.joined = false;
+    this.spectating = false;
+    this.scores = new Map();
+    this.messages = [];
+    this.glyphs = new Map();
+    this.resize(80, 40);
+  }
+
+  resize(width, height) {
+    this.width = width;
+    this.height = height;
+    this.board = new Uint16Array(width * height);
+    this.region = null;
+    this.myHead = null;
+    this.viewX = 0;
+    this.viewY = 0;
+    this.wipe = true;
+    this.changed = [];
+  }
+
+  connect() {
+    const scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+    this.ws = new WebSocket(scheme + location.host + '/snek');
+    this.ws.binaryType = 'arraybuffer';
+    this.ws.onmessage = (event) => this.receive(event.data);
+    this.ws.onclose = () => this.notice('Disconnected. Reload to play again.');
+  }
+
+  send(snekId, cmd, arg) {
+    const msg = new DataView(new ArrayBuffer(4));
+    msg.setUint16(0, snekId);
+    msg.setUint8(2, cmd);
+    msg.setUint8(3, arg);
+    this.ws.send(msg.buffer);
+  }
+
+  join() {
+    if (!this.joined && this.ws.readyState === WebSocket.OPEN) {
+      if (WATCH !== null) {
+        this.send(SPECTATE_V2, Number(WATCH), ACCEPT);
+      } else {
+        this.send(JOIN_REQUEST_V2, PROTOCOL_V2, ACCEPT);
+      }
+      this.joined = true;
+      this.notice('');
+    }
+  }
+
+  turn(direction) {
+    if (this.spectating) {
+      this.pan(direction);
+    } else if (this.snekId !== null) {
+      this.send(this.snekId, direction, 0);
+    }
+  }
+
+  // spectators have no head to follow, so the arrow keys move the view instead
+  pan(direction) {
+    const step = [[0, -1], [1, 0], [0, 1], [-1, 0]][direction];
+    if (this.width > VIEW_W) this.viewX = (this.viewX + step[0] * VIEW_MARGIN + this.width) % this.width;
+    if (this.height > VIEW_H) this.viewY = (this.viewY + step[1] * VIEW_MARGIN + this.height) % this.height;
+    this.wipe = true;
+    this.draw();
+  }
+
+  // a WebSocket message holds one or more whole messages from the server
+  receive(buf) {
+    const view = new DataView(buf);
+    let at = 0;
+    while (at < view.byteLength) {
+      const type = view.getUint8(at);
+      if (type === MSG_TYPE_JOIN) {
+        this.onJoin(view.getUint16(at + 1), view.getUint16(at + 3), view.getUint16(at + 5));
+        at += 7;
+      } else if (type === MSG_TYPE_INFO) {
+        this.onInfo(view.getUint8(at + 1), view.getUint16(at + 2));
+        at += 4;
+      } else if (type === MSG_TYPE_ACK) {
+        at += 2;
+      } else {
+        const length = view.getUint32(at + 1);
+        if (type !== MSG_TYPE_TXT) this.onFrame(type, new DataView(buf, at + 5, length));
+        at += 5 + length;
+      }
+    }
+    this.draw();
+  }
+
+  onJoin(snekId, width, height) {
+    if (snekId === JOIN_REJECT_V2) {
+      this.notice(WATCH === null ? 'Server full of sneks.' : 'No such arena to watch.');
+      return;
+    }
+    this.spectating = snekId === SPECTATE_V2;
+    this.snekId = this.spectating ? null : snekId;
+    this.resize(width, height);
+  }
+
+  onInfo(infoType, snekId) {
+    const name = this.snekName(snekId);
+    if (infoType === INFO_TYPE_JOIN) {
+      this.message(name + ' has joined the fight.');
+    } else if (infoType === INFO_TYPE_KILL) {
+      this.message(name + ' has met an untimely death.  Mediocre.');
+      this.scores.delete(snekId);
+      if (snekId === this.snekId) {
+        this.snekId = null;
+        this.joined = false;
+        this.notice('YOU ARE DEAD<br>Press SPACE to respawn.');
+      }
+    }
+  }
+
+  onFrame(type, body) {
+    // snek data, then the payload with the encoding the server picked
+    const count = body.getUint16(0);
+    for (let i = 0; i < count; i++) {
+      this.scores.set(body.getUint16(2 + i * 6), body.getUint16(4 + i * 6));
+    }
+    let at = 2 + count * 6;
+    const encoding = body.getUint8(at++);
+    const myHead = this.snekId === null ? -1 : snekHeadSquare(this.snekId);
+
+    if (type === MSG_TYPE_BOARD) {
+      this.board.set(this.decodeSquares(encoding, body, at));
+      this.region = null;
+      const head = this.board.indexOf(myHead);
+      if (head >= 0) this.myHead = [head % this.width, Math.floor(head / this.width)];
+      this.wipe = true;
+    } else if (type === MSG_TYPE_REGION) {
+      const [rx, ry, rw, rh] = [0, 2, 4, 6].map((o) => body.getUint16(at + o));
+      const squares = this.decodeSquares(encoding, body, at + 8);
+      for (let i = 0; i < squares.length; i++) {
+        this.board[((ry + Math.floor(i / rw)) % this.height) * this.width + (rx + i % rw) % this.width] = squares[i];
+      }
+      this.region = [rx, ry, rw, rh];
+      this.viewX = (rx + Math.floor(Math.max(0, rw - VIEW_W) / 2)) % this.width;
+      this.viewY = (ry + Math.floor(Math.max(0, rh - VIEW_H) / 2)) % this.height;
+      this.wipe = true;
+    } else if (type === MSG_TYPE_UPDATE) {
+      this.decodeChanges(encoding, body, at, (x, y, v) => {
+        this.board[y * this.width + x] = v;
+        this.changed.push(x, y);
+        if (v === myHead) this.myHead = [x, y];
+      });
+    }
+    this.followHead();
+  }
+
+  decodeSquares(encoding, body, at) {
+    if (encoding === ENC_RLE) {
+      const squares = [];
+      for (; at < body.byteLength; at += 4) {
+        const count = body.getUint16(at);
+        const v = body.getUint16(at + 2);
+        for (let i = 0; i < count; i++) squares.push(v);
+      }
+      return squares;
+    }
+    const squares = new Uint16Array((body.byteLength - at) / 2);
+    for (let i = 0; i < squares.length; i++) squares[i] = body.getUint16(at + i * 2);
+    return squares;
+  }
+
+  decodeChanges(encoding, body, at, change) {
+    const end = body.byteLength;
+    if (encoding === ENC_RUNS) {
+      while (at < end) {
+        const x = body.getUint16(at);
+        const y = body.getUint16(at + 2);
+        const count = body.getUint16(at + 4);
+        for (let i = 0; i < count; i++) change((x + i) % this.width, y, body.getUint16(at + 6 + i * 2));
+        at += 6 + count * 2;
+      }
+    } else if (encoding === ENC_BITMAP) {
+      const [ax, ay, aw, ah] = this.region || [0, 0, this.width, this.height];
+      let value = at + Math.ceil(aw * ah / 8);
+      for (let i = 0; i < aw * ah; i++) {
+        if (body.getUint8(at + (i >> 3)) & (0x80 >> (i & 7))) {
+          change((ax + i % aw) % this.width, (ay + Math.floor(i / aw)) % this.height, body.getUint16(value));
+          value += 2;
+        }
+      }
+    } else {
+      for (; at < end; at += 6) change(body.getUint16(at), body.getUint16(at + 2), body.getUint16(at + 4));
+    }
+  }
+
+  // keep our head away from the edges of the view, unless the server picks the region we see
+  followHead() {
+    if (!this.myHead || this.region) return;
+    const [x, y] = this.myHead;
+    if (this.width > VIEW_W) {
+      const dx = (x - this.viewX + this.width) % this.width;
+      if (dx < VIEW_MARGIN || dx >= VIEW_W - VIEW_MARGIN) {
+        this.viewX = (x - Math.floor(VIEW_W / 2) + this.width) % this.width;
+        this.wipe = true;
+      }
+    }
+    if (this.height > VIEW_H) {
+      const dy = (y - this.viewY + this.height) % this.height;
+      if (dy < VIEW_MARGIN || dy >= VIEW_H - VIEW_MARGIN) {
+        this.viewY = (y - Math.floor(VIEW_H / 2) + this.height) % this.height;
+        this.wipe = true;
+      }
+    }
+  }
+
+  glyph(v) {
+    if (!this.glyphs.has(v)) {
+      let glyph = [' ', 0];
+      if (isSnekSquare(v)) {
+        const looks = THE_SNEKS[squareSnekId(v) % THE_SNEKS.length];
+        glyph = [looks[1][v % 2], looks[2]];
+      } else if (v in THE_FOODS) {
+        glyph = THE_FOODS[v];
+      }
+      this.glyphs.set(v, [glyph[0], xterm(glyph[1])]);
+    }
+    return this.glyphs.get(v);
+  }
+
+  drawSquare(vx, vy) {
+    const ctx = this.ctx;
+    ctx.fillStyle = '#000';
+    ctx.fillRect(vx * CELL_W, vy * CELL_H, CELL_W, CELL_H);
+    if (vx >= this.width || vy >= this.height) return;
+    const v = this.board[((this.viewY + vy) % this.height) * this.width + (this.viewX + vx) % this.width];
+    if (!v) return;
+    const [symbol, color] = this.glyph(v);
+    ctx.fillStyle = color;
+    ctx.fillText(symbol, vx * CELL_W + 1, vy * CELL_H + 1);
+  }
+
+  draw() {
+    if (this.wipe) {
+      for (let vy = 0; vy < VIEW_H; vy++) {
+        for (let vx = 0; vx < VIEW_W; vx++) this.drawSquare(vx, vy);
+      }
+      this.wipe = false;
+    } else {
+      for (let i = 0; i < this.changed.length; i += 2) {
+        const vx = (this.changed[i] - this.viewX + this.width) % this.width;
+        const vy = (this.changed[i + 1] - this.viewY + this.height) % this.height;
+        if (vx < VIEW_W && vy < VIEW_H) this.drawSquare(vx, vy);
+      }
+    }
+    this.changed = [];
+    this.drawScores();
+  }
+
+  snekName(snekId) {
+    const looks = THE_SNEKS[snekId % THE_SNEKS.length];
+    return snekId < THE_SNEKS.length ? looks[0] : looks[0] + ' ' + (Math.floor(snekId / THE_SNEKS.length) + 1);
+  }
+
+  drawScores() {
+    const top = [...this.scores].sort((a, b) => b[1] - a[1]).slice(0, 16);
+    const scores = document.getElementById('scores');
+    scores.replaceChildren(...top.map(([snekId, score]) => {
+      const line = document.createElement('div');
+      line.textContent = this.snekName(snekId).padEnd(14) + String(score).padStart(10, '0');
+      line.style.color = xterm(THE_SNEKS[snekId % THE_SNEKS.length][2]);
+      return line;
+    }));
+  }
+
+  message(text) {
+    this.messages.unshift(text);
+    this.messages.length = Math.min(this.messages.length, 10);
+    document.getElementById('messages').replaceChildren(...this.messages.map((m) => {
+      const line = document.createElement('div');
+      line.textContent = m;
+      return line;
+    }));
+  }
+
+  notice(html) {
+    const notice = document.getElementById('notice');
+    notice.innerHTML = html;
+    notice.style.display = html ? '' : 'none';
+  }
+}
+
+const KEYS = { ArrowUp: 0, ArrowRight: 1, ArrowDown: 2, ArrowLeft: 3 };
+
+const game = new Game(document.getElementById('board'));
+game.connect();
+document.addEventListener('keydown', (event) => {
+  if (event.key in KEYS) {
+    game.turn(KEYS[event.key]);
+  } else if (event.key === ' ') {
+    game.join();
+  } else {
+    return;
+  }
+  event.preventDefault();
+});